@@ -0,0 +1,551 @@
+import hashlib
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from clientes import lotes_por_slot
+from configuracao import (
+    CONCORRENCIA_PADRAO, RPM_PADRAO, TPM_PADRAO, MODO_ANALISE_UNICA, ORCAMENTO_TOKENS_PADRAO, RESUMO_INCREMENTAL_PADRAO,
+)
+from metricas import METRICAS
+
+# openai e tiktoken são importados no primeiro uso: as páginas do painel que só leem as
+# configurações (e os padrões definidos aqui) não pagam o tempo de importação deles
+
+# Modelo usado em todas as análises
+MODELO_PADRAO = "gpt-4o-mini"
+
+# Limite de tokens de uma única mensagem da conversa, cortada no fim para não ocupar o
+# prompt sozinha (o orçamento do prompt, ORCAMENTO_TOKENS_PADRAO, fica em configuracao)
+MAX_TOKENS_MENSAGEM = 400
+# Tokens de uma mensagem típica, usados para estimar quantas mensagens cabem no orçamento
+TOKENS_MEDIOS_MENSAGEM = 25
+
+# Validade e tamanho máximo do cache de respostas do modelo
+CACHE_TTL_PADRAO = 60 * 60 * 24 * 30
+CACHE_MAX_ENTRADAS_PADRAO = 100000
+
+# Schema da resposta da chamada única; os campos têm os mesmos nomes das chaves analise:{tipo}:{phone}.
+# A data não é pedida ao modelo: ela vem do createdAt das mensagens.
+FORMATO_RESPOSTA_ANALISE = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "analise_conversa",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "resumo": {
+                    "type": "string",
+                    "description": "Resumo da conversa em um único parágrafo, sem quebras de linha.",
+                },
+                "nome": {
+                    "type": "string",
+                    "description": "Nome do usuário ou 'Nome não fornecido'.",
+                },
+                "classificacao": {
+                    "type": "string",
+                    "description": "Apenas o status do lead.",
+                },
+            },
+            "required": ["resumo", "nome", "classificacao"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Erros que valem uma nova tentativa: 429, falhas 5xx e problemas de conexão/timeout
+def erros_recuperaveis():
+    import openai
+    return (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+# Limitador de requisições e tokens por minuto (balde de fichas reabastecido continuamente).
+# É compartilhado entre as threads, então todas as chamadas respeitam o mesmo limite.
+class LimitadorTaxa:
+    def __init__(self, rpm=RPM_PADRAO, tpm=TPM_PADRAO):
+        self.rpm = rpm or 0
+        self.tpm = tpm or 0
+        self._requisicoes = float(self.rpm)
+        self._tokens = float(self.tpm)
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reabastecer(self):
+        agora = time.monotonic()
+        decorrido = agora - self._ultimo
+        self._ultimo = agora
+        if self.rpm:
+            self._requisicoes = min(self.rpm, self._requisicoes + decorrido * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + decorrido * self.tpm / 60)
+
+    # Bloqueia até haver 1 requisição e `tokens` tokens disponíveis
+    def adquirir(self, tokens=0):
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+        while True:
+            with self._lock:
+                self._reabastecer()
+                falta_req = 1 - self._requisicoes if self.rpm else 0
+                falta_tok = tokens - self._tokens if self.tpm else 0
+                if falta_req <= 0 and falta_tok <= 0:
+                    if self.rpm:
+                        self._requisicoes -= 1
+                    if self.tpm:
+                        self._tokens -= tokens
+                    return
+                espera = max(
+                    falta_req * 60 / self.rpm if self.rpm else 0,
+                    falta_tok * 60 / self.tpm if self.tpm else 0,
+                )
+            time.sleep(max(espera, 0.01))
+
+    # Corrige o saldo de tokens com o consumo real informado em response.usage
+    def ajustar(self, tokens_estimados, tokens_reais):
+        if not self.tpm:
+            return
+        with self._lock:
+            self._tokens = min(self.tpm, self._tokens + tokens_estimados - tokens_reais)
+
+
+# Codificador do modelo, criado uma vez por processo. tiktoken é opcional: sem ele
+# (None), os tokens são estimados pelo tamanho do texto
+_codificador = None
+_codificador_carregado = False
+
+
+def codificador():
+    global _codificador, _codificador_carregado
+    if not _codificador_carregado:
+        try:
+            import tiktoken
+        except ImportError:
+            tiktoken = None
+        if tiktoken is not None:
+            try:
+                _codificador = tiktoken.encoding_for_model(MODELO_PADRAO)
+            except KeyError:
+                _codificador = tiktoken.get_encoding('o200k_base')
+        _codificador_carregado = True
+    return _codificador
+
+
+# Tokens do texto pelo tokenizador do modelo ou, sem tiktoken, ~4 caracteres por token
+def contar_tokens(texto):
+    if codificador() is None:
+        return len(texto) // 4 + 1 if texto else 0
+    return len(codificador().encode(texto, disallowed_special=()))
+
+
+# Marca do fim de uma mensagem cortada
+MARCA_CORTE = ' [...]'
+
+
+# Corta o texto em até `max_tokens` tokens (contando a marca de corte), mantendo o início
+def cortar_texto(texto, max_tokens):
+    limite = max(max_tokens - contar_tokens(MARCA_CORTE), 0)
+    if codificador() is None:
+        return texto[:limite * 4] + MARCA_CORTE if len(texto) > max_tokens * 4 else texto
+    tokens = codificador().encode(texto, disallowed_special=())
+    return codificador().decode(tokens[:limite]) + MARCA_CORTE if len(tokens) > max_tokens else texto
+
+
+# Janela da conversa para o prompt: as últimas linhas (mensagens) que cabem em `orcamento`
+# tokens, cada uma cortada em `max_tokens_mensagem`. Devolve o texto, os tokens usados e
+# quantas mensagens foram cortadas.
+def janela_conversa(mensagens, orcamento=ORCAMENTO_TOKENS_PADRAO, max_tokens_mensagem=MAX_TOKENS_MENSAGEM):
+    max_tokens_mensagem = min(max_tokens_mensagem, orcamento)
+    janela = []
+    usados = cortadas = 0
+    for linha in reversed(mensagens.strip().split('\n')):
+        tokens = contar_tokens(linha)
+        if tokens > max_tokens_mensagem:
+            linha = cortar_texto(linha, max_tokens_mensagem)
+            # A recodificação do texto cortado pode diferir em um token do corte
+            tokens = min(contar_tokens(linha), max_tokens_mensagem)
+            cortadas += 1
+        if usados + tokens > orcamento:
+            break
+        janela.append(linha)
+        usados += tokens
+    return '\n'.join(reversed(janela)), usados, cortadas
+
+
+# Estimativa de quantas mensagens recentes preenchem a janela de `orcamento` tokens
+def mensagens_estimadas_janela(orcamento=ORCAMENTO_TOKENS_PADRAO):
+    return max(orcamento // TOKENS_MEDIOS_MENSAGEM, 1)
+
+
+# Últimas `linhas` que entram na janela de `orcamento` tokens, contando cada uma até
+# `max_tokens_mensagem`, como janela_conversa as corta
+def ultimas_linhas_no_orcamento(linhas, orcamento=ORCAMENTO_TOKENS_PADRAO, max_tokens_mensagem=MAX_TOKENS_MENSAGEM):
+    max_tokens_mensagem = min(max_tokens_mensagem, orcamento)
+    usados = 0
+    for quantidade, linha in enumerate(reversed(linhas)):
+        usados += min(contar_tokens(linha), max_tokens_mensagem)
+        if usados > orcamento:
+            return linhas[len(linhas) - quantidade:]
+    return linhas
+
+
+# Estimativa usada pelo limitador antes de conhecer o usage real
+def estimar_tokens(messages, max_tokens=0):
+    return sum(contar_tokens(m.get('content') or '') for m in messages) + (max_tokens or 0)
+
+
+def _tempo_espera(erro, tentativa, backoff_base, backoff_max):
+    # Respeita o Retry-After enviado pela API, quando existir
+    resposta = getattr(erro, 'response', None)
+    if resposta is not None:
+        retry_after = resposta.headers.get('retry-after')
+        try:
+            return min(float(retry_after), backoff_max)
+        except (TypeError, ValueError):
+            pass
+    return min(backoff_base * 2 ** tentativa, backoff_max) * (0.5 + random.random() / 2)
+
+
+# Faz a chamada ao chat.completions passando pelo limitador e com retry exponencial.
+# O cliente OpenAI deve ser criado com max_retries=0 para não repetir as tentativas em dobro.
+# Latência e tokens de cada tentativa são registrados nas métricas sob `operacao`.
+def chamar_llm(client, limitador=None, max_tentativas=5, backoff_base=1.0, backoff_max=60.0, operacao='chat', **kwargs):
+    tokens_estimados = estimar_tokens(kwargs.get('messages', []), kwargs.get('max_tokens'))
+    for tentativa in range(max_tentativas):
+        if limitador is not None:
+            limitador.adquirir(tokens_estimados)
+        inicio = time.perf_counter()
+        try:
+            response = client.chat.completions.create(**kwargs)
+        except erros_recuperaveis() as e:
+            METRICAS.registrar_llm(operacao, time.perf_counter() - inicio, erro=True)
+            if tentativa == max_tentativas - 1:
+                raise
+            time.sleep(_tempo_espera(e, tentativa, backoff_base, backoff_max))
+            continue
+        except Exception:
+            METRICAS.registrar_llm(operacao, time.perf_counter() - inicio, erro=True)
+            raise
+        usage = getattr(response, 'usage', None)
+        METRICAS.registrar_llm(operacao, time.perf_counter() - inicio, usage)
+        if limitador is not None and usage is not None:
+            limitador.ajustar(tokens_estimados, usage.total_tokens)
+        return response
+
+
+# Executa `funcao` para cada item em um pool de threads e devolve (item, resultado)
+# conforme as tarefas terminam
+def executar_em_paralelo(funcao, itens, max_concorrencia=CONCORRENCIA_PADRAO):
+    itens = list(itens)
+    if not itens:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concorrencia, len(itens)))) as executor:
+        futuros = {executor.submit(funcao, item): item for item in itens}
+        for futuro in as_completed(futuros):
+            yield futuros[futuro], futuro.result()
+
+
+# Valida a resposta da chamada única e devolve somente os campos válidos;
+# os campos ausentes ou inválidos são gerados depois pelas chamadas individuais
+def interpretar_analise(conteudo):
+    try:
+        dados = json.loads(conteudo)
+    except (TypeError, ValueError):
+        return {}
+    if not isinstance(dados, dict):
+        return {}
+
+    analise = {}
+    for campo in ('resumo', 'nome', 'classificacao'):
+        valor = dados.get(campo)
+        if isinstance(valor, str) and valor.strip():
+            analise[campo] = valor.strip()
+    return analise
+
+
+# Cache das respostas do modelo no Redis, endereçado pelo conteúdo da requisição.
+# A chave é o hash de tudo que é enviado (mensagens já com o trecho da conversa,
+# prompt e configurações da IA, modelo e parâmetros), então a mesma conversa com a
+# mesma configuração nunca é paga duas vezes. As entradas expiram por TTL e, acima
+# de max_entradas, as menos usadas recentemente são removidas.
+class CacheAnalise:
+    def __init__(self, redis_client, ttl=CACHE_TTL_PADRAO, max_entradas=CACHE_MAX_ENTRADAS_PADRAO, prefixo='cache_analise'):
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self.prefixo = prefixo
+        self.chave_lru = f'{prefixo}:lru'
+        self.chave_estatisticas = f'{prefixo}:stats'
+
+    @staticmethod
+    def chave(requisicao):
+        conteudo = json.dumps(requisicao, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(conteudo.encode('utf-8')).hexdigest()
+
+    # Um acerto custa uma ida ao Redis: a consulta já conta como acerto e atualiza o LRU. Na
+    # falha (chave expirada ou removida), uma segunda ida corrige a contagem e tira a chave do LRU.
+    def obter(self, chave):
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.get(f'{self.prefixo}:{chave}')
+        pipe.zadd(self.chave_lru, {chave: time.time()}, xx=True)
+        pipe.hincrby(self.chave_estatisticas, 'hits', 1)
+        valor = pipe.execute()[0]
+        if valor is None:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.zrem(self.chave_lru, chave)
+            pipe.hincrby(self.chave_estatisticas, 'hits', -1)
+            pipe.hincrby(self.chave_estatisticas, 'misses', 1)
+            pipe.execute()
+            return None
+        return valor.decode('utf-8')
+
+    # Várias chaves em uma ida ao Redis; devolve {chave: valor} só com as encontradas
+    def obter_varios(self, chaves):
+        chaves = list(dict.fromkeys(chaves))
+        if not chaves:
+            return {}
+        # Um MGET por slot (no Redis Cluster as chaves ficam espalhadas pelos nós)
+        nomes = [f'{self.prefixo}:{chave}' for chave in chaves]
+        lotes = lotes_por_slot(self.redis_client, nomes, len(nomes))
+        pipe = self.redis_client.pipeline(transaction=False)
+        for lote in lotes:
+            pipe.mget([nomes[indice] for indice in lote])
+        encontrados = {
+            chaves[indice]: valor.decode('utf-8')
+            for lote, valores in zip(lotes, pipe.execute())
+            for indice, valor in zip(lote, valores) if valor is not None
+        }
+        pipe = self.redis_client.pipeline(transaction=False)
+        if encontrados:
+            pipe.zadd(self.chave_lru, {chave: time.time() for chave in encontrados}, xx=True)
+            pipe.hincrby(self.chave_estatisticas, 'hits', len(encontrados))
+        if len(chaves) > len(encontrados):
+            pipe.zrem(self.chave_lru, *[chave for chave in chaves if chave not in encontrados])
+            pipe.hincrby(self.chave_estatisticas, 'misses', len(chaves) - len(encontrados))
+        pipe.execute()
+        return encontrados
+
+    # Entradas do LRU sem uso há mais que o TTL já expiraram (o TTL conta da gravação, que é
+    # anterior ao último uso) e saem do LRU a cada gravação
+    def salvar(self, chave, valor):
+        agora = time.time()
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.set(f'{self.prefixo}:{chave}', valor, ex=self.ttl)
+        pipe.zremrangebyscore(self.chave_lru, '-inf', f'({agora - self.ttl}')
+        pipe.zadd(self.chave_lru, {chave: agora})
+        pipe.zcard(self.chave_lru)
+        total = pipe.execute()[-1]
+        if total > self.max_entradas:
+            self._remover_antigas(total - self.max_entradas)
+
+    def _remover_antigas(self, quantidade):
+        removidas = self.redis_client.zpopmin(self.chave_lru, quantidade)
+        if removidas:
+            self.redis_client.delete(*[f'{self.prefixo}:{chave.decode("utf-8")}' for chave, _ in removidas])
+
+    def estatisticas(self):
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hmget(self.chave_estatisticas, 'hits', 'misses')
+        pipe.zcard(self.chave_lru)
+        (hits, misses), entradas = pipe.execute()
+        hits, misses = int(hits or 0), int(misses or 0)
+        return {
+            'hits': hits,
+            'misses': misses,
+            'taxa_acerto': hits / (hits + misses) if hits + misses else 0.0,
+            'entradas': entradas,
+        }
+
+
+# Resumos que podem servir de base para o resumo incremental (não vazios nem de erro)
+def resumo_reaproveitavel(resumo):
+    if not isinstance(resumo, str) or not resumo.strip():
+        return False
+    return not resumo.startswith('Erro ao gerar resumo') and resumo != 'Sem resumo disponível'
+
+
+# Chamada ao modelo que devolve só o texto da resposta, passando pelo cache quando houver.
+# Erros não são guardados no cache.
+def completar_chat(client, limitador=None, cache=None, operacao='chat', **kwargs):
+    if cache is None:
+        return chamar_llm(client, limitador, operacao=operacao, **kwargs).choices[0].message.content
+    chave = cache.chave(kwargs)
+    conteudo = cache.obter(chave)
+    METRICAS.registrar_cache('analise', conteudo is not None)
+    if conteudo is None:
+        conteudo = chamar_llm(client, limitador, operacao=operacao, **kwargs).choices[0].message.content
+        cache.salvar(chave, conteudo)
+    return conteudo
+
+
+# Gera as análises de uma conversa (resumo, nome e classificação) com as configurações da IA.
+# Usado tanto pelo painel quanto pelo worker; os métodos não dependem do Streamlit e podem
+# rodar em threads.
+class Analisador:
+    def __init__(self, client, ai_name, ai_objectives, ai_status, modo=MODO_ANALISE_UNICA, limitador=None, cache=None,
+                 modelo=MODELO_PADRAO, orcamento_tokens=ORCAMENTO_TOKENS_PADRAO, resumo_incremental=RESUMO_INCREMENTAL_PADRAO):
+        self.client = client
+        self.ai_name = ai_name
+        self.ai_objectives = ai_objectives
+        self.ai_status = ai_status
+        self.modo = modo
+        self.limitador = limitador
+        self.cache = cache
+        self.modelo = modelo
+        self.orcamento_tokens = orcamento_tokens
+        self.resumo_incremental = resumo_incremental
+
+    # Assinatura das configurações que mudam o resultado das análises: o texto dos prompts, o
+    # modelo e o schema da resposta. Modo, orçamento de tokens e resumo incremental ficam de
+    # fora: mudá-los não exige reanalisar (e pagar de novo) todas as conversas.
+    def assinatura(self):
+        return CacheAnalise.chave([self.ai_name, self.ai_objectives, self.ai_status, self.modelo, FORMATO_RESPOSTA_ANALISE])
+
+    # Últimas mensagens da conversa que cabem no orçamento de tokens do prompt
+    def _janela(self, operacao, mensagens):
+        texto, tokens, cortadas = janela_conversa(mensagens, self.orcamento_tokens)
+        METRICAS.registrar_janela(operacao, tokens, cortadas)
+        return texto
+
+    def _completar(self, operacao, **kwargs):
+        return completar_chat(self.client, self.limitador, self.cache, operacao=operacao, model=self.modelo, **kwargs)
+
+    # Os métodos requisicao_* montam os argumentos do chat.completions (sem o modelo) de cada
+    # análise; são usados pelos gerar_* e pelo backfill em lote (backfill.py)
+    def requisicao_resumo(self, mensagens, phone_number):
+        ai_name, ai_objectives = self.ai_name, self.ai_objectives
+        mensagens_limitadas = self._janela('gerar_resumo_conversa', mensagens)
+        return dict(
+            messages=[
+                {"role": "system", "content": f"Escreva seu resumo todo em um único parágrafo sem 'enters' ou 'quebras de linhas'. Resuma a conversa entre o usuário, cujo número é {phone_number}, e a IA de nome {ai_name}. Caso o usuário forneça o nome durante a conversa, use o nome fornecido para referenciá-lo. Lembre-se que {ai_name} é o nome da IA. No seu resumo, atente-se às seguintes situações:{ai_objectives}. Essas são as mensagens entre o usuário e a IA: {mensagens_limitadas}"},
+            ],
+            max_tokens=300,
+            temperature=0.2,
+        )
+
+    def gerar_resumo_conversa(self, mensagens, phone_number):
+        try:
+            return self._completar('gerar_resumo_conversa', **self.requisicao_resumo(mensagens, phone_number)).strip()
+        except Exception as e:
+            return f"Erro ao gerar resumo: {e}"
+
+    # Atualiza o resumo anterior com as mensagens recebidas desde a última análise
+    def gerar_resumo_incremental(self, resumo_anterior, mensagens_novas, phone_number):
+        ai_name, ai_objectives = self.ai_name, self.ai_objectives
+        try:
+            mensagens_limitadas = self._janela('gerar_resumo_incremental', mensagens_novas)
+            conteudo = self._completar(
+                'gerar_resumo_incremental',
+                messages=[
+                    {"role": "system", "content": f"Escreva seu resumo todo em um único parágrafo sem 'enters' ou 'quebras de linhas'. Você receberá o resumo da conversa entre o usuário, cujo número é {phone_number}, e a IA de nome {ai_name}, seguido das mensagens trocadas depois dele. Reescreva o resumo incorporando as novas mensagens, sem perder as informações do resumo anterior. Caso o usuário forneça o nome durante a conversa, use o nome fornecido para referenciá-lo. Lembre-se que {ai_name} é o nome da IA. No seu resumo, atente-se às seguintes situações:{ai_objectives}. Resumo anterior: {resumo_anterior}"},
+                    {"role": "user", "content": f"As novas mensagens são:\n\n{mensagens_limitadas}"},
+                ],
+                max_tokens=300,
+                temperature=0.2,
+            )
+            return conteudo.strip()
+        except Exception as e:
+            return f"Erro ao gerar resumo: {e}"
+
+    def requisicao_nome(self, mensagens, phone_number):
+        ai_name = self.ai_name
+        mensagens_limitadas = self._janela('gerar_nome', mensagens)
+        return dict(
+            messages=[
+                {"role": "system", "content": f"Analise a conversa entre o usuário, cujo telefone é {phone_number}, e a IA, cujo nome é {ai_name}. Seu objetivo é identificar e retornar o nome do usuário. Seu retorno deve ser apenas o nome do usuário: Exemplo 'Bruno'. Caso não identifique o nome do usuário, retorne apenas 'Nome não fornecido'. Lembre-se que o nome da IA é {ai_name}."},
+                {"role": "user", "content": f"As mensagens são:\n\n{mensagens_limitadas}"},
+            ],
+            max_tokens=50,
+            temperature=0.2,
+        )
+
+    def gerar_nome(self, mensagens, phone_number):
+        try:
+            return self._completar('gerar_nome', **self.requisicao_nome(mensagens, phone_number)).strip()
+        except Exception as e:
+            return f"Erro ao gerar nome: {e}"
+
+    def requisicao_classificacao(self, mensagens, phone_number):
+        ai_name, ai_status = self.ai_name, self.ai_status
+        mensagens_limitadas = self._janela('gerar_classificacao', mensagens)
+        return dict(
+            messages=[
+                {"role": "system", "content": f"Analise a conversa entre o usuário, cujo telefone é {phone_number}, e a IA, cujo nome é {ai_name}. Classifique a conversa conforme as seguintes categorias: {ai_status}. Sua resposta deve conter apenas a classificação. Exemplo: 'Lead quente'"},
+                {"role": "user", "content": f"As mensagens são:\n\n{mensagens_limitadas}"},
+            ],
+            max_tokens=50,
+            temperature=0.2,
+        )
+
+    def gerar_classificacao(self, mensagens, phone_number):
+        try:
+            return self._completar('gerar_classificacao', **self.requisicao_classificacao(mensagens, phone_number)).strip()
+        except Exception as e:
+            return f"Erro ao gerar classificação: {e}"
+
+    def requisicao_analise_completa(self, mensagens, phone_number):
+        ai_name, ai_objectives, ai_status = self.ai_name, self.ai_objectives, self.ai_status
+        mensagens_limitadas = self._janela('gerar_analise_completa', mensagens)
+        return dict(
+            messages=[
+                {"role": "system", "content": f"Analise a conversa entre o usuário, cujo telefone é {phone_number}, e a IA, cujo nome é {ai_name}. Lembre-se que {ai_name} é o nome da IA. Retorne: 'resumo': um resumo da conversa em um único parágrafo sem 'enters' ou 'quebras de linhas', usando o nome do usuário caso ele o forneça e atentando-se às seguintes situações: {ai_objectives}. 'nome': apenas o nome do usuário (exemplo: 'Bruno') ou 'Nome não fornecido' caso não seja identificado. 'classificacao': apenas a classificação da conversa conforme as seguintes categorias: {ai_status}."},
+                {"role": "user", "content": f"As mensagens são:\n\n{mensagens_limitadas}"},
+            ],
+            max_tokens=450,
+            temperature=0.2,
+            response_format=FORMATO_RESPOSTA_ANALISE,
+        )
+
+    # Gera resumo, nome e classificação em uma única chamada com saída estruturada.
+    # Retorna apenas os campos que passaram na validação do schema.
+    def gerar_analise_completa(self, mensagens, phone_number):
+        try:
+            return interpretar_analise(self._completar('gerar_analise_completa', **self.requisicao_analise_completa(mensagens, phone_number)))
+        except Exception:
+            return {}
+
+    # Versão incremental da chamada única: o resumo anterior e as mensagens novas substituem a conversa
+    def gerar_analise_incremental(self, resumo_anterior, mensagens_novas, phone_number):
+        ai_name, ai_objectives, ai_status = self.ai_name, self.ai_objectives, self.ai_status
+        try:
+            mensagens_limitadas = self._janela('gerar_analise_incremental', mensagens_novas)
+            conteudo = self._completar(
+                'gerar_analise_incremental',
+                messages=[
+                    {"role": "system", "content": f"Analise a conversa entre o usuário, cujo telefone é {phone_number}, e a IA, cujo nome é {ai_name}. Lembre-se que {ai_name} é o nome da IA. Você receberá o resumo da conversa até aqui e as mensagens trocadas depois dele. Resumo anterior: {resumo_anterior}. Retorne: 'resumo': o resumo anterior reescrito incorporando as novas mensagens, sem perder as informações anteriores, em um único parágrafo sem 'enters' ou 'quebras de linhas', usando o nome do usuário caso ele o forneça e atentando-se às seguintes situações: {ai_objectives}. 'nome': apenas o nome do usuário (exemplo: 'Bruno') ou 'Nome não fornecido' caso não seja identificado. 'classificacao': apenas a classificação da conversa conforme as seguintes categorias: {ai_status}."},
+                    {"role": "user", "content": f"As novas mensagens são:\n\n{mensagens_limitadas}"},
+                ],
+                max_tokens=450,
+                temperature=0.2,
+                response_format=FORMATO_RESPOSTA_ANALISE,
+            )
+            return interpretar_analise(conteudo)
+        except Exception:
+            return {}
+
+    # Executa as análises de uma conversa. Com `resumo_anterior` e `mensagens_novas` (as recebidas
+    # desde a última análise), o resumo é atualizado só com elas quando o modo incremental está ativo.
+    def analisar_conversa(self, mensagens_texto, phone_number, resumo_anterior=None, mensagens_novas=''):
+        incremental = self.resumo_incremental and mensagens_novas.strip() and resumo_reaproveitavel(resumo_anterior)
+        if incremental:
+            gerar_resumo = lambda: self.gerar_resumo_incremental(resumo_anterior, mensagens_novas, phone_number)
+        else:
+            gerar_resumo = lambda: self.gerar_resumo_conversa(mensagens_texto, phone_number)
+        geradores = {
+            'resumo': gerar_resumo,
+            'nome': lambda: self.gerar_nome(mensagens_texto, phone_number),
+            'classificacao': lambda: self.gerar_classificacao(mensagens_texto, phone_number),
+        }
+        analise = {}
+        if self.modo == MODO_ANALISE_UNICA and incremental:
+            analise = self.gerar_analise_incremental(resumo_anterior, mensagens_novas, phone_number)
+        elif self.modo == MODO_ANALISE_UNICA:
+            analise = self.gerar_analise_completa(mensagens_texto, phone_number)
+
+        # Campos que faltaram ou vieram inválidos caem para a chamada individual
+        for analise_tipo, gerar in geradores.items():
+            if analise_tipo not in analise:
+                analise[analise_tipo] = gerar()
+        return analise
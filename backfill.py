@@ -0,0 +1,420 @@
+# Reprocessamento em massa das conversas pela Batch API da OpenAI (metade do preço e sem
+# disputar os limites por minuto com o painel). Usado ao cadastrar um cliente novo ou ao mudar
+# as configurações da IA, quando todas as conversas precisam ser reanalisadas.
+#
+# Etapas: as requisições dos gerar_* de cada conversa são gravadas em arquivos JSONL (vários
+# quando passam dos limites de um lote da Batch API), cada arquivo é enviado como um lote, os
+# lotes são acompanhados até terminar e as respostas são gravadas em analise:* e
+# dashboard_dados:*. Requisições já presentes no cache de análises não entram nos lotes. Os
+# lotes em andamento ficam em backfill:lote, e --retomar continua de onde parou (por exemplo,
+# depois de fechar o terminal).
+#
+# Uso:
+#   python -m backfill
+#   python -m backfill --selecionados
+#   python -m backfill --telefones 11999990000,21988880000 --local --openai-base-url http://localhost:8000/v1
+#   python -m backfill --retomar
+import argparse
+import json
+import logging
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from analise import (
+    Analisador, CacheAnalise, LimitadorTaxa,
+    chamar_llm, executar_em_paralelo, interpretar_analise,
+)
+from clientes import criar_cliente_openai, criar_cliente_redis
+from configuracao import MODO_ANALISE_UNICA, montar_url_redis
+from conversas import (
+    CHAVE_ASSINATURA_CONFIG, RegistroLeads, avancar_watermark, carregar_linhas_do_redis,
+    get_historic_phone_numbers, ler_conversas_pendentes, normalizar_telefones, registrar_analise,
+    restaurar_checks_do_redis, salvar_dados_no_redis,
+)
+from metricas import METRICAS
+from worker import carregar_configuracoes
+
+logger = logging.getLogger('backfill')
+
+# Lotes em andamento (ids, tipo, arquivos), para acompanhar e ingerir depois de reiniciar
+CHAVE_BACKFILL = 'backfill:lote'
+PASTA_BACKFILL = Path('data/backfill')
+
+ENDPOINT_LOTE = '/v1/chat/completions'
+STATUS_FINAIS = {'completed', 'failed', 'expired', 'cancelled'}
+
+# Limites de um arquivo de lote da Batch API: requisições e tamanho em bytes
+MAX_REQUISICOES_LOTE = 50000
+MAX_BYTES_LOTE = 200 * 1024 * 1024
+
+# Campos de cada análise nas requisições do lote: a chamada única devolve os três campos
+TIPOS_REQUISICAO = {
+    'analise_completa': 'requisicao_analise_completa',
+    'resumo': 'requisicao_resumo',
+    'nome': 'requisicao_nome',
+    'classificacao': 'requisicao_classificacao',
+}
+
+
+# Lote enviado pela Batch API da OpenAI
+class LoteOpenAI:
+    tipo = 'openai'
+
+    def __init__(self, client):
+        self.client = client
+
+    def enviar(self, caminho):
+        with open(caminho, 'rb') as arquivo:
+            enviado = self.client.files.create(file=arquivo, purpose='batch')
+        lote = self.client.batches.create(input_file_id=enviado.id, endpoint=ENDPOINT_LOTE, completion_window='24h')
+        return lote.id
+
+    def consultar(self, lote_id):
+        lote = self.client.batches.retrieve(lote_id)
+        contagem = lote.request_counts
+        return {
+            'status': lote.status,
+            'total': getattr(contagem, 'total', 0) if contagem else 0,
+            'concluidos': getattr(contagem, 'completed', 0) if contagem else 0,
+            'falhas': getattr(contagem, 'failed', 0) if contagem else 0,
+            'saida': lote.output_file_id,
+        }
+
+    def resultados(self, lote_id):
+        saida = self.consultar(lote_id)['saida']
+        if not saida:
+            return []
+        return [json.loads(linha) for linha in self.client.files.content(saida).text.splitlines() if linha.strip()]
+
+
+# Substituto local da Batch API: lê o arquivo do lote, faz as chamadas pelo endpoint do
+# `client` (por exemplo, um servidor de testes compatível com a OpenAI) e grava a saída no
+# mesmo formato da Batch API. O lote termina dentro de enviar().
+class LoteLocal:
+    tipo = 'local'
+
+    def __init__(self, client, limitador=None, max_concorrencia=8):
+        self.client = client
+        self.limitador = limitador
+        self.max_concorrencia = max_concorrencia
+
+    def enviar(self, caminho):
+        with open(caminho, encoding='utf-8') as arquivo:
+            requisicoes = [json.loads(linha) for linha in arquivo if linha.strip()]
+
+        def executar(requisicao):
+            try:
+                resposta = chamar_llm(self.client, self.limitador, operacao='backfill_local', **requisicao['body'])
+                return {'response': {'status_code': 200, 'body': resposta.model_dump()}, 'error': None}
+            except Exception as e:
+                return {'response': None, 'error': {'message': str(e)}}
+
+        saida = Path(caminho).with_suffix('.saida.jsonl')
+        with open(saida, 'w', encoding='utf-8') as arquivo:
+            for requisicao, resultado in executar_em_paralelo(executar, requisicoes, self.max_concorrencia):
+                arquivo.write(json.dumps({'custom_id': requisicao['custom_id'], **resultado}, ensure_ascii=False) + '\n')
+        return str(saida)
+
+    def consultar(self, lote_id):
+        with open(lote_id, encoding='utf-8') as arquivo:
+            linhas = [json.loads(linha) for linha in arquivo if linha.strip()]
+        falhas = sum(1 for linha in linhas if linha.get('error'))
+        return {'status': 'completed', 'total': len(linhas), 'concluidos': len(linhas) - falhas, 'falhas': falhas, 'saida': lote_id}
+
+    def resultados(self, lote_id):
+        with open(lote_id, encoding='utf-8') as arquivo:
+            return [json.loads(linha) for linha in arquivo if linha.strip()]
+
+
+# Números a reprocessar: todos, os marcados no painel (`selecionados`) ou os informados em `telefones`
+def selecionar_telefones(redis_client, telefones=None, selecionados=False):
+    phone_numbers = get_historic_phone_numbers(redis_client)
+    normalizados = normalizar_telefones(pd.Series([item['phone_number'] for item in phone_numbers], dtype=object)).tolist()
+    if telefones:
+        escolhidos = set(telefones)
+    elif selecionados:
+        checks = pd.DataFrame({'Número de WhatsApp': normalizados, 'Selecionado': False})
+        restaurar_checks_do_redis(redis_client, checks)
+        escolhidos = set(checks.loc[checks['Selecionado'].astype(bool), 'Número de WhatsApp'])
+    else:
+        return phone_numbers
+    return [item for item, phone in zip(phone_numbers, normalizados) if phone in escolhidos]
+
+
+# Grava os arquivos dos lotes com as requisições que não estão no cache, cada um dentro de
+# `max_requisicoes` e `max_bytes`, e o manifesto com as conversas e a chave de cache de cada
+# requisição. `completo` indica que todas as conversas entraram nos lotes. Devolve os caminhos
+# dos arquivos, o do manifesto e os totais de requisições enviadas e já em cache.
+def preparar_lote(analisador, pendentes, completo=False, pasta=PASTA_BACKFILL,
+                  max_requisicoes=MAX_REQUISICOES_LOTE, max_bytes=MAX_BYTES_LOTE):
+    pasta.mkdir(parents=True, exist_ok=True)
+    nome = datetime.now().strftime('%Y%m%d_%H%M%S')
+    caminho_manifesto = pasta / f'lote_{nome}.manifesto.json'
+    tipos = ['analise_completa'] if analisador.modo == MODO_ANALISE_UNICA else ['resumo', 'nome', 'classificacao']
+
+    corpos = {}
+    for indice, pendente in enumerate(pendentes):
+        for tipo in tipos:
+            requisicao = getattr(analisador, TIPOS_REQUISICAO[tipo])(pendente['mensagens_texto'], pendente['phone_number'])
+            corpos[f'{indice}:{tipo}'] = {'model': analisador.modelo, **requisicao}
+    # Mesma chave usada por completar_chat, para que lote e chamadas individuais compartilhem o cache
+    chaves = {custom_id: CacheAnalise.chave(corpo) for custom_id, corpo in corpos.items()}
+    em_cache = analisador.cache.obter_varios(chaves.values()) if analisador.cache is not None else {}
+
+    # Um arquivo novo sempre que o próximo passaria de um dos limites
+    caminhos_lote = []
+    arquivo = None
+    requisicoes = tamanho = enviados = 0
+    try:
+        for custom_id, corpo in corpos.items():
+            if chaves[custom_id] in em_cache:
+                continue
+            linha = (json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': ENDPOINT_LOTE, 'body': corpo}, ensure_ascii=False) + '\n').encode('utf-8')
+            if arquivo is None or requisicoes >= max_requisicoes or tamanho + len(linha) > max_bytes:
+                if arquivo is not None:
+                    arquivo.close()
+                caminhos_lote.append(pasta / f'lote_{nome}_{len(caminhos_lote) + 1}.jsonl')
+                arquivo = open(caminhos_lote[-1], 'wb')
+                requisicoes = tamanho = 0
+            arquivo.write(linha)
+            requisicoes += 1
+            tamanho += len(linha)
+            enviados += 1
+    finally:
+        if arquivo is not None:
+            arquivo.close()
+
+    manifesto = {
+        'assinatura': analisador.assinatura(),
+        'completo': completo,
+        'pendentes': [
+            {**pendente, 'data_criacao': pendente['data_criacao'].isoformat() if pendente['data_criacao'] else None}
+            for pendente in pendentes
+        ],
+        'chaves': chaves,
+    }
+    caminho_manifesto.write_text(json.dumps(manifesto, ensure_ascii=False), encoding='utf-8')
+    return caminhos_lote, caminho_manifesto, enviados, len(corpos) - enviados
+
+
+# Texto da resposta de cada requisição do lote que terminou com sucesso
+def respostas_do_lote(resultados):
+    respostas = {}
+    for resultado in resultados:
+        resposta = resultado.get('response') or {}
+        if resultado.get('error') or resposta.get('status_code') != 200:
+            continue
+        try:
+            respostas[resultado['custom_id']] = resposta['body']['choices'][0]['message']['content']
+        except (KeyError, IndexError, TypeError):
+            continue
+    return respostas
+
+
+# Grava as análises do lote nas chaves analise:* e nas linhas do dashboard. As respostas que
+# faltaram (falhas no lote) ou vieram inválidas passam pelas chamadas individuais.
+def ingerir_lote(redis_client, analisador, manifesto, respostas, max_concorrencia=8):
+    chaves = manifesto['chaves']
+    # As respostas do lote entram no cache; as requisições que ficaram fora do lote já estavam nele
+    em_cache = {}
+    if analisador.cache is not None:
+        for custom_id, texto in respostas.items():
+            analisador.cache.salvar(chaves[custom_id], texto)
+        em_cache = analisador.cache.obter_varios(chave for custom_id, chave in chaves.items() if custom_id not in respostas)
+
+    def conteudo(indice, tipo):
+        custom_id = f'{indice}:{tipo}'
+        return respostas.get(custom_id) or em_cache.get(chaves.get(custom_id))
+
+    pendentes = [
+        {**pendente, 'data_criacao': datetime.fromisoformat(pendente['data_criacao']) if pendente['data_criacao'] else None}
+        for pendente in manifesto['pendentes']
+    ]
+    analises = []
+    for indice, pendente in enumerate(pendentes):
+        analise = {}
+        if analisador.modo == MODO_ANALISE_UNICA:
+            completa = conteudo(indice, 'analise_completa')
+            analise = interpretar_analise(completa) if completa else {}
+        else:
+            for tipo in ('resumo', 'nome', 'classificacao'):
+                texto = conteudo(indice, tipo)
+                if texto:
+                    analise[tipo] = texto.strip()
+        analises.append(analise)
+
+    geradores = {
+        'resumo': analisador.gerar_resumo_conversa,
+        'nome': analisador.gerar_nome,
+        'classificacao': analisador.gerar_classificacao,
+    }
+
+    def completar(item):
+        pendente, analise = item
+        for tipo, gerar in geradores.items():
+            if tipo not in analise:
+                analise[tipo] = gerar(pendente['mensagens_texto'], pendente['phone_number'])
+        return analise
+
+    incompletas = [(pendente, analise) for pendente, analise in zip(pendentes, analises) if len(analise) < len(geradores)]
+    if incompletas:
+        logger.info("%s conversas sem resposta válida no lote; analisando individualmente", len(incompletas))
+        list(executar_em_paralelo(completar, incompletas, max_concorrencia))
+
+    normalizados = [pendente['normalized_phone_number'] for pendente in pendentes]
+    registro = RegistroLeads(carregar_linhas_do_redis(redis_client, normalizados).values())
+    for pendente, analise in zip(pendentes, analises):
+        registrar_analise(redis_client, registro, pendente, analise)
+    df = registro.para_dataframe(list(dict.fromkeys(normalizados)))
+    if not df.empty:
+        salvar_dados_no_redis(redis_client, df)
+    return len(pendentes)
+
+
+# Acompanha os lotes até todos chegarem a um status final, registrando o progresso somado a
+# cada consulta. O status geral só é final quando todos os lotes terminaram: 'completed' se
+# todos foram concluídos ou o status do primeiro que não foi.
+def aguardar_lotes(redis_client, lote, lote_ids, intervalo=30):
+    situacoes = {}
+    while True:
+        for lote_id in lote_ids:
+            if situacoes.get(lote_id, {}).get('status') not in STATUS_FINAIS:
+                situacoes[lote_id] = lote.consultar(lote_id)
+        terminados = [situacao for situacao in situacoes.values() if situacao['status'] in STATUS_FINAIS]
+        if len(terminados) < len(lote_ids):
+            status = 'in_progress'
+        else:
+            status = next((situacao['status'] for situacao in terminados if situacao['status'] != 'completed'), 'completed')
+        concluidos = sum(situacao['concluidos'] for situacao in situacoes.values())
+        falhas = sum(situacao['falhas'] for situacao in situacoes.values())
+        redis_client.hset(CHAVE_BACKFILL, mapping={'status': status, 'concluidos': concluidos, 'falhas': falhas})
+        logger.info("Lotes: %s/%s terminados (%s/%s requisições, %s falhas)", len(terminados), len(lote_ids),
+                    concluidos, sum(situacao['total'] for situacao in situacoes.values()), falhas)
+        if status in STATUS_FINAIS:
+            return situacoes
+        time.sleep(intervalo)
+
+
+# Envia os arquivos que ainda não têm lote, gravando cada id em backfill:lote assim que o lote
+# é criado, para que uma falha no meio do envio possa ser retomada sem reenviar os anteriores
+def enviar_lotes(redis_client, lote, estado):
+    arquivos = json.loads(estado['arquivos'])
+    lote_ids = json.loads(estado['lotes'])
+    for indice, caminho in enumerate(arquivos):
+        if not lote_ids[indice]:
+            lote_ids[indice] = lote.enviar(caminho)
+            estado['lotes'] = json.dumps(lote_ids)
+            redis_client.hset(CHAVE_BACKFILL, 'lotes', estado['lotes'])
+            logger.info("Arquivo %s enviado como o lote %s (%s/%s)", caminho, lote_ids[indice], indice + 1, len(arquivos))
+    return lote_ids
+
+
+def executar(redis_client, analisador, lote, phone_numbers=None, completo=False, intervalo=30, max_concorrencia=8):
+    estado = {chave.decode('utf-8'): valor.decode('utf-8') for chave, valor in redis_client.hgetall(CHAVE_BACKFILL).items()}
+
+    if phone_numbers is not None:
+        if estado and estado.get('status') not in STATUS_FINAIS | {'ingerido'}:
+            raise SystemExit(f"Já existem lotes em andamento ({estado.get('lotes')}). Use --retomar.")
+        normalizados = normalizar_telefones(pd.Series([item['phone_number'] for item in phone_numbers], dtype=object)).tolist()
+        registro = RegistroLeads(carregar_linhas_do_redis(redis_client, normalizados).values())
+        # Todas as conversas são reanalisadas: as linhas anteriores só servem de base para os campos fixos
+        pendentes = ler_conversas_pendentes(redis_client, phone_numbers, normalizados, registro, reanalisar=True, orcamento_tokens=analisador.orcamento_tokens)
+        # Números sem conversa recebem a linha padrão já na leitura
+        analisados = {pendente['normalized_phone_number'] for pendente in pendentes}
+        sem_conversa = registro.para_dataframe([phone for phone in dict.fromkeys(normalizados) if phone not in analisados])
+        if not sem_conversa.empty:
+            salvar_dados_no_redis(redis_client, sem_conversa)
+
+        caminhos_lote, caminho_manifesto, enviados, em_cache = preparar_lote(analisador, pendentes, completo)
+        logger.info("%s conversas, %s requisições em %s lotes (%s já estavam no cache)", len(pendentes), enviados, len(caminhos_lote), em_cache)
+
+        estado = {
+            'lotes': json.dumps([''] * len(caminhos_lote)), 'tipo': lote.tipo,
+            'arquivos': json.dumps([str(caminho) for caminho in caminhos_lote]), 'manifesto': str(caminho_manifesto),
+            'status': 'enviando' if enviados else 'completed', 'enviado_em': int(time.time()),
+            'max_watermark': max((item['created_at'] or 0 for item in phone_numbers), default=0),
+        }
+        redis_client.delete(CHAVE_BACKFILL)
+        redis_client.hset(CHAVE_BACKFILL, mapping=estado)
+    elif not estado:
+        raise SystemExit("Nenhum lote para retomar.")
+    elif estado.get('status') == 'ingerido':
+        logger.info("Os últimos lotes (%s) já foram ingeridos.", estado.get('lotes'))
+        return 0
+    elif estado.get('tipo') != lote.tipo:
+        raise SystemExit(f"O lote em andamento é do tipo '{estado.get('tipo')}'; use a mesma opção (--local) para retomá-lo.")
+
+    respostas = {}
+    lote_ids = enviar_lotes(redis_client, lote, estado)
+    if lote_ids:
+        for lote_id, situacao in aguardar_lotes(redis_client, lote, lote_ids, intervalo).items():
+            if situacao['status'] != 'completed':
+                logger.warning("Lote %s terminou com status %s; as conversas sem resposta serão analisadas individualmente", lote_id, situacao['status'])
+            respostas.update(respostas_do_lote(lote.resultados(lote_id)))
+
+    manifesto = json.loads(Path(estado['manifesto']).read_text(encoding='utf-8'))
+    with METRICAS.etapa('ingerir_backfill'):
+        total = ingerir_lote(redis_client, analisador, manifesto, respostas, max_concorrencia)
+
+    # Com todas as conversas reanalisadas, o painel não precisa repetir a reanálise
+    if manifesto['completo']:
+        redis_client.set(CHAVE_ASSINATURA_CONFIG, manifesto['assinatura'])
+        if int(estado.get('max_watermark') or 0):
+            avancar_watermark(redis_client, [{'created_at': int(estado['max_watermark'])}])
+    redis_client.hset(CHAVE_BACKFILL, 'status', 'ingerido')
+    logger.info("%s conversas gravadas", total)
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reprocessamento das conversas em lote pela Batch API da OpenAI.")
+    parser.add_argument('--redis-url', help="URL completa do Redis (padrão: credenciais salvas em Configurações)")
+    parser.add_argument('--openai-base-url', help="Endpoint compatível com a API da OpenAI (ex.: servidor de testes)")
+    selecao = parser.add_mutually_exclusive_group()
+    selecao.add_argument('--telefones', help="Números (com DDD, sem o 55) separados por vírgula; padrão: todos")
+    selecao.add_argument('--selecionados', action='store_true', help="Apenas os números marcados no painel")
+    selecao.add_argument('--retomar', action='store_true', help="Acompanha e ingere o lote em andamento em vez de criar outro")
+    parser.add_argument('--local', action='store_true', help="Executa o lote localmente pelo endpoint em vez da Batch API")
+    parser.add_argument('--intervalo', type=int, default=30, help="Segundos entre as consultas ao status do lote")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    load_dotenv()
+
+    config = carregar_configuracoes()
+    redis_url = args.redis_url or montar_url_redis(config['redis_url'], config['redis_password'])
+    redis_client = criar_cliente_redis(redis_url)
+    redis_client.ping()
+    client = criar_cliente_openai(config['api_key'], base_url=args.openai_base_url)
+
+    limitador = LimitadorTaxa(rpm=config['llm_rpm'], tpm=config['llm_tpm'])
+    analisador = Analisador(
+        client,
+        config['ai_name'],
+        config['ai_objectives'],
+        config['ai_status'],
+        modo=config['llm_modo_analise'],
+        limitador=limitador,
+        cache=CacheAnalise(redis_client),
+        orcamento_tokens=config['llm_orcamento_tokens'],
+        resumo_incremental=False,
+    )
+    if args.local:
+        lote = LoteLocal(client, limitador, config['llm_concorrencia'])
+    else:
+        lote = LoteOpenAI(client)
+
+    phone_numbers = None
+    if not args.retomar:
+        telefones = [telefone.strip() for telefone in args.telefones.split(',')] if args.telefones else None
+        phone_numbers = selecionar_telefones(redis_client, telefones, args.selecionados)
+    completo = not args.retomar and not args.telefones and not args.selecionados
+    executar(redis_client, analisador, lote, phone_numbers, completo, args.intervalo, config['llm_concorrencia'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+# Benchmark offline da atualização do painel e da preparação do Dashboard BI.
+# Popula um Redis (local ou fakeredis em memória) com N números x M mensagens no mesmo formato
+# lido pelo dashboard (message:*, threadId:*, conversation:*), sobe um endpoint compatível com a
+# API da OpenAI com latência configurável e mede cada etapa em vários tamanhos.
+#
+# Uso:
+#   python -m benchmark
+#   python -m benchmark --escalas 100,1000,5000 --mensagens 40 --latencia 0.2 --saida bench.json
+#   python -m benchmark --redis-url redis://localhost:6379/15 --comparar bench.json
+#   python -m benchmark --redis-url redis://localhost:7000   # um nó de um Redis Cluster local
+#
+# Atenção: o banco do --redis-url é apagado (FLUSHDB) a cada escala.
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pandas as pd
+from openai import OpenAI
+
+from analise import Analisador, CacheAnalise, LimitadorTaxa
+from clientes import criar_cliente_redis
+from configuracao import MODO_ANALISE_UNICA, MODOS_ANALISE
+from conversas import (
+    RegistroLeads, buscar_leads, chave_telefone, get_historic_phone_numbers, ler_rollups, processar_em_fluxo,
+    processar_telefones, reconstruir_indice_busca, registrar_mensagem_no_indice, restaurar_dados_do_redis, salvar_dados_no_redis,
+)
+from relatorios import CAMINHO_DDD_ESTADO, carregar_relatorio, salvar_relatorio
+
+# fakeredis é opcional: só é necessário quando nenhum --redis-url é informado
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+ESCALAS_PADRAO = '100,1000'
+TOLERANCIA_PADRAO = 0.2
+
+RESPOSTA_ANALISE = {
+    'resumo': "Usuário pediu informações sobre o produto e agradeceu o atendimento. Obrigado.",
+    'nome': "Maria",
+    'classificacao': "Lead quente",
+}
+
+
+# Endpoint /v1/chat/completions que responde depois de `latencia` segundos
+class ServidorOpenAIFalso(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latencia=0.0):
+        super().__init__(('127.0.0.1', 0), _RespostaChat)
+        self.latencia = latencia
+        self.chamadas = 0
+        self._trava = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/v1'
+
+    def iniciar(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _RespostaChat(BaseHTTPRequestHandler):
+    def do_POST(self):
+        corpo = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        with self.server._trava:
+            self.server.chamadas += 1
+        time.sleep(self.server.latencia)
+
+        # Com response_format, a análise única espera o JSON com resumo, nome e classificação
+        if corpo.get('response_format'):
+            conteudo = json.dumps(RESPOSTA_ANALISE, ensure_ascii=False)
+        else:
+            conteudo = RESPOSTA_ANALISE['resumo']
+        tokens_prompt = sum(len(str(mensagem.get('content', ''))) for mensagem in corpo.get('messages', [])) // 4
+        resposta = json.dumps({
+            'id': f'chatcmpl-bench-{self.server.chamadas}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': corpo.get('model', 'benchmark'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': conteudo},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': tokens_prompt, 'completion_tokens': 40, 'total_tokens': tokens_prompt + 40},
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(resposta)))
+        self.end_headers()
+        self.wfile.write(resposta)
+
+    def log_message(self, *args):
+        pass
+
+
+# Popula o Redis com `telefones` conversas de `mensagens` mensagens cada, alternando usuário e
+# assistente, com os metadados message:* usados no scan e o threadId de cada número. Como o
+# bot, registra cada número no índice de telefones.
+def popular_redis(redis_client, telefones, mensagens, inicio_ms=None):
+    inicio_ms = inicio_ms if inicio_ms is not None else int(time.time() * 1000) - telefones * mensagens * 1000
+    pipe = redis_client.pipeline(transaction=False)
+    for i in range(telefones):
+        phone_number = f'55{11 + i % 89:02d}9{i:08d}'
+        normalizado = phone_number[2:]
+        thread_id = f'thread_bench_{i}'
+        pipe.set(chave_telefone(redis_client, 'threadId:', normalizado), thread_id)
+        conversa = []
+        for j in range(mensagens):
+            created_at = inicio_ms + (i * mensagens + j) * 1000
+            pipe.hset(f'message:{i}:{j}', mapping={'phoneNumber': phone_number, 'createdAt': created_at})
+            conversa.append(json.dumps({
+                'role': 'user' if j % 2 == 0 else 'assistant',
+                'content': f'Mensagem {j} da conversa {i} sobre preços, prazos e formas de pagamento.',
+                'createdAt': created_at,
+            }))
+        pipe.rpush(chave_telefone(redis_client, 'conversation:', normalizado, thread_id), *conversa)
+        registrar_mensagem_no_indice(redis_client, phone_number, created_at, pipe)
+        if i % 200 == 199:
+            pipe.execute()
+    pipe.execute()
+
+
+# Acrescenta uma mensagem do usuário às primeiras `quantidade` conversas (atualização parcial).
+# O texto leva o horário para que cada rodada gere análises novas, e não acertos do cache.
+def acrescentar_mensagens(redis_client, quantidade):
+    created_at = int(time.time() * 1000)
+    pipe = redis_client.pipeline(transaction=False)
+    for i in range(quantidade):
+        pipe.rpush(chave_telefone(redis_client, 'conversation:', f'{11 + i % 89:02d}9{i:08d}', f'thread_bench_{i}'), json.dumps({
+            'role': 'user', 'content': f'Mensagem nova ({created_at})', 'createdAt': created_at,
+        }))
+    pipe.execute()
+
+
+# Atualização como no botão "Atualizar" do painel: em fluxo, com cada bloco gravado no Redis
+# assim que suas análises terminam. Devolve as linhas dos números visitados.
+def atualizar_painel(redis_client, analisador, phone_numbers, concorrencia):
+    registro = RegistroLeads(restaurar_dados_do_redis(redis_client))
+    visitados = []
+    for df_bloco, _ in processar_em_fluxo(redis_client, analisador, phone_numbers, registro, max_concorrencia=concorrencia):
+        visitados.extend(df_bloco['Número de WhatsApp'])
+    return registro.para_dataframe(list(dict.fromkeys(visitados)))
+
+
+@contextmanager
+def cronometro(resultados, etapa):
+    inicio = time.perf_counter()
+    yield
+    resultados[etapa] = time.perf_counter() - inicio
+
+
+# Mede as etapas para uma escala. Os arquivos do relatório são gravados em um diretório temporário.
+def medir_escala(redis_client, client, telefones, mensagens, concorrencia, modo):
+    redis_client.flushdb()
+    popular_redis(redis_client, telefones, mensagens)
+
+    analisador = Analisador(
+        client, 'Bia', 'Qualificar leads interessados', 'Lead quente, Lead frio',
+        modo=modo,
+        limitador=LimitadorTaxa(rpm=10 ** 9, tpm=10 ** 12),
+        cache=CacheAnalise(redis_client),
+    )
+    resultados = {}
+
+    with cronometro(resultados, 'scan_telefones'):
+        historic_phone_numbers = get_historic_phone_numbers(redis_client, usar_indice=False)
+    with cronometro(resultados, 'indice_telefones'):
+        get_historic_phone_numbers(redis_client, usar_indice=True)
+
+    # Atualização completa como no botão "Atualizar": análises e gravação em fluxo, e relatório
+    with cronometro(resultados, 'atualizacao_completa'):
+        with cronometro(resultados, 'analises'):
+            df = atualizar_painel(redis_client, analisador, historic_phone_numbers, concorrencia)
+        df = df.drop(columns='Mensagens', errors='ignore').sort_values(by='Data de Criação', ascending=False)
+        with cronometro(resultados, 'salvar_relatorio'):
+            salvar_relatorio(df)
+
+    with cronometro(resultados, 'atualizacao_sem_mudancas'):
+        atualizar_painel(redis_client, analisador, historic_phone_numbers, concorrencia)
+
+    acrescentar_mensagens(redis_client, max(1, telefones // 10))
+    with cronometro(resultados, 'atualizacao_10pct'):
+        atualizar_painel(redis_client, analisador, historic_phone_numbers, concorrencia)
+
+    # Caminho do worker (python -m worker): análises de todo o grupo e uma única gravação
+    with cronometro(resultados, 'worker_sem_mudancas'):
+        processar_telefones(redis_client, analisador, historic_phone_numbers, max_concorrencia=concorrencia)
+
+    acrescentar_mensagens(redis_client, max(1, telefones // 10))
+    with cronometro(resultados, 'worker_10pct'):
+        df_parcial = processar_telefones(redis_client, analisador, historic_phone_numbers, max_concorrencia=concorrencia)
+        salvar_dados_no_redis(redis_client, df_parcial)
+
+    with cronometro(resultados, 'restaurar_redis'):
+        RegistroLeads(restaurar_dados_do_redis(redis_client)).para_dataframe()
+
+    # Preparação dos dados do Dashboard BI (sem renderizar os gráficos)
+    with cronometro(resultados, 'bi_carregar_relatorio'):
+        carregar_relatorio()
+    with cronometro(resultados, 'bi_agregados'):
+        agregados = ler_rollups(redis_client)
+        agregados.groupby('Status')['conversas'].sum()
+        agregados.groupby('Dia')['conversas'].sum()
+
+    # Índice de busca do painel: montagem completa e uma busca com prefixo
+    with cronometro(resultados, 'busca_indice'):
+        reconstruir_indice_busca(redis_client)
+    with cronometro(resultados, 'busca'):
+        buscar_leads(redis_client, 'formas de pagamento prazo')
+
+    resultados['chamadas_llm'] = analisador.cache.estatisticas()['misses']
+    return resultados
+
+
+def imprimir_resultados(resultados):
+    tabela = pd.DataFrame(resultados).T
+    tabela.index.name = 'telefones'
+    etapas = [coluna for coluna in tabela.columns if coluna != 'chamadas_llm']
+    tabela[etapas] = tabela[etapas].map(lambda segundos: f'{segundos * 1000:.1f} ms')
+    tabela['chamadas_llm'] = tabela['chamadas_llm'].astype(int)
+    print(tabela.T.to_string())
+
+
+# Etapas que ficaram mais de `tolerancia` mais lentas que no arquivo de referência
+def comparar_resultados(resultados, referencia, tolerancia):
+    regressoes = []
+    for escala, etapas in resultados.items():
+        anteriores = referencia.get(str(escala), {})
+        for etapa, segundos in etapas.items():
+            anterior = anteriores.get(etapa)
+            if etapa != 'chamadas_llm' and anterior and segundos > anterior * (1 + tolerancia):
+                regressoes.append(f'{escala} telefones / {etapa}: {anterior * 1000:.1f} ms -> {segundos * 1000:.1f} ms')
+    return regressoes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline da atualização do painel e do Dashboard BI.")
+    parser.add_argument('--escalas', default=ESCALAS_PADRAO, help="Números de telefones a medir, separados por vírgula")
+    parser.add_argument('--mensagens', type=int, default=20, help="Mensagens por conversa")
+    parser.add_argument('--latencia', type=float, default=0.05, help="Latência de cada resposta do endpoint falso, em segundos")
+    parser.add_argument('--concorrencia', type=int, default=8, help="Análises simultâneas")
+    parser.add_argument('--modo', choices=list(MODOS_ANALISE), default=MODO_ANALISE_UNICA, help="Modo de análise")
+    parser.add_argument('--redis-url', help="Redis local a usar (o banco é apagado). Sem ele, usa fakeredis em memória")
+    parser.add_argument('--saida', help="Grava os resultados em JSON")
+    parser.add_argument('--comparar', help="JSON de uma execução anterior; termina com erro se alguma etapa regredir")
+    parser.add_argument('--tolerancia', type=float, default=TOLERANCIA_PADRAO, help="Regressão tolerada na comparação (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    if args.redis_url:
+        redis_client = criar_cliente_redis(args.redis_url)
+    elif fakeredis is not None:
+        redis_client = fakeredis.FakeRedis()
+    else:
+        parser.error("Informe --redis-url ou instale o fakeredis para usar um Redis em memória.")
+
+    servidor = ServidorOpenAIFalso(args.latencia).iniciar()
+    client = OpenAI(api_key='benchmark', base_url=servidor.base_url, max_retries=0)
+
+    # O relatório usa caminhos relativos (data/...): as medições rodam em um diretório temporário
+    diretorio_original = Path.cwd()
+    diretorio = Path(tempfile.mkdtemp(prefix='benchmark_'))
+    (diretorio / 'data').mkdir()
+    shutil.copy(CAMINHO_DDD_ESTADO, diretorio / CAMINHO_DDD_ESTADO)
+    os.chdir(diretorio)
+    resultados = {}
+    try:
+        for escala in [int(valor) for valor in args.escalas.split(',')]:
+            print(f"[{datetime.now():%H:%M:%S}] {escala} telefones x {args.mensagens} mensagens...", flush=True)
+            resultados[escala] = medir_escala(redis_client, client, escala, args.mensagens, args.concorrencia, args.modo)
+    finally:
+        os.chdir(diretorio_original)
+        shutil.rmtree(diretorio, ignore_errors=True)
+        servidor.shutdown()
+
+    imprimir_resultados(resultados)
+    if args.saida:
+        Path(args.saida).write_text(json.dumps(resultados, indent=2))
+    if args.comparar:
+        regressoes = comparar_resultados(resultados, json.loads(Path(args.comparar).read_text()), args.tolerancia)
+        for regressao in regressoes:
+            print(f"REGRESSÃO {regressao}")
+        if regressoes:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
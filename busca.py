@@ -0,0 +1,120 @@
+import re
+import unicodedata
+import uuid
+
+# Índice invertido do painel: para cada campo e termo, um conjunto com os números dos leads
+# cujo campo contém o termo (busca:{indice}:{campo}:{termo}). Os termos são as palavras em
+# minúsculas e sem acentos, sem as palavras muito comuns do português. Todas as chaves do
+# índice têm a mesma hash tag ({indice}), para que SINTER/SUNIONSTORE funcionem também
+# em um Redis Cluster.
+PREFIXO_INDICE = 'busca:{indice}:'
+# Termos conhecidos (ZSET com score 0), usado para expandir o prefixo da última palavra da busca
+CHAVE_VOCABULARIO = PREFIXO_INDICE + 'vocabulario'
+# Incrementada a cada alteração; marca que o índice já foi montado
+CHAVE_INDICE_VERSAO = PREFIXO_INDICE + 'versao'
+
+# Campos indexados e as colunas do painel de onde vêm
+CAMPOS_BUSCA = {
+    'nome': 'Nome do usuário',
+    'status': 'Status',
+    'resumo': 'Resumo da Conversa (IA) 🤖',
+    'mensagens': 'Mensagens',
+}
+
+# A última palavra da busca vale como prefixo a partir deste tamanho, expandida para no
+# máximo MAX_EXPANSOES_PREFIXO termos; palavras menores precisam ser completas
+MIN_PREFIXO = 3
+MAX_EXPANSOES_PREFIXO = 20
+TAMANHO_LOTE_INDICE = 1000
+
+# Palavras ignoradas na indexação e na busca. 'usuario' e 'assistente' iniciam todas as
+# linhas das conversas.
+PALAVRAS_IGNORADAS = frozenset("""
+    a o as os e de da do das dos em no na nos nas um uma uns umas ao aos para pra por pelo pela
+    com sem que se ou mas mais como ja eu tu ele ela nos voces eles elas me te lhe seu sua seus suas
+    meu minha meus minhas isso isto esse essa este esta foi ser ter tem sao era nao sim
+    usuario assistente
+""".split())
+
+_PALAVRA = re.compile(r'[a-z0-9]+')
+
+
+# Texto em minúsculas e sem acentos ('Satisfação' -> 'satisfacao'); outros símbolos são descartados
+def normalizar_texto(texto):
+    return unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode('ascii').lower()
+
+
+# Termos de um texto, na ordem em que aparecem e sem repetições
+def tokenizar(texto):
+    if not isinstance(texto, str) or not texto:
+        return []
+    termos = _PALAVRA.findall(normalizar_texto(texto))
+    return list(dict.fromkeys(termo for termo in termos if len(termo) > 1 and termo not in PALAVRAS_IGNORADAS))
+
+
+def chave_termo(campo, termo):
+    return f'{PREFIXO_INDICE}{campo}:{termo}'
+
+
+# Termos de uma linha do painel no formato campo:termo
+def termos_da_linha(linha):
+    return {f'{campo}:{termo}' for campo, coluna in CAMPOS_BUSCA.items() for termo in tokenizar(linha.get(coluna))}
+
+
+# Enfileira em `pipe` a troca dos termos `anteriores` pelos `novos` de cada número. Os
+# números de cada termo vão em um único SADD/SREM, em vez de um comando por lead.
+def atualizar_indice(pipe, telefones, anteriores, novos):
+    adicionados = {}
+    removidos = {}
+    for telefone, termos_anteriores, termos_novos in zip(telefones, anteriores, novos):
+        for termo in termos_novos - termos_anteriores:
+            adicionados.setdefault(termo, []).append(telefone)
+        for termo in termos_anteriores - termos_novos:
+            removidos.setdefault(termo, []).append(telefone)
+    for comando, termos in ((pipe.srem, removidos), (pipe.sadd, adicionados)):
+        for termo, numeros in termos.items():
+            for i in range(0, len(numeros), TAMANHO_LOTE_INDICE):
+                comando(PREFIXO_INDICE + termo, *numeros[i:i + TAMANHO_LOTE_INDICE])
+    # Termos que deixam de ser usados continuam no vocabulário até o índice ser reconstruído
+    vocabulario = list({termo.split(':', 1)[1] for termo in adicionados})
+    for i in range(0, len(vocabulario), TAMANHO_LOTE_INDICE):
+        pipe.zadd(CHAVE_VOCABULARIO, dict.fromkeys(vocabulario[i:i + TAMANHO_LOTE_INDICE], 0))
+    pipe.incr(CHAVE_INDICE_VERSAO)
+
+
+# Apaga o índice inteiro: os conjuntos de cada campo e termo do vocabulário, sem percorrer as chaves
+def limpar_indice(redis_client):
+    termos = [termo.decode('utf-8') for termo in redis_client.zrange(CHAVE_VOCABULARIO, 0, -1)]
+    chaves = [chave_termo(campo, termo) for termo in termos for campo in CAMPOS_BUSCA] + [CHAVE_VOCABULARIO, CHAVE_INDICE_VERSAO]
+    for i in range(0, len(chaves), TAMANHO_LOTE_INDICE):
+        redis_client.delete(*chaves[i:i + TAMANHO_LOTE_INDICE])
+
+
+# Números dos leads que têm todas as palavras da busca em algum dos `campos` (todos, por
+# padrão). A última palavra vale como prefixo. Custa duas idas ao Redis, independente do
+# número de leads.
+def buscar(redis_client, consulta, campos=None):
+    termos = tokenizar(consulta)
+    if not termos:
+        return set()
+    campos = list(campos or CAMPOS_BUSCA)
+    grupos = [[termo] for termo in termos[:-1]]
+    ultimo = termos[-1]
+    if len(ultimo) >= MIN_PREFIXO:
+        expansoes = redis_client.zrangebylex(CHAVE_VOCABULARIO, f'[{ultimo}', f'[{ultimo}\xff', start=0, num=MAX_EXPANSOES_PREFIXO)
+        grupos.append([termo.decode('utf-8') for termo in expansoes])
+    else:
+        grupos.append([ultimo])
+    if not grupos[-1]:
+        return set()
+
+    # Cada palavra vira a união dos seus conjuntos nos campos pedidos; o resultado é a interseção
+    temporarias = [f'{PREFIXO_INDICE}tmp:{uuid.uuid4().hex}' for _ in grupos]
+    pipe = redis_client.pipeline(transaction=False)
+    for temporaria, grupo in zip(temporarias, grupos):
+        pipe.sunionstore(temporaria, [chave_termo(campo, termo) for termo in grupo for campo in campos])
+    pipe.sinter(temporarias)
+    for temporaria in temporarias:
+        pipe.delete(temporaria)
+    telefones = pipe.execute()[len(grupos)]
+    return {telefone.decode('utf-8') for telefone in telefones}
@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+from redis.cluster import RedisCluster
+
+from metricas import instrumentar_redis
+
+# Limites do pool de conexões com o Redis, compartilhado por todas as sessões do painel
+# (ou por todas as threads do worker). Com o pool cheio, a chamada espera uma conexão livre
+# por até REDIS_ESPERA_CONEXAO segundos em vez de abrir outra.
+REDIS_MAX_CONEXOES = 32
+REDIS_ESPERA_CONEXAO = 10
+# Conexões paradas há mais tempo que isso recebem um PING antes de serem reutilizadas
+REDIS_VERIFICACAO_SEGUNDOS = 30
+REDIS_TIMEOUT_CONEXAO = 5
+
+
+# Cliente Redis sobre um pool de conexões limitado. Quando o endereço é de um nó de um
+# Redis Cluster, devolve um RedisCluster (com um pool por nó), descoberto a partir desse nó.
+# Os comandos enviados são contados para a página Diagnóstico.
+def criar_cliente_redis(redis_url, max_conexoes=REDIS_MAX_CONEXOES):
+    pool = redis.BlockingConnectionPool.from_url(
+        redis_url,
+        max_connections=max_conexoes,
+        timeout=REDIS_ESPERA_CONEXAO,
+        health_check_interval=REDIS_VERIFICACAO_SEGUNDOS,
+        socket_connect_timeout=REDIS_TIMEOUT_CONEXAO,
+        socket_keepalive=True,
+    )
+    redis_client = redis.Redis(connection_pool=pool)
+    if _cluster_habilitado(redis_client):
+        pool.disconnect()
+        redis_client = RedisCluster.from_url(
+            redis_url,
+            max_connections=max_conexoes,
+            health_check_interval=REDIS_VERIFICACAO_SEGUNDOS,
+            socket_connect_timeout=REDIS_TIMEOUT_CONEXAO,
+            socket_keepalive=True,
+        )
+    return instrumentar_redis(redis_client)
+
+
+def _cluster_habilitado(redis_client):
+    try:
+        return bool(redis_client.info('cluster').get('cluster_enabled'))
+    except redis.ResponseError:
+        # Servidores sem a seção cluster no INFO
+        return False
+
+
+def em_cluster(redis_client):
+    return isinstance(redis_client, RedisCluster)
+
+
+# Pipeline em MULTI/EXEC. Em um Redis Cluster, uma transação não pode envolver chaves de
+# slots diferentes; os comandos vão em um pipeline comum, sem a garantia de atomicidade.
+def pipeline_transacao(redis_client):
+    return redis_client.pipeline(transaction=not em_cluster(redis_client))
+
+
+# Índices das chaves em lotes de até `tamanho_lote` que podem ir juntos em um comando de
+# várias chaves (MGET, MSET). Em um Redis Cluster, cada lote tem chaves de um único slot;
+# os lotes vão no mesmo pipeline, que o cliente do cluster envia nó a nó.
+def lotes_por_slot(redis_client, chaves, tamanho_lote):
+    if not em_cluster(redis_client):
+        return [range(i, min(i + tamanho_lote, len(chaves))) for i in range(0, len(chaves), tamanho_lote)]
+    slots = {}
+    for indice, chave in enumerate(chaves):
+        slots.setdefault(redis_client.keyslot(chave), []).append(indice)
+    return [indices[i:i + tamanho_lote] for indices in slots.values() for i in range(0, len(indices), tamanho_lote)]
+
+
+# Aplica `funcao(cliente, chaves)` a cada lote de chaves do SCAN de `match` e devolve a lista
+# de resultados. Em um Redis Cluster, cada nó primário é percorrido em paralelo com o cliente
+# do próprio nó, então `funcao` pode usar um pipeline comum para as chaves recebidas.
+def varrer_chaves(redis_client, match, funcao, tamanho_lote):
+    if not em_cluster(redis_client):
+        return _varrer_no(redis_client, match, funcao, tamanho_lote)
+    nos = redis_client.get_primaries()
+    with ThreadPoolExecutor(max_workers=len(nos)) as executor:
+        partes = executor.map(
+            lambda no: _varrer_no(redis_client.get_redis_connection(no), match, funcao, tamanho_lote), nos,
+        )
+        return [resultado for parte in partes for resultado in parte]
+
+
+def _varrer_no(cliente, match, funcao, tamanho_lote):
+    resultados = []
+    cursor = 0
+    while True:
+        cursor, chaves = cliente.scan(cursor=cursor, match=match, count=tamanho_lote)
+        if chaves:
+            resultados.append(funcao(cliente, chaves))
+        if cursor == 0:
+            return resultados
+
+
+# Cliente OpenAI para ser reutilizado: o cliente HTTP interno mantém as conexões abertas
+# entre as chamadas. As novas tentativas (429, 5xx) ficam a cargo de chamar_llm.
+# openai é importado aqui, e não no topo, para que quem só usa o Redis não pague a importação
+def criar_cliente_openai(api_key, base_url=None):
+    from openai import OpenAI
+    return OpenAI(api_key=api_key or None, base_url=base_url, max_retries=0)
+
+
+# Fecha as conexões de um cliente que deixou de ser usado (credenciais alteradas).
+# No Redis, fecha só as conexões livres, para não interromper comandos de outras sessões.
+def fechar_cliente(cliente):
+    if isinstance(cliente, redis.Redis):
+        cliente.connection_pool.disconnect(inuse_connections=False)
+    else:
+        cliente.close()
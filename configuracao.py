@@ -0,0 +1,74 @@
+import logging
+import pickle
+from pathlib import Path
+
+# Configuração de pastas para armazenamento da chave
+PASTA_CONFIGURACOES = Path('configuracoes')
+
+# Caminhos dos arquivos de configuração
+API_KEY_PATH = PASTA_CONFIGURACOES / 'OPENAI_API_KEY'
+REDIS_URL_PATH = PASTA_CONFIGURACOES / 'REDIS_URL'
+REDIS_PASSWORD_PATH = PASTA_CONFIGURACOES / 'REDIS_PASSWORD'
+
+AI_NAME_PATH = PASTA_CONFIGURACOES / 'AI_NAME'
+AI_OBJECTIVES_PATH = PASTA_CONFIGURACOES / 'AI_OBJECTIVES'
+
+AI_STATUS_PATH = PASTA_CONFIGURACOES / 'STATUS'
+
+LLM_CONCORRENCIA_PATH = PASTA_CONFIGURACOES / 'LLM_CONCORRENCIA'
+LLM_RPM_PATH = PASTA_CONFIGURACOES / 'LLM_RPM'
+LLM_TPM_PATH = PASTA_CONFIGURACOES / 'LLM_TPM'
+LLM_MODO_ANALISE_PATH = PASTA_CONFIGURACOES / 'LLM_MODO_ANALISE'
+LLM_ORCAMENTO_TOKENS_PATH = PASTA_CONFIGURACOES / 'LLM_ORCAMENTO_TOKENS'
+LLM_RESUMO_INCREMENTAL_PATH = PASTA_CONFIGURACOES / 'LLM_RESUMO_INCREMENTAL'
+MODO_EXECUCAO_PATH = PASTA_CONFIGURACOES / 'MODO_EXECUCAO'
+
+# Valores padrão das configurações da IA. Ficam aqui, e não em analise, para que as páginas
+# do painel que só leem as configurações não importem analise (e com ele clientes e redis).
+# Limites de uso da API (nível 1 do gpt-4o-mini)
+CONCORRENCIA_PADRAO = 8
+RPM_PADRAO = 500
+TPM_PADRAO = 200000
+
+# Tokens da conversa enviados em cada prompt (as mensagens mais recentes que couberem)
+ORCAMENTO_TOKENS_PADRAO = 2000
+
+# Resumo incremental: com um resumo anterior válido, só as mensagens novas vão para o modelo
+RESUMO_INCREMENTAL_PADRAO = True
+
+# Modos de análise: uma chamada com saída estruturada ou as três chamadas separadas (resumo, nome e classificação)
+MODO_ANALISE_UNICA = 'unica'
+MODO_ANALISE_SEPARADA = 'separada'
+MODOS_ANALISE = {
+    MODO_ANALISE_UNICA: 'Chamada única (JSON estruturado)',
+    MODO_ANALISE_SEPARADA: 'Três chamadas separadas',
+}
+
+
+# Funções de leitura e escrita da chave API
+def salva_chave(caminho, chave):
+    with open(caminho, 'wb') as f:
+        pickle.dump(chave, f)
+
+# `avisar` recebe a mensagem quando o arquivo está corrompido (st.warning no dashboard)
+def le_chave(caminho, avisar=logging.warning):
+    if caminho.exists() and caminho.stat().st_size > 0:
+        with open(caminho, 'rb') as f:
+            try:
+                return pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                avisar(f"O arquivo de chave em {caminho} está corrompido ou vazio. Salve novamente a chave.")
+                # Limpa o arquivo corrompido
+                caminho.write_bytes(b'')
+                return ''
+    else:
+        return ''
+
+# URL de conexão a partir do endereço e da senha salvos em Configurações
+def montar_url_redis(redis_url, redis_password):
+    return f'redis://default:{redis_password}@{redis_url}'
+
+# Versão dos arquivos de configuração (data de modificação de cada um), usada como chave
+# de cache para não reler os arquivos a cada sessão
+def versao_configuracoes(caminhos):
+    return tuple(caminho.stat().st_mtime_ns if caminho.exists() else 0 for caminho in caminhos)
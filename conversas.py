@@ -0,0 +1,962 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+from analise import executar_em_paralelo, mensagens_estimadas_janela, ultimas_linhas_no_orcamento
+from busca import CHAVE_INDICE_VERSAO, atualizar_indice, buscar, limpar_indice, termos_da_linha, tokenizar
+from clientes import em_cluster, lotes_por_slot, pipeline_transacao, varrer_chaves
+from configuracao import CONCORRENCIA_PADRAO, ORCAMENTO_TOKENS_PADRAO
+from metricas import METRICAS, medir
+
+# Índice ordenado opcional (telefone -> último createdAt), habilitado com
+# USAR_INDICE_TELEFONES=1. O bot que grava as mensagens precisa chamar
+# registrar_mensagem_no_indice a cada mensagem gravada; enquanto ele faz isso, a lista de
+# números vem de um único ZREVRANGE em vez de percorrer todas as chaves message:*
+INDICE_TELEFONES_KEY = 'index:phone_last_created_at'
+# Horário da última mensagem registrada por quem grava as mensagens. Sem registro há mais
+# de VALIDADE_INDICE_TELEFONES segundos, o índice pode estar desatualizado e volta o scan.
+CHAVE_INDICE_ESCRITOR = 'index:phone_last_created_at:escritor'
+VALIDADE_INDICE_TELEFONES_PADRAO = 24 * 60 * 60
+TAMANHO_LOTE_SCAN = 1000
+
+# Assinatura das configurações da IA usadas na última atualização do painel
+CHAVE_ASSINATURA_CONFIG = 'analise_config:assinatura'
+
+# Marca d'água da atualização incremental: maior createdAt já processado pelo painel
+CHAVE_WATERMARK_REFRESH = 'refresh:watermark'
+
+# Fila de números a analisar consumida pelo worker (python -m worker). As chaves da fila têm
+# a mesma hash tag ({analise}), para que LMOVE/BLMOVE entre elas funcionem em um Redis Cluster.
+FILA_ANALISE = 'fila:{analise}'
+FILA_ANALISE_PROCESSANDO = 'fila:{analise}:processando'
+PROGRESSO_ANALISE = 'fila:{analise}:progresso'
+
+# Formato usado na coluna 'Data de Criação'
+FORMATO_DATA = '%d/%m/%y %H:%M:%S'
+
+# Agregados diários do Dashboard BI: um hash por dia (rollup:dia:AAAA-MM-DD) com os campos
+# {métrica}:{DDD}:{Status}, mantidos por salvar_dados_no_redis à medida que as linhas mudam.
+# Os dias existentes ficam no ZSET rollup:dias (score AAAAMMDD) e as linhas sem data em
+# rollup:sem_data. A versão é incrementada a cada alteração e marca que os agregados existem;
+# o sufixo muda quando a regra de alguma métrica muda, para que os agregados sejam remontados.
+PREFIXO_ROLLUP_DIA = 'rollup:dia:'
+CHAVE_ROLLUP_SEM_DATA = 'rollup:sem_data'
+CHAVE_ROLLUP_DIAS = 'rollup:dias'
+CHAVE_ROLLUP_VERSAO = 'rollup:versao:2'
+METRICAS_ROLLUP = ['conversas', 'mensagens', 'satisfeitos']
+
+# Conversa completa de cada lead, fora do JSON da linha: o painel só a lê quando é pedida.
+# Na linha fica apenas o hash do texto, usado para saber se a conversa mudou.
+PREFIXO_MENSAGENS = 'dashboard_mensagens:'
+
+# Termos de cada lead no índice de busca (busca.py), separados por espaço; usados para
+# saber o que sai do índice quando a linha muda
+PREFIXO_TERMOS_BUSCA = 'busca_termos:'
+
+# Atualização em fluxo do painel: números lidos por bloco e blocos lidos à frente das
+# análises. Limitam as conversas mantidas em memória, independente do total de leads.
+TAMANHO_BLOCO_FLUXO = 50
+BLOCOS_EM_ESPERA = 2
+
+# Palavras no resumo que indicam satisfação do usuário, comparadas como termos do índice de
+# busca (busca.tokenizar): a métrica 'satisfeitos' conta os mesmos leads que o índice encontra
+PALAVRAS_SATISFACAO = ('satisfação', 'agradecimento', 'obrigado', 'obrigada')
+TERMOS_SATISFACAO = frozenset(termo for palavra in PALAVRAS_SATISFACAO for termo in tokenizar(palavra))
+
+
+# Lidos a cada chamada para respeitar o .env carregado pelo dashboard/worker
+def indice_telefones_habilitado():
+    return os.getenv('USAR_INDICE_TELEFONES', '').lower() in ('1', 'true', 'sim')
+
+def validade_indice_telefones():
+    return int(os.getenv('VALIDADE_INDICE_TELEFONES') or VALIDADE_INDICE_TELEFONES_PADRAO)
+
+
+# Normaliza uma Series de números: só dígitos, sem o DDI 55 e com o nono dígito
+def normalizar_telefones(phones):
+    digitos = phones.fillna('').astype(str).str.replace(r'\D', '', regex=True)
+    com_ddi = digitos.str.startswith('55')
+    digitos = digitos.where(~com_ddi, digitos.str[2:])
+    # Números antigos sem o nono dígito (DDD + 8 dígitos) recebem o 9 depois do DDD
+    sem_nono_digito = com_ddi & (digitos.str.len() == 10)
+    return digitos.where(~sem_nono_digito, digitos.str[:2] + '9' + digitos.str[2:])
+
+
+# Converte a coluna 'Data de Criação' para datetime64 de uma vez. Aceita datas no FORMATO_DATA,
+# só o dia ('%d/%m/%y') e timestamps UNIX (segundos ou milissegundos) de dados antigos;
+# valores vazios ou inválidos viram NaT.
+def normalizar_datas(datas):
+    if pd.api.types.is_datetime64_any_dtype(datas):
+        return datas
+    # Linhas vindas de análises recentes já trazem datetime; as lidas do Redis trazem texto
+    objetos = datas.map(lambda valor: isinstance(valor, datetime))
+    convertidas = pd.to_datetime(datas.where(objetos), errors='coerce')
+    textos = datas.where(~objetos).astype('string').str.strip()
+    convertidas = convertidas.fillna(pd.to_datetime(textos, format=FORMATO_DATA, errors='coerce'))
+    convertidas = convertidas.fillna(pd.to_datetime(textos, format='%d/%m/%y', errors='coerce'))
+    numeros = pd.to_numeric(textos.where(textos.str.fullmatch(r'\d+', na=False)), errors='coerce')
+    numeros = numeros.where(numeros <= 1e11, numeros / 1000)
+    return convertidas.fillna(pd.to_datetime(numeros, unit='s', errors='coerce'))
+
+
+# Datas no FORMATO_DATA para exibição, exportação e gravação no Redis ('' quando ausentes)
+def formatar_datas(datas):
+    return normalizar_datas(datas).dt.strftime(FORMATO_DATA).fillna('')
+
+
+# O createdAt das mensagens pode vir em segundos ou milissegundos; converte para datetime local
+def timestamp_para_datetime(timestamp):
+    timestamp = float(timestamp)
+    if timestamp > 1e11:
+        timestamp /= 1000
+    return datetime.fromtimestamp(timestamp)
+
+
+# Chave de um número: `prefixo` + número + `:sufixos`. Em um Redis Cluster, o número vai
+# entre chaves ({phone}, hash tag), para que threadId, conversa, análises, check e linha do
+# mesmo número fiquem no mesmo slot; fora do cluster, mantém o formato original.
+def chave_telefone(redis_client, prefixo, phone_number, *sufixos):
+    telefone = f"{{{phone_number}}}" if em_cluster(redis_client) else phone_number
+    return ':'.join([f"{prefixo}{telefone}", *map(str, sufixos)])
+
+# Número de uma chave de `prefixo`, com ou sem a hash tag
+def telefone_da_chave(chave, prefixo):
+    return chave[len(prefixo):].split(':', 1)[0].strip('{}')
+
+
+# Funções para salvar e restaurar análises individuais no Redis
+def salvar_analise_no_redis(redis_client, phone_number, analise_tipo, resultado):
+    redis_client.set(chave_telefone(redis_client, f"analise:{analise_tipo}:", phone_number), resultado)
+
+def restaurar_analise_do_redis(redis_client, phone_number, analise_tipo):
+    resultado = redis_client.get(chave_telefone(redis_client, f"analise:{analise_tipo}:", phone_number))
+    if resultado:
+        return resultado.decode('utf-8')
+    else:
+        return None
+
+
+# Contrato de quem grava as mensagens (o bot): chamar a cada mensagem gravada, em message:*
+# ou só na lista conversation:*. GT mantém sempre o maior createdAt já visto para o número.
+# Com `pipe`, os comandos são só enfileirados nele.
+def registrar_mensagem_no_indice(redis_client, phone_number, created_at, pipe=None):
+    executar = pipe is None
+    pipe = pipe if pipe is not None else redis_client.pipeline(transaction=False)
+    pipe.zadd(INDICE_TELEFONES_KEY, {phone_number: int(created_at)}, gt=True)
+    pipe.set(CHAVE_INDICE_ESCRITOR, int(time.time()))
+    if executar:
+        pipe.execute()
+
+# O índice só substitui o scan enquanto alguém o mantém; sem isso, números novos sumiriam do painel
+def indice_telefones_mantido(redis_client):
+    registrado = redis_client.get(CHAVE_INDICE_ESCRITOR)
+    return registrado is not None and time.time() - int(registrado) <= validade_indice_telefones()
+
+def reconstruir_indice_telefones(redis_client, phone_numbers_with_timestamps):
+    pipe = redis_client.pipeline(transaction=False)
+    itens = list(phone_numbers_with_timestamps.items())
+    for i in range(0, len(itens), TAMANHO_LOTE_SCAN):
+        pipe.zadd(INDICE_TELEFONES_KEY, dict(itens[i:i + TAMANHO_LOTE_SCAN]), gt=True)
+    pipe.execute()
+
+# Percorre as chaves message:* em lotes, buscando apenas phoneNumber e createdAt
+# com um pipeline por lote (um round trip por lote em vez de um HGETALL por chave).
+# Em um Redis Cluster, os nós são percorridos em paralelo.
+def scan_telefones_mensagens(_redis_client, tamanho_lote=TAMANHO_LOTE_SCAN):
+    def ler_lote(cliente, keys):
+        pipe = cliente.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, 'phoneNumber', 'createdAt')
+        return pipe.execute()
+
+    phone_numbers_with_timestamps = {}
+    for lote in varrer_chaves(_redis_client, 'message:*', ler_lote, tamanho_lote):
+        for phone_raw, created_raw in lote:
+            if phone_raw is None or created_raw is None:
+                continue
+            phone_number = phone_raw.decode('utf-8')
+            created_at = int(created_raw)
+            if created_at > phone_numbers_with_timestamps.get(phone_number, float('-inf')):
+                phone_numbers_with_timestamps[phone_number] = created_at
+    return phone_numbers_with_timestamps
+
+# Função para obter todos os números históricos
+@medir('listar_telefones')
+def get_historic_phone_numbers(_redis_client, usar_indice=None):
+    if usar_indice is None:
+        usar_indice = indice_telefones_habilitado()
+    if usar_indice and indice_telefones_mantido(_redis_client):
+        indice = _redis_client.zrevrange(INDICE_TELEFONES_KEY, 0, -1, withscores=True)
+        if indice:
+            return [{'phone_number': phone.decode('utf-8'), 'created_at': int(timestamp)} for phone, timestamp in indice]
+
+    phone_numbers_with_timestamps = scan_telefones_mensagens(_redis_client)
+
+    # Índice habilitado, mas vazio ou sem quem o mantenha: o scan é mesclado ao índice, para
+    # que ele esteja completo quando o bot passar a registrar as mensagens, e a lista inclui
+    # os números já registrados só no índice (conversas sem message:*)
+    if usar_indice:
+        reconstruir_indice_telefones(_redis_client, phone_numbers_with_timestamps)
+        indice = _redis_client.zrevrange(INDICE_TELEFONES_KEY, 0, -1, withscores=True)
+        return [{'phone_number': phone.decode('utf-8'), 'created_at': int(timestamp)} for phone, timestamp in indice]
+
+    # Ordenar e retornar todos os históricos
+    sorted_phone_numbers = sorted(phone_numbers_with_timestamps.items(), key=lambda x: x[1], reverse=True)
+    historic_phone_numbers = [{'phone_number': phone, 'created_at': timestamp} for phone, timestamp in sorted_phone_numbers]
+    return historic_phone_numbers
+
+
+def ler_watermark(redis_client):
+    watermark = redis_client.get(CHAVE_WATERMARK_REFRESH)
+    return int(watermark) if watermark is not None else None
+
+# Números sem created_at (conversas alteradas detectadas pelo LLEN) não movem a marca
+def avancar_watermark(redis_client, phone_numbers):
+    timestamps = [item['created_at'] for item in phone_numbers if item.get('created_at') is not None]
+    if timestamps:
+        redis_client.set(CHAVE_WATERMARK_REFRESH, max(max(timestamps), ler_watermark(redis_client) or 0))
+
+# Números com atividade desde a última atualização. Os números já no painel (`registro`)
+# entram quando a conversa mudou: outro threadId ou LLEN diferente do tamanho salvo, o que
+# inclui mensagens gravadas só em conversation:*. Os números com mensagens depois da marca
+# d'água vêm do índice de telefones (ZRANGEBYSCORE), quando o bot o mantém; sem ele, do scan
+# de message:* (só phoneNumber e createdAt), para que números novos não fiquem de fora.
+@medir('listar_telefones_alterados')
+def get_changed_phone_numbers(_redis_client, watermark, registro, usar_indice=None):
+    if usar_indice is None:
+        usar_indice = indice_telefones_habilitado()
+    if usar_indice and indice_telefones_mantido(_redis_client):
+        indice = _redis_client.zrangebyscore(INDICE_TELEFONES_KEY, f'({watermark}', '+inf', withscores=True)
+        alterados = {phone.decode('utf-8'): int(timestamp) for phone, timestamp in indice}
+    else:
+        alterados = {phone: timestamp for phone, timestamp in scan_telefones_mensagens(_redis_client).items() if timestamp > watermark}
+    ordenados = [{'phone_number': phone, 'created_at': timestamp} for phone, timestamp in sorted(alterados.items(), key=lambda x: x[1], reverse=True)]
+    novos = set(normalizar_telefones(pd.Series(list(alterados), dtype=object)))
+    return ordenados + [
+        {'phone_number': phone_number, 'created_at': None}
+        for phone_number in conversas_alteradas(_redis_client, registro) if phone_number not in novos
+    ]
+
+# Números do `registro` cuja conversa mudou desde a linha salva, em duas idas ao Redis
+# (MGET dos threadIds e LLEN das conversas)
+def conversas_alteradas(redis_client, registro):
+    phone_numbers = list(registro)
+    thread_ids = [
+        thread_id.decode('utf-8') if thread_id else None
+        for thread_id in _mget_em_lotes(redis_client, [chave_telefone(redis_client, 'threadId:', phone) for phone in phone_numbers])
+    ]
+    com_conversa = [(phone_number, thread_id) for phone_number, thread_id in zip(phone_numbers, thread_ids) if thread_id]
+    pipe = redis_client.pipeline(transaction=False)
+    for phone_number, thread_id in com_conversa:
+        pipe.llen(chave_telefone(redis_client, 'conversation:', phone_number, thread_id))
+    alterados = []
+    for (phone_number, thread_id), tamanho in zip(com_conversa, pipe.execute()):
+        linha = registro.get(phone_number)
+        tamanho_salvo = linha.get('Tamanho Conversa')
+        if linha.get('Thread ID') != thread_id or pd.isna(tamanho_salvo) or int(tamanho_salvo) != tamanho:
+            alterados.append(phone_number)
+    return alterados
+
+
+# Conjunto com os números que têm linha salva em dashboard_dados:{phone}; permite
+# carregar o painel com SMEMBERS + MGET em vez de SCAN + um GET por chave
+CHAVE_TELEFONES_DASHBOARD = 'dashboard_telefones'
+# Incrementada a cada gravação de linhas do painel; o relatório guarda a versão de que foi gerado
+CHAVE_VERSAO_DASHBOARD = 'dashboard_versao'
+
+
+# Lê as chaves em blocos de MGET dentro de um único pipeline (um round trip; no cluster,
+# um por nó), com blocos de um único slot, e devolve os valores na ordem de `keys`
+def _mget_em_lotes(redis_client, keys):
+    lotes = lotes_por_slot(redis_client, keys, TAMANHO_LOTE_SCAN)
+    pipe = redis_client.pipeline(transaction=False)
+    for lote in lotes:
+        pipe.mget([keys[indice] for indice in lote])
+    valores = [None] * len(keys)
+    for lote, resultado in zip(lotes, pipe.execute()):
+        for indice, valor in zip(lote, resultado):
+            valores[indice] = valor
+    return valores
+
+# Grava os pares em blocos de MSET (de um único slot) dentro de um único pipeline
+def _mset_em_lotes(redis_client, pares, pipe=None):
+    executar = pipe is None
+    pipe = pipe if pipe is not None else redis_client.pipeline(transaction=False)
+    for lote in lotes_por_slot(redis_client, [chave for chave, _ in pares], TAMANHO_LOTE_SCAN):
+        pipe.mset(dict(pares[indice] for indice in lote))
+    if executar:
+        pipe.execute()
+
+# Decodifica vários JSONs de uma vez, juntando-os em uma única lista
+def _carregar_jsons(valores):
+    valores = [valor for valor in valores if valor]
+    if not valores:
+        return []
+    return json.loads(b'[' + b','.join(valores) + b']')
+
+
+def assinatura_mensagens(mensagens_texto):
+    return hashlib.sha1(mensagens_texto.encode('utf-8')).hexdigest()
+
+
+# Função para salvar dados processados no Redis
+@medir('salvar_redis')
+def salvar_dados_no_redis(redis_client, df):
+    if df.empty:
+        return
+    phone_numbers = df['Número de WhatsApp'].tolist()
+    pipe = redis_client.pipeline(transaction=False)
+    # O índice de busca recebe os termos das linhas novas, inclusive os da conversa
+    atualizar_indice_busca(redis_client, df, pipe)
+    # As conversas vão para chaves próprias e a linha guarda só o hash
+    pares_mensagens = []
+    if 'Mensagens' in df.columns:
+        mensagens = df['Mensagens']
+        com_mensagens = mensagens.notna()
+        pares_mensagens = [
+            (chave_telefone(redis_client, PREFIXO_MENSAGENS, phone_number), texto)
+            for phone_number, texto in zip(df.loc[com_mensagens, 'Número de WhatsApp'], mensagens[com_mensagens])
+        ]
+        df = df.drop(columns='Mensagens')
+        df.loc[com_mensagens, 'Hash Mensagens'] = mensagens[com_mensagens].map(assinatura_mensagens)
+    # A data é gravada como texto no FORMATO_DATA
+    registros = df.assign(**{'Data de Criação': formatar_datas(df['Data de Criação'])}).to_dict('records')
+    pares = [
+        (chave_telefone(redis_client, 'dashboard_dados:', phone_number), json.dumps(registro))  # Salva cada linha como JSON no Redis
+        for phone_number, registro in zip(phone_numbers, registros)
+    ]
+    # Os agregados do BI recebem a diferença entre as linhas antigas e as novas
+    atualizar_rollups(redis_client, df, pipe)
+    _mset_em_lotes(redis_client, pares + pares_mensagens, pipe)
+    for i in range(0, len(phone_numbers), TAMANHO_LOTE_SCAN):
+        pipe.sadd(CHAVE_TELEFONES_DASHBOARD, *phone_numbers[i:i + TAMANHO_LOTE_SCAN])
+    pipe.incr(CHAVE_VERSAO_DASHBOARD)
+    pipe.execute()
+
+def versao_dados_do_redis(redis_client):
+    versao = redis_client.get(CHAVE_VERSAO_DASHBOARD)
+    return int(versao) if versao is not None else 0
+
+# Função para restaurar dados do Redis
+@medir('restaurar_redis')
+def restaurar_dados_do_redis(redis_client):
+    keys = [chave_telefone(redis_client, 'dashboard_dados:', phone.decode('utf-8')) for phone in redis_client.smembers(CHAVE_TELEFONES_DASHBOARD)]
+    if not keys:
+        # Dados gravados antes do conjunto de números existir: faz o scan uma vez e preenche o conjunto
+        lotes = varrer_chaves(redis_client, 'dashboard_dados:*', lambda _, chaves: [key.decode('utf-8') for key in chaves], TAMANHO_LOTE_SCAN)
+        keys = [key for lote in lotes for key in lote]
+        phone_numbers = [telefone_da_chave(key, 'dashboard_dados:') for key in keys]
+        for i in range(0, len(phone_numbers), TAMANHO_LOTE_SCAN):
+            redis_client.sadd(CHAVE_TELEFONES_DASHBOARD, *phone_numbers[i:i + TAMANHO_LOTE_SCAN])
+    linhas = _carregar_jsons(_mget_em_lotes(redis_client, keys))
+    # Linhas gravadas com a conversa dentro do JSON são regravadas uma vez no formato atual
+    legadas = [linha for linha in linhas if 'Mensagens' in linha]
+    if legadas:
+        salvar_dados_no_redis(redis_client, pd.DataFrame(legadas))
+        for linha in legadas:
+            mensagens = linha.pop('Mensagens')
+            if mensagens is not None:
+                linha['Hash Mensagens'] = assinatura_mensagens(mensagens)
+    return linhas
+
+# Linhas já salvas dos números informados, em um único MGET
+def carregar_linhas_do_redis(redis_client, phone_numbers):
+    if not phone_numbers:
+        return {}
+    dados = _mget_em_lotes(redis_client, [chave_telefone(redis_client, 'dashboard_dados:', phone_number) for phone_number in phone_numbers])
+    return {phone_number: json.loads(dado) for phone_number, dado in zip(phone_numbers, dados) if dado}
+
+# Conversa completa de um lead, lida sob demanda pelo painel
+def carregar_mensagens(redis_client, phone_number):
+    mensagens = redis_client.get(chave_telefone(redis_client, PREFIXO_MENSAGENS, phone_number))
+    return mensagens.decode('utf-8') if mensagens is not None else None
+
+# Cópia de `df` com a coluna 'Mensagens' preenchida a partir do Redis (exportação completa)
+def anexar_mensagens(redis_client, df):
+    chaves = [chave_telefone(redis_client, PREFIXO_MENSAGENS, phone_number) for phone_number in df['Número de WhatsApp'].astype(str)]
+    mensagens = [valor.decode('utf-8') if valor is not None else '' for valor in _mget_em_lotes(redis_client, chaves)]
+    df = df.assign(Mensagens=mensagens)
+    colunas = [coluna for coluna in COLUNAS_DASHBOARD if coluna in df.columns]
+    return df[colunas + [coluna for coluna in df.columns if coluna not in colunas]]
+
+# Função para salvar o estado dos checks no Redis
+def salvar_checks_no_redis(redis_client, df):
+    if df.empty:
+        return
+    # Armazena como string ('True' ou 'False')
+    pares = [
+        (chave_telefone(redis_client, 'check:', phone_number), selecionado)
+        for phone_number, selecionado in zip(df['Número de WhatsApp'].astype(str), df['Selecionado'].astype(bool).astype(str))
+    ]
+    _mset_em_lotes(redis_client, pares)
+
+# Função para restaurar os checks do Redis
+def restaurar_checks_do_redis(redis_client, df):
+    if df.empty:
+        return
+    valores = pd.Series(
+        _mget_em_lotes(redis_client, [chave_telefone(redis_client, 'check:', phone_number) for phone_number in df['Número de WhatsApp'].astype(str)]),
+        index=df.index,
+    )
+    salvos = valores.notna()
+    df.loc[salvos, 'Selecionado'] = valores[salvos] == b'True'  # Converte string para booleano
+
+
+def marcar_satisfeitos(resumos):
+    return resumos.astype(object).map(lambda resumo: not TERMOS_SATISFACAO.isdisjoint(tokenizar(resumo))).astype(bool)
+
+
+# Soma as linhas do dashboard por dia, DDD e Status ('' quando ausentes). Usa a coluna
+# 'Satisfeito' do relatório quando presente; senão, procura os termos no resumo.
+def agregar_linhas(df):
+    if 'Satisfeito' in df.columns:
+        satisfeitos = df['Satisfeito'].astype(bool)
+    else:
+        satisfeitos = marcar_satisfeitos(df['Resumo da Conversa (IA) 🤖'])
+    linhas = pd.DataFrame({
+        'Dia': normalizar_datas(df['Data de Criação']).dt.strftime('%Y-%m-%d').fillna(''),
+        'DDD': df['DDD'].astype('string').fillna('').astype(str),
+        'Status': df['Status'].astype('string').fillna('').astype(str),
+        'conversas': 1,
+        'mensagens': pd.to_numeric(df['Nº User Messages'], errors='coerce').fillna(0).astype('int64'),
+        'satisfeitos': satisfeitos.astype('int64'),
+    }, index=df.index)
+    return linhas.groupby(['Dia', 'DDD', 'Status'], as_index=False)[METRICAS_ROLLUP].sum()
+
+
+def _gravar_rollups(pipe, agregados):
+    for linha in agregados.itertuples(index=False):
+        chave = PREFIXO_ROLLUP_DIA + linha.Dia if linha.Dia else CHAVE_ROLLUP_SEM_DATA
+        for metrica in METRICAS_ROLLUP:
+            valor = int(getattr(linha, metrica))
+            if valor:
+                pipe.hincrby(chave, f"{metrica}:{linha.DDD}:{linha.Status}", valor)
+    dias = set(agregados['Dia']) - {''}
+    if dias:
+        pipe.zadd(CHAVE_ROLLUP_DIAS, {dia: int(dia.replace('-', '')) for dia in dias})
+    pipe.incr(CHAVE_ROLLUP_VERSAO)
+
+
+# Aplica aos agregados a troca das linhas salvas pelas linhas de `df` (mesmos números).
+# Sem agregados no Redis ainda, não faz nada: eles são montados por inteiro na primeira leitura.
+def atualizar_rollups(redis_client, df, pipe):
+    if not redis_client.exists(CHAVE_ROLLUP_VERSAO):
+        return
+    anteriores = pd.DataFrame(list(carregar_linhas_do_redis(redis_client, df['Número de WhatsApp'].tolist()).values()))
+    partes = [agregar_linhas(df)]
+    if not anteriores.empty:
+        removidos = agregar_linhas(anteriores)
+        removidos[METRICAS_ROLLUP] = -removidos[METRICAS_ROLLUP]
+        partes.append(removidos)
+    diferenca = pd.concat(partes).groupby(['Dia', 'DDD', 'Status'], as_index=False)[METRICAS_ROLLUP].sum()
+    _gravar_rollups(pipe, diferenca[(diferenca[METRICAS_ROLLUP] != 0).any(axis=1)])
+
+
+# Recalcula os agregados a partir de todas as linhas salvas do dashboard
+@medir('reconstruir_rollups')
+def reconstruir_rollups(redis_client):
+    dias = [dia.decode('utf-8') for dia in redis_client.zrange(CHAVE_ROLLUP_DIAS, 0, -1)]
+    pipe = pipeline_transacao(redis_client)
+    # Um DEL por chave: no cluster, cada chave pode estar em um nó diferente
+    for chave in [CHAVE_ROLLUP_DIAS, CHAVE_ROLLUP_SEM_DATA, *[PREFIXO_ROLLUP_DIA + dia for dia in dias]]:
+        pipe.delete(chave)
+    linhas = pd.DataFrame(restaurar_dados_do_redis(redis_client))
+    if linhas.empty:
+        pipe.incr(CHAVE_ROLLUP_VERSAO)
+    else:
+        _gravar_rollups(pipe, agregar_linhas(linhas))
+    pipe.execute()
+
+
+def versao_rollups(redis_client):
+    versao = redis_client.get(CHAVE_ROLLUP_VERSAO)
+    return int(versao) if versao is not None else 0
+
+
+# Agregados dos dias entre `inicio` e `fim` (datas; None deixa o lado aberto). As linhas sem
+# data só entram quando não há limite. Custa um HGETALL por dia, independente do nº de conversas.
+def ler_rollups(redis_client, inicio=None, fim=None):
+    if not redis_client.exists(CHAVE_ROLLUP_VERSAO):
+        reconstruir_rollups(redis_client)
+    dias = redis_client.zrangebyscore(
+        CHAVE_ROLLUP_DIAS,
+        int(inicio.strftime('%Y%m%d')) if inicio is not None else '-inf',
+        int(fim.strftime('%Y%m%d')) if fim is not None else '+inf',
+    )
+    dias = [dia.decode('utf-8') for dia in dias]
+    chaves = [PREFIXO_ROLLUP_DIA + dia for dia in dias]
+    if inicio is None and fim is None:
+        dias.append('')
+        chaves.append(CHAVE_ROLLUP_SEM_DATA)
+    pipe = redis_client.pipeline(transaction=False)
+    for chave in chaves:
+        pipe.hgetall(chave)
+
+    valores = {}
+    for dia, campos in zip(dias, pipe.execute()):
+        for campo, valor in campos.items():
+            metrica, ddd, status = campo.decode('utf-8').split(':', 2)
+            valores.setdefault((dia, ddd, status), dict.fromkeys(METRICAS_ROLLUP, 0))[metrica] = int(valor)
+    agregados = pd.DataFrame(
+        [{'Dia': dia, 'DDD': ddd, 'Status': status, **metricas} for (dia, ddd, status), metricas in valores.items()],
+        columns=['Dia', 'DDD', 'Status'] + METRICAS_ROLLUP,
+    )
+    # Combinações cujas conversas mudaram de dia/status ficam zeradas no hash
+    return agregados[agregados['conversas'] > 0].reset_index(drop=True)
+
+
+# Aplica ao índice de busca a troca das linhas salvas pelas linhas de `df`. Linhas sem a
+# conversa (que não foi relida) mantêm os termos anteriores dela. Sem o índice no Redis
+# ainda, não faz nada: ele é montado por inteiro na primeira busca.
+def atualizar_indice_busca(redis_client, df, pipe):
+    if not redis_client.exists(CHAVE_INDICE_VERSAO):
+        return
+    phone_numbers = df['Número de WhatsApp'].astype(str).tolist()
+    chaves = [chave_telefone(redis_client, PREFIXO_TERMOS_BUSCA, phone_number) for phone_number in phone_numbers]
+    anteriores = [set(termos.decode('utf-8').split()) if termos else set() for termos in _mget_em_lotes(redis_client, chaves)]
+    novos = []
+    for linha, termos_anteriores in zip(df.to_dict('records'), anteriores):
+        termos = termos_da_linha(linha)
+        if not isinstance(linha.get('Mensagens'), str):
+            termos |= {termo for termo in termos_anteriores if termo.startswith('mensagens:')}
+        novos.append(termos)
+    atualizar_indice(pipe, phone_numbers, anteriores, novos)
+    _mset_em_lotes(redis_client, [(chave, ' '.join(sorted(termos))) for chave, termos in zip(chaves, novos)], pipe)
+
+
+# Monta o índice de busca a partir de todas as linhas salvas e das suas conversas
+@medir('reconstruir_indice_busca')
+def reconstruir_indice_busca(redis_client):
+    limpar_indice(redis_client)
+    linhas = restaurar_dados_do_redis(redis_client)
+    phone_numbers = [str(linha['Número de WhatsApp']) for linha in linhas]
+    mensagens = _mget_em_lotes(redis_client, [chave_telefone(redis_client, PREFIXO_MENSAGENS, phone_number) for phone_number in phone_numbers])
+    novos = [
+        termos_da_linha({**linha, 'Mensagens': texto.decode('utf-8') if texto is not None else ''})
+        for linha, texto in zip(linhas, mensagens)
+    ]
+    pipe = redis_client.pipeline(transaction=False)
+    atualizar_indice(pipe, phone_numbers, [set()] * len(phone_numbers), novos)
+    _mset_em_lotes(redis_client, [
+        (chave_telefone(redis_client, PREFIXO_TERMOS_BUSCA, phone_number), ' '.join(sorted(termos)))
+        for phone_number, termos in zip(phone_numbers, novos)
+    ], pipe)
+    pipe.execute()
+
+
+# Números dos leads encontrados pela busca do painel (busca.buscar)
+@medir('buscar_leads')
+def buscar_leads(redis_client, consulta, campos=None):
+    if not redis_client.exists(CHAVE_INDICE_VERSAO):
+        reconstruir_indice_busca(redis_client)
+    return buscar(redis_client, consulta, campos)
+
+
+# Ordem das colunas do painel
+COLUNAS_DASHBOARD = [
+    'Selecionado', 'Data de Criação', 'Nome do usuário', 'Status', 'Número de WhatsApp',
+    'Resumo da Conversa (IA) 🤖', 'Mensagens', 'Nº User Messages', 'Thread ID', 'Falar com Usuário', 'DDD',
+]
+
+
+# Linhas do painel indexadas pelo número normalizado. As atualizações são feitas por
+# número (inserindo ou mesclando campos) e o DataFrame só é montado no final.
+class RegistroLeads:
+    def __init__(self, linhas=()):
+        self._linhas = {}
+        for linha in linhas:
+            self._linhas[linha['Número de WhatsApp']] = dict(linha)
+
+    @classmethod
+    def de_dataframe(cls, df):
+        return cls(df.to_dict('records')) if not df.empty else cls()
+
+    def __contains__(self, phone_number):
+        return phone_number in self._linhas
+
+    def __len__(self):
+        return len(self._linhas)
+
+    def __iter__(self):
+        return iter(self._linhas)
+
+    def get(self, phone_number):
+        return self._linhas.get(phone_number)
+
+    # Atualiza os campos da linha do número, criando a linha se ela ainda não existir
+    def upsert(self, phone_number, campos):
+        linha = self._linhas.get(phone_number)
+        if linha is None:
+            linha = self._linhas[phone_number] = {'Selecionado': False, 'Número de WhatsApp': phone_number}
+        linha.update(campos)
+        return linha
+
+    # Monta o DataFrame com todas as linhas ou apenas com as dos números informados, nessa ordem.
+    # 'Data de Criação' sai sempre como datetime64, venha a linha do Redis (texto) ou de uma análise.
+    def para_dataframe(self, phone_numbers=None):
+        if phone_numbers is None:
+            linhas = list(self._linhas.values())
+        else:
+            linhas = [self._linhas[phone_number] for phone_number in phone_numbers if phone_number in self._linhas]
+        df = pd.DataFrame(linhas)
+        if df.empty:
+            return df
+        if 'Data de Criação' in df.columns:
+            df['Data de Criação'] = normalizar_datas(df['Data de Criação'])
+        colunas = [coluna for coluna in COLUNAS_DASHBOARD if coluna in df.columns]
+        return df[colunas + [coluna for coluna in df.columns if coluna not in colunas]]
+
+
+# Campos da linha do dashboard gerados a partir da conversa e da análise
+def montar_campos(normalized_phone_number, data_criacao, analise, mensagens_texto, user_message_count, thread_id, tamanho_conversa=0):
+    return {
+        'Data de Criação': data_criacao,
+        'Nome do usuário': analise['nome'],
+        'Status': analise['classificacao'],
+        # Remover quebras de linha no resumo para evitar múltiplas linhas no CSV
+        'Resumo da Conversa (IA) 🤖': ' '.join(analise['resumo'].splitlines()),
+        'Mensagens': mensagens_texto,
+        'Hash Mensagens': assinatura_mensagens(mensagens_texto),
+        # Nº de itens da lista da conversa na análise, para detectar mensagens novas com LLEN
+        'Tamanho Conversa': tamanho_conversa,
+        'Nº User Messages': user_message_count,
+        'Thread ID': thread_id,
+        # Gerar o link do WhatsApp Web para contato direto
+        'Falar com Usuário': f"https://wa.me/55{normalized_phone_number}",
+        # DDD são os 2 primeiros dígitos do número de WhatsApp
+        'DDD': normalized_phone_number[:2],
+    }
+
+
+# Linha do texto da conversa de uma mensagem (None para papéis que não entram no texto)
+def _linha_conversa(msg_obj):
+    role = msg_obj.get('role', '')
+    if role == "user":
+        return f"Usuário: {msg_obj.get('content', '')}"
+    if role == "assistant":
+        return f"Assistente: {msg_obj.get('content', '')}"
+    return None
+
+
+# Lê as conversas dos números e devolve as que precisam de análise (pendentes). Números sem
+# mudança ou sem conversa têm a linha atualizada direto no `registro`. Cada conversa guarda
+# as mensagens mais recentes que cabem em `orcamento_tokens` (o orçamento do prompt).
+def ler_conversas_pendentes(redis_client, phone_numbers, normalized_phone_numbers, registro, reanalisar=False, orcamento_tokens=ORCAMENTO_TOKENS_PADRAO):
+    inicio_leitura = time.perf_counter()
+    # threadId e tamanho das conversas de todos os números em duas idas ao Redis
+    thread_ids = [
+        thread_id.decode('utf-8') if thread_id else None
+        for thread_id in _mget_em_lotes(redis_client, [chave_telefone(redis_client, 'threadId:', phone) for phone in normalized_phone_numbers])
+    ]
+    pipe = redis_client.pipeline(transaction=False)
+    for normalized_phone_number, thread_id in zip(normalized_phone_numbers, thread_ids):
+        if thread_id:
+            pipe.llen(chave_telefone(redis_client, 'conversation:', normalized_phone_number, thread_id))
+    tamanhos = iter(pipe.execute())
+
+    # Conversas que cresceram (ou ainda sem linha): lê só a janela final e as mensagens novas
+    leituras = []
+    for item, normalized_phone_number, thread_id in zip(phone_numbers, normalized_phone_numbers, thread_ids):
+        # A data vem do createdAt mais recente do número (já calculado no scan)
+        data_criacao = timestamp_para_datetime(item['created_at']) if item.get('created_at') else None
+
+        # Linha do número já existente no dashboard, se houver
+        previous_row = registro.get(normalized_phone_number)
+
+        if thread_id:
+            tamanho = next(tamanhos)
+            # A conversa é uma lista só de inserções: mesmo thread e mesmo tamanho, nada mudou
+            tamanho_anterior = None
+            if previous_row is not None and previous_row.get('Thread ID') == thread_id and pd.notna(previous_row.get('Tamanho Conversa')):
+                tamanho_anterior = int(previous_row['Tamanho Conversa'])
+                if tamanho_anterior > tamanho:
+                    tamanho_anterior = None  # Lista encurtada: recontar do início
+            if not reanalisar and tamanho_anterior == tamanho:
+                continue
+            # Com o tamanho anterior, basta ler a janela final e as mensagens novas, somando os
+            # usuários novos à contagem salva; sem ele, a conversa é lida inteira uma vez. A janela
+            # começa pela estimativa do orçamento e é completada depois, se couber mais.
+            inicio = min(tamanho_anterior, max(tamanho - mensagens_estimadas_janela(orcamento_tokens), 0)) if tamanho_anterior is not None else 0
+            leituras.append({
+                'item': item,
+                'normalized_phone_number': normalized_phone_number,
+                'thread_id': thread_id,
+                'data_criacao': data_criacao,
+                'previous_row': previous_row,
+                'inicio': inicio,
+                'tamanho_anterior': tamanho_anterior or 0,
+                'contagem_anterior': int(previous_row.get('Nº User Messages') or 0) if tamanho_anterior is not None else 0,
+                # Base do resumo incremental: o resumo salvo cobre as mensagens até o tamanho anterior
+                'resumo_anterior': previous_row.get('Resumo da Conversa (IA) 🤖') if tamanho_anterior is not None and not reanalisar else None,
+            })
+        elif previous_row is None:
+            # Sem conversa registrada: nada a analisar
+            analise = {
+                'resumo': "Sem resumo disponível",
+                'nome': "Nome não fornecido",
+                'classificacao': "Não classificado",
+            }
+            registro.upsert(normalized_phone_number, montar_campos(normalized_phone_number, data_criacao, analise, '', 0, ''))
+
+    pipe = redis_client.pipeline(transaction=False)
+    for leitura in leituras:
+        leitura['chave'] = chave_telefone(redis_client, 'conversation:', leitura['normalized_phone_number'], leitura['thread_id'])
+        pipe.lrange(leitura['chave'], leitura['inicio'], -1)
+    lidas = [[json.loads(msg) for msg in messages] for messages in pipe.execute()]
+
+    # Conversas cujo trecho lido ainda cabe inteiro no orçamento leem as mensagens anteriores
+    # (dobrando o trecho a cada ida ao Redis) até preencher a janela ou chegar ao início
+    def janela_incompleta(posicao):
+        linhas = [linha for linha in map(_linha_conversa, lidas[posicao]) if linha is not None]
+        return leituras[posicao]['inicio'] > 0 and len(ultimas_linhas_no_orcamento(linhas, orcamento_tokens)) == len(linhas)
+
+    incompletas = [posicao for posicao in range(len(leituras)) if janela_incompleta(posicao)]
+    while incompletas:
+        pipe = redis_client.pipeline(transaction=False)
+        for posicao in incompletas:
+            leitura = leituras[posicao]
+            fim = leitura['inicio'] - 1
+            leitura['inicio'] = max(leitura['inicio'] - max(len(lidas[posicao]), 1), 0)
+            pipe.lrange(leitura['chave'], leitura['inicio'], fim)
+        for posicao, anteriores in zip(incompletas, pipe.execute()):
+            lidas[posicao] = [json.loads(msg) for msg in anteriores] + lidas[posicao]
+        incompletas = [posicao for posicao in incompletas if janela_incompleta(posicao)]
+
+    pendentes = []
+    for leitura, messages in zip(leituras, lidas):
+        normalized_phone_number = leitura['normalized_phone_number']
+        previous_row = leitura['previous_row']
+        data_criacao = leitura['data_criacao']
+
+        # Processar mensagens para gerar o resumo e outras informações
+        mensagens = []
+        mensagens_novas = []
+        timestamps_mensagens = []
+        user_message_count = leitura['contagem_anterior']
+        for posicao, msg_obj in enumerate(messages, leitura['inicio']):
+            role = msg_obj.get('role', '')
+            timestamp_mensagem = msg_obj.get('createdAt') or msg_obj.get('timestamp')
+            if isinstance(timestamp_mensagem, (int, float)):
+                timestamps_mensagens.append(timestamp_mensagem)
+            # Mensagens anteriores ao tamanho salvo já estão na contagem
+            if role == "user" and posicao >= leitura['tamanho_anterior']:
+                user_message_count += 1
+            linha = _linha_conversa(msg_obj)
+            if linha is None:
+                continue
+            mensagens.append(linha)
+            if posicao >= leitura['tamanho_anterior']:
+                mensagens_novas.append(linha)
+
+        mensagens_texto = '\n'.join(ultimas_linhas_no_orcamento(mensagens, orcamento_tokens))
+        tamanho_conversa = leitura['inicio'] + len(messages)
+
+        # Mesma conversa e mesmas configurações: manter os dados antigos. Qualquer mudança
+        # no texto (inclusive mensagens só do assistente) passa pela análise, e o cache
+        # evita novas chamadas quando a combinação já foi analisada antes.
+        if not reanalisar and previous_row is not None and previous_row.get('Hash Mensagens') == assinatura_mensagens(mensagens_texto):
+            registro.upsert(normalized_phone_number, {'Tamanho Conversa': tamanho_conversa, 'Nº User Messages': user_message_count})
+            continue
+
+        # Sem createdAt nos metadados, usa o timestamp da última mensagem da conversa ou a data já salva
+        if data_criacao is None and timestamps_mensagens:
+            data_criacao = timestamp_para_datetime(max(timestamps_mensagens))
+        if data_criacao is None and previous_row is not None:
+            data_criacao = previous_row.get('Data de Criação')
+
+        # A análise é feita depois, em paralelo
+        pendentes.append({
+            'phone_number': leitura['item']['phone_number'],
+            'normalized_phone_number': normalized_phone_number,
+            'data_criacao': data_criacao,
+            'mensagens_texto': mensagens_texto,
+            'user_message_count': user_message_count,
+            'thread_id': leitura['thread_id'],
+            'tamanho_conversa': tamanho_conversa,
+            'resumo_anterior': leitura['resumo_anterior'],
+            'mensagens_novas': '\n'.join(mensagens_novas),
+        })
+
+    METRICAS.registrar_etapa('ler_conversas', time.perf_counter() - inicio_leitura)
+    return pendentes
+
+
+# Grava a análise de uma conversa pendente em analise:* e atualiza a linha no `registro`
+def registrar_analise(redis_client, registro, pendente, analise):
+    # Mantém a chave analise:data:{phone}, agora preenchida a partir do createdAt
+    if pendente['data_criacao']:
+        analise['data'] = pendente['data_criacao'].strftime(FORMATO_DATA)
+    for analise_tipo, resultado in analise.items():
+        salvar_analise_no_redis(redis_client, pendente['phone_number'], analise_tipo, resultado)
+    registro.upsert(pendente['normalized_phone_number'], montar_campos(
+        pendente['normalized_phone_number'],
+        pendente['data_criacao'],
+        analise,
+        pendente['mensagens_texto'],
+        pendente['user_message_count'],
+        pendente['thread_id'],
+        pendente['tamanho_conversa'],
+    ))
+
+
+# Processa os números informados: lê as conversas, reaproveita as linhas cujas conversas não
+# mudaram e gera as análises das demais em paralelo. As linhas são atualizadas em `registro`
+# (por padrão, carregado do Redis só com os números visitados) e a função devolve um
+# DataFrame com as linhas dos números visitados. `reanalisar` ignora as linhas anteriores
+# (configurações da IA mudaram).
+def processar_telefones(redis_client, analisador, phone_numbers, reanalisar=False, max_concorrencia=CONCORRENCIA_PADRAO, registro=None):
+    normalized_phone_numbers = normalizar_telefones(pd.Series([item['phone_number'] for item in phone_numbers], dtype=object)).tolist()
+    if registro is None:
+        registro = RegistroLeads(carregar_linhas_do_redis(redis_client, normalized_phone_numbers).values())
+    pendentes = ler_conversas_pendentes(redis_client, phone_numbers, normalized_phone_numbers, registro, reanalisar, analisador.orcamento_tokens)
+
+    # Gerar as análises das conversas alteradas em paralelo, respeitando os limites da API
+    inicio_analises = time.perf_counter()
+    concluidas = executar_em_paralelo(
+        lambda pendente: analisador.analisar_conversa(
+            pendente['mensagens_texto'], pendente['phone_number'], pendente['resumo_anterior'], pendente['mensagens_novas'],
+        ),
+        pendentes,
+        max_concorrencia=max_concorrencia,
+    )
+    for pendente, analise in concluidas:
+        registrar_analise(redis_client, registro, pendente, analise)
+    if pendentes:
+        METRICAS.registrar_etapa('analises', time.perf_counter() - inicio_analises)
+
+    # O DataFrame é montado uma única vez, com as linhas dos números visitados
+    return registro.para_dataframe(list(dict.fromkeys(normalized_phone_numbers)))
+
+
+# Atualização em fluxo (leitura -> análise -> gravação), com fila limitada entre as etapas:
+# uma thread lê as conversas por bloco de números enquanto as análises rodam no pool, e cada
+# bloco é gravado no Redis assim que todas as suas análises terminam. Devolve, na ordem dos
+# números, (DataFrame das linhas do bloco, conversas analisadas no bloco). As linhas ficam em
+# `registro` sem a conversa completa, que só é mantida até o bloco ser gravado.
+# Só a thread que consome os blocos altera `registro`: a leitura trabalha sobre uma cópia das
+# linhas do bloco, tirada sob `trava`, e as alterações dela são aplicadas junto com as análises.
+def processar_em_fluxo(redis_client, analisador, phone_numbers, registro, reanalisar=False, max_concorrencia=CONCORRENCIA_PADRAO, tamanho_bloco=TAMANHO_BLOCO_FLUXO):
+    blocos = queue.Queue(maxsize=BLOCOS_EM_ESPERA)
+    parar = threading.Event()
+    trava = threading.Lock()
+
+    # Etapa de leitura; a fila cheia faz a thread esperar pelas análises (backpressure)
+    def ler_blocos():
+        try:
+            for i in range(0, len(phone_numbers), tamanho_bloco):
+                itens = phone_numbers[i:i + tamanho_bloco]
+                normalizados = normalizar_telefones(pd.Series([item['phone_number'] for item in itens], dtype=object)).tolist()
+                telefones = list(dict.fromkeys(normalizados))
+                with trava:
+                    linhas = RegistroLeads(registro.get(phone_number) for phone_number in telefones if phone_number in registro)
+                bloco = {
+                    'telefones': telefones,
+                    'linhas': linhas,
+                    'pendentes': ler_conversas_pendentes(redis_client, itens, normalizados, linhas, reanalisar, analisador.orcamento_tokens),
+                }
+                if not _entregar(blocos, bloco, parar):
+                    return
+        except Exception as erro:
+            _entregar(blocos, erro, parar)
+        else:
+            _entregar(blocos, None, parar)
+
+    def analisar(pendente):
+        return analisador.analisar_conversa(
+            pendente['mensagens_texto'], pendente['phone_number'], pendente['resumo_anterior'], pendente['mensagens_novas'],
+        )
+
+    leitor = threading.Thread(target=ler_blocos, daemon=True)
+    leitor.start()
+    inicio_analises = time.perf_counter()
+    # Novos blocos só entram no pool enquanto houver poucas análises em andamento
+    limite_em_andamento = max(1, max_concorrencia) * 2
+    em_andamento = deque()
+    fim = False
+    with ThreadPoolExecutor(max_workers=max(1, max_concorrencia)) as executor:
+        try:
+            while True:
+                while not fim and sum(len(bloco['futuros']) for bloco in em_andamento) < limite_em_andamento:
+                    bloco = blocos.get()
+                    if bloco is None:
+                        fim = True
+                    elif isinstance(bloco, Exception):
+                        raise bloco
+                    else:
+                        bloco['futuros'] = [executor.submit(analisar, pendente) for pendente in bloco['pendentes']]
+                        em_andamento.append(bloco)
+                if not em_andamento:
+                    break
+
+                # Etapa de gravação, bloco a bloco
+                bloco = em_andamento.popleft()
+                analises = [futuro.result() for futuro in bloco['futuros']]
+                with trava:
+                    for phone_number in bloco['linhas']:
+                        registro.upsert(phone_number, bloco['linhas'].get(phone_number))
+                    for pendente, analise in zip(bloco['pendentes'], analises):
+                        registrar_analise(redis_client, registro, pendente, analise)
+                    df_bloco = registro.para_dataframe(bloco['telefones'])
+                salvar_dados_no_redis(redis_client, df_bloco)
+                with trava:
+                    for phone_number in bloco['telefones']:
+                        if phone_number in registro:
+                            registro.get(phone_number).pop('Mensagens', None)
+                yield df_bloco.drop(columns='Mensagens', errors='ignore'), len(bloco['pendentes'])
+        finally:
+            # Interrompida (erro ou consumidor parou): a leitura para e as análises na fila são descartadas
+            parar.set()
+            for bloco in em_andamento:
+                for futuro in bloco['futuros']:
+                    futuro.cancel()
+    METRICAS.registrar_etapa('analises', time.perf_counter() - inicio_analises)
+
+
+# Coloca `item` na fila, desistindo se o consumidor parou
+def _entregar(fila, item, parar):
+    while not parar.is_set():
+        try:
+            fila.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+# Coloca os números na fila do worker e reinicia o progresso exibido no painel
+def enfileirar_analises(redis_client, phone_numbers, reanalisar=False):
+    # Uma nova rodada começa do zero; se o worker ainda estiver processando, soma ao total
+    if progresso_analises(redis_client)['status'] == 'concluido':
+        redis_client.delete(PROGRESSO_ANALISE)
+    pipe = pipeline_transacao(redis_client)
+    pipe.hset(PROGRESSO_ANALISE, mapping={'status': 'na_fila', 'iniciado_em': int(time.time())})
+    pipe.hincrby(PROGRESSO_ANALISE, 'total', len(phone_numbers))
+    for i in range(0, len(phone_numbers), TAMANHO_LOTE_SCAN):
+        pipe.rpush(FILA_ANALISE, *[
+            json.dumps({**item, 'reanalisar': reanalisar})
+            for item in phone_numbers[i:i + TAMANHO_LOTE_SCAN]
+        ])
+    pipe.execute()
+
+def progresso_analises(redis_client):
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hgetall(PROGRESSO_ANALISE)
+    pipe.llen(FILA_ANALISE)
+    pipe.llen(FILA_ANALISE_PROCESSANDO)
+    progresso, na_fila, processando = pipe.execute()
+    progresso = {chave.decode('utf-8'): valor.decode('utf-8') for chave, valor in progresso.items()}
+    return {
+        'status': progresso.get('status', 'concluido'),
+        'total': int(progresso.get('total', 0)),
+        'concluidos': int(progresso.get('concluidos', 0)),
+        'na_fila': na_fila,
+        'processando': processando,
+    }
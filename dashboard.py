@@ -1,153 +1,147 @@
-import json 
 from dotenv import load_dotenv 
-import redis 
-import pandas as pd 
 import streamlit as st 
-import plotly.express as px 
-from openai import OpenAI 
-from datetime import datetime, timedelta
-import pickle
-from pathlib import Path
+from configuracao import (
+    CONCORRENCIA_PADRAO, RPM_PADRAO, TPM_PADRAO, MODO_ANALISE_UNICA, MODOS_ANALISE, ORCAMENTO_TOKENS_PADRAO, RESUMO_INCREMENTAL_PADRAO,
+    PASTA_CONFIGURACOES, API_KEY_PATH, REDIS_URL_PATH, REDIS_PASSWORD_PATH,
+    AI_NAME_PATH, AI_OBJECTIVES_PATH, AI_STATUS_PATH,
+    LLM_CONCORRENCIA_PATH, LLM_RPM_PATH, LLM_TPM_PATH, LLM_MODO_ANALISE_PATH, LLM_ORCAMENTO_TOKENS_PATH, LLM_RESUMO_INCREMENTAL_PATH, MODO_EXECUCAO_PATH,
+    salva_chave, montar_url_redis, versao_configuracoes,
+)
+from configuracao import le_chave as ler_arquivo_chave
+from metricas import CHAVE_METRICAS_WORKER, METRICAS, resumo_para_prometheus
+from datetime import datetime
+import json
+import time
+
+# As dependências pesadas (pandas, plotly, openai, analise e os módulos de dados) são importadas
+# dentro de cada página e os clientes são criados na primeira página que precisa deles,
+# para que cada página pague só pelo que usa (python -m perfil_inicializacao mede isso).
 
 # Definir o layout expandido da página
 st.set_page_config(layout="wide")
 load_dotenv()
 
 # Configuração de pastas para armazenamento da chave
-PASTA_CONFIGURACOES = Path('configuracoes')
 PASTA_CONFIGURACOES.mkdir(exist_ok=True)
 
-# Funções de leitura e escrita da chave API
-def salva_chave(caminho, chave):
-    with open(caminho, 'wb') as f:
-        pickle.dump(chave, f)
-
-def le_chave(caminho):
-    if caminho.exists() and caminho.stat().st_size > 0:
-        with open(caminho, 'rb') as f:
-            try:
-                return pickle.load(f)
-            except (EOFError, pickle.UnpicklingError):
-                st.warning(f"O arquivo de chave em {caminho} está corrompido ou vazio. Salve novamente a chave.")
-                # Limpa o arquivo corrompido
-                caminho.write_bytes(b'')
-                return ''
-    else:
-        return ''
-
+# Modos de execução da atualização: no próprio painel ou pelo worker em segundo plano
+MODO_EXECUCAO_PAINEL = 'painel'
+MODO_EXECUCAO_WORKER = 'worker'
+MODOS_EXECUCAO = {
+    MODO_EXECUCAO_PAINEL: 'No painel (aguarda o fim da atualização)',
+    MODO_EXECUCAO_WORKER: 'Worker em segundo plano (python -m worker)',
+}
 
+# Linhas enviadas ao navegador por página da tabela do painel
+TAMANHO_PAGINA = 50
 
-# Caminhos dos arquivos de configuração
-API_KEY_PATH = PASTA_CONFIGURACOES / 'OPENAI_API_KEY'
-REDIS_URL_PATH = PASTA_CONFIGURACOES / 'REDIS_URL'
-REDIS_PASSWORD_PATH = PASTA_CONFIGURACOES / 'REDIS_PASSWORD'
-
-AI_NAME_PATH = PASTA_CONFIGURACOES / 'AI_NAME'
-AI_OBJECTIVES_PATH = PASTA_CONFIGURACOES / 'AI_OBJECTIVES'
-
-AI_STATUS_PATH = PASTA_CONFIGURACOES / 'STATUS'
+# Leitura das chaves avisando no painel quando o arquivo está corrompido
+def le_chave(caminho):
+    return ler_arquivo_chave(caminho, avisar=st.warning)
+
+# Configurações salvas: chave do session_state, arquivo e valor padrão
+CONFIGURACOES_SALVAS = {
+    'api_key': (API_KEY_PATH, ''),
+    'redis_url': (REDIS_URL_PATH, ''),
+    'redis_password': (REDIS_PASSWORD_PATH, ''),
+    'ai_name_info': (AI_NAME_PATH, ''),
+    'ai_objectives_info': (AI_OBJECTIVES_PATH, ''),
+    'ai_status_info': (AI_STATUS_PATH, ''),
+    'llm_concorrencia': (LLM_CONCORRENCIA_PATH, CONCORRENCIA_PADRAO),
+    'llm_rpm': (LLM_RPM_PATH, RPM_PADRAO),
+    'llm_tpm': (LLM_TPM_PATH, TPM_PADRAO),
+    'llm_modo_analise': (LLM_MODO_ANALISE_PATH, MODO_ANALISE_UNICA),
+    'llm_orcamento_tokens': (LLM_ORCAMENTO_TOKENS_PATH, ORCAMENTO_TOKENS_PADRAO),
+    'llm_resumo_incremental': (LLM_RESUMO_INCREMENTAL_PATH, RESUMO_INCREMENTAL_PADRAO),
+    'modo_execucao': (MODO_EXECUCAO_PATH, MODO_EXECUCAO_PAINEL),
+}
+
+# Arquivos de configuração lidos uma vez por versão e compartilhados pelas novas sessões.
+# Só o arquivo ausente ou vazio ('') usa o padrão, para que False seja mantido.
+@st.cache_data(max_entries=4, show_spinner=False)
+def ler_configuracoes_salvas(versao):
+    configuracoes = {}
+    for nome, (caminho, padrao) in CONFIGURACOES_SALVAS.items():
+        valor = le_chave(caminho)
+        configuracoes[nome] = padrao if valor == '' else valor
+    return configuracoes
 
 # Lógica para salvar e ler as chaves de configuração
-if 'api_key' not in st.session_state:
-    st.session_state['api_key'] = le_chave(API_KEY_PATH)
-if 'redis_url' not in st.session_state:
-    st.session_state['redis_url'] = le_chave(REDIS_URL_PATH)
-if 'redis_password' not in st.session_state:
-    st.session_state['redis_password'] = le_chave(REDIS_PASSWORD_PATH)
-if 'ai_name_info' not in st.session_state:
-    st.session_state['ai_name_info'] = le_chave(AI_NAME_PATH)
-if 'ai_objectives_info' not in st.session_state:
-    st.session_state['ai_objectives_info'] = le_chave(AI_OBJECTIVES_PATH)
-if 'ai_status_info' not in st.session_state:
-    st.session_state['ai_status_info'] = le_chave(AI_STATUS_PATH)
-
-# Inicializar o cliente OpenAI usando a chave salva
-api_key = st.session_state['api_key']
-
-# Inicializar o cliente OpenAI somente se a chave estiver disponível
-if st.session_state['api_key']:
+if any(nome not in st.session_state for nome in CONFIGURACOES_SALVAS):
+    caminhos = [caminho for caminho, _ in CONFIGURACOES_SALVAS.values()]
+    for nome, valor in ler_configuracoes_salvas(versao_configuracoes(caminhos)).items():
+        st.session_state.setdefault(nome, valor)
+
+# Fecha as conexões do cliente substituído (importa clientes só quando há o que fechar)
+def fechar_cliente(cliente):
+    from clientes import fechar_cliente as fechar
+    fechar(cliente)
+
+# Clientes compartilhados por todas as sessões e execuções do processo. São recriados
+# somente quando as credenciais mudam; o cliente substituído tem as conexões fechadas.
+@st.cache_resource(max_entries=4, show_spinner=False, on_release=fechar_cliente)
+def obter_cliente_openai(api_key):
+    from clientes import criar_cliente_openai
+    return criar_cliente_openai(api_key)
+
+@st.cache_resource(max_entries=4, show_spinner=False, on_release=fechar_cliente)
+def obter_cliente_redis(redis_url, redis_password):
+    from clientes import criar_cliente_redis
+    redis_client = criar_cliente_redis(montar_url_redis(redis_url, redis_password))
+    # O PING é feito só na criação do pool; depois, as conexões paradas são verificadas pelo pool
+    redis_client.ping()
+    return redis_client
+
+# Cliente OpenAI, criado somente se a chave estiver disponível (None sem ela)
+def conectar_openai():
+    if not st.session_state['api_key']:
+        st.warning("A chave da API OpenAI não foi fornecida. Vá para 'Configurações' para inserir sua chave.")
+        return None
     try:
-        client = OpenAI(api_key=st.session_state['api_key'])
+        client = obter_cliente_openai(st.session_state['api_key'])
         st.toast("Cliente OpenAI inicializado com sucesso.", icon="✅")
+        return client
     except Exception as e:
         st.error(f"Erro ao inicializar o cliente OpenAI: {e}")
-else:
-    st.warning("A chave da API OpenAI não foi fornecida. Vá para 'Configurações' para inserir sua chave.")
+        return None
 
-# Conectar ao Redis somente se as variáveis estiverem preenchidas
-if st.session_state['redis_url'] and st.session_state['redis_password']:
+# Conectar ao Redis somente se as variáveis estiverem preenchidas (None sem elas)
+def conectar_redis():
+    if not (st.session_state['redis_url'] and st.session_state['redis_password']):
+        st.warning("As credenciais do Redis estão incompletas. Por favor, preencha os campos de URL e senha do Redis na seção de configurações.")
+        return None
     try:
-        redis_client = redis.Redis.from_url(
-            f'redis://default:{st.session_state["redis_password"]}@{st.session_state["redis_url"]}'
-        )
-        redis_client.ping()
+        redis_client = obter_cliente_redis(st.session_state['redis_url'], st.session_state['redis_password'])
         st.toast("Conexão com Redis estabelecida com sucesso.", icon="✅")
+        return redis_client
     except Exception as e:
         st.error(f"Erro ao conectar ao Redis: {e}")
         st.stop()
-else:
-    st.warning("As credenciais do Redis estão incompletas. Por favor, preencha os campos de URL e senha do Redis na seção de configurações.")
-
 
-
-# Conectar AI_NAME E AI_OBJECTIVES somente se as variáveis estiverem preenchidas
-if st.session_state['ai_name_info'] and st.session_state['ai_objectives_info'] and st.session_state['ai_status_info']:
-    try:
-        ai_name = st.session_state["ai_name_info"]
-        ai_objectives = st.session_state["ai_objectives_info"]
-        ai_status = st.session_state["ai_status_info"]
+# Conferir AI_NAME, AI_OBJECTIVES e AI_STATUS, usados nas análises do painel
+def verificar_informacoes_ia():
+    if st.session_state['ai_name_info'] and st.session_state['ai_objectives_info'] and st.session_state['ai_status_info']:
         st.toast("Informações sobre as IAs configuradas com sucesso.", icon="✅")
-    except Exception as e:
-        st.error(f"Erro ao definir informações das IAs: {e}")
-        st.stop()
-else:
-    st.warning("As informações sobre as IAs estão incompletas. Por favor, verifique as informações na seção de configurações.")
-
-
+    else:
+        st.warning("As informações sobre as IAs estão incompletas. Por favor, verifique as informações na seção de configurações.")
 
 
 
 
 
 
-# Funções para salvar e restaurar análises individuais no Redis
-def salvar_analise_no_redis(redis_client, phone_number, analise_tipo, resultado):
-    redis_client.set(f"analise:{analise_tipo}:{phone_number}", resultado)
 
-def restaurar_analise_do_redis(redis_client, phone_number, analise_tipo):
-    resultado = redis_client.get(f"analise:{analise_tipo}:{phone_number}")
-    if resultado:
-        return resultado.decode('utf-8')
-    else:
-        return None
 
-# Função para obter todos os números históricos
-def get_historic_phone_numbers(_redis_client):
-    phone_numbers_with_timestamps = {}
-    cursor = '0'
-
-    # Carregar todos os números do Redis
-    while True:
-        cursor, keys = _redis_client.scan(cursor=cursor, match='message:*', count=1000)
-        for key in keys:
-            message_data = _redis_client.hgetall(key)
-            if b'phoneNumber' in message_data and b'createdAt' in message_data:
-                phone_number = message_data[b'phoneNumber'].decode('utf-8')
-                created_at = int(message_data[b'createdAt'].decode('utf-8'))
-                if phone_number not in phone_numbers_with_timestamps or created_at > phone_numbers_with_timestamps[phone_number]:
-                    phone_numbers_with_timestamps[phone_number] = created_at
-        if cursor == 0:
-            break
-
-    # Ordenar e retornar todos os históricos
-    sorted_phone_numbers = sorted(phone_numbers_with_timestamps.items(), key=lambda x: x[1], reverse=True)
-    historic_phone_numbers = [{'phone_number': phone, 'created_at': timestamp} for phone, timestamp in sorted_phone_numbers]
-    return historic_phone_numbers
+# Limitador compartilhado por todas as sessões do processo, já que o limite da API é por chave
+@st.cache_resource
+def obter_limitador_llm(rpm, tpm):
+    from analise import LimitadorTaxa
+    return LimitadorTaxa(rpm=rpm, tpm=tpm)
 
 # Adicionar um seletor de período à barra lateral
 with st.sidebar:
     st.header("Navegação")
-    pagina_selecionada = st.selectbox("Escolha a página", ["Painel de Mensagem", "Dashboard BI", "Configurações"])
+    pagina_selecionada = st.selectbox("Escolha a página", ["Painel de Mensagem", "Dashboard BI", "Configurações", "Diagnóstico"], key='pagina')
 
 
 
@@ -187,6 +181,42 @@ def pagina_configuracoes():
     
     ai_status_input = st.text_input("• Quais status sua IA poderá usar para classificar o lead? (Inclua o status e a descrição dele. Exemplo: Use 'Lead quente' quando o usuário demostrar interesse no produto.)", value=st.session_state['ai_status_info'])
 
+    # Espaço entre os campos
+    st.markdown("<div style='margin-bottom: 40px;'></div>", unsafe_allow_html=True)
+
+    st.markdown("<span style='color: #03fcf8; font-weight: bold;'>LIMITES DA API OPENAI</span>", unsafe_allow_html=True)
+
+    llm_concorrencia_input = st.number_input("• Número máximo de análises simultâneas:", min_value=1, max_value=64, value=int(st.session_state['llm_concorrencia']))
+
+    llm_rpm_input = st.number_input("• Limite de requisições por minuto (RPM) da sua conta:", min_value=1, value=int(st.session_state['llm_rpm']))
+
+    llm_tpm_input = st.number_input("• Limite de tokens por minuto (TPM) da sua conta:", min_value=1000, value=int(st.session_state['llm_tpm']))
+
+    llm_orcamento_tokens_input = st.number_input(
+        "• Máximo de tokens da conversa enviados em cada análise (as mensagens mais recentes que couberem):",
+        min_value=200, max_value=32000, step=100, value=int(st.session_state['llm_orcamento_tokens']),
+    )
+
+    llm_resumo_incremental_input = st.checkbox(
+        "• Resumo incremental (envia ao modelo só o resumo anterior e as mensagens novas de cada conversa)",
+        value=bool(st.session_state['llm_resumo_incremental']),
+    )
+
+    modos = list(MODOS_ANALISE)
+    llm_modo_analise_input = st.selectbox(
+        "• Modo de análise das conversas:",
+        modos,
+        index=modos.index(st.session_state['llm_modo_analise']) if st.session_state['llm_modo_analise'] in modos else 0,
+        format_func=MODOS_ANALISE.get,
+    )
+
+    modos_execucao = list(MODOS_EXECUCAO)
+    modo_execucao_input = st.selectbox(
+        "• Onde executar a atualização do painel:",
+        modos_execucao,
+        index=modos_execucao.index(st.session_state['modo_execucao']) if st.session_state['modo_execucao'] in modos_execucao else 0,
+        format_func=MODOS_EXECUCAO.get,
+    )
 
 
     # Botão para salvar as configurações
@@ -205,6 +235,20 @@ def pagina_configuracoes():
         st.session_state['ai_status_info'] = ai_status_input
         salva_chave(AI_STATUS_PATH, ai_status_input)
 
+        st.session_state['llm_concorrencia'] = int(llm_concorrencia_input)
+        salva_chave(LLM_CONCORRENCIA_PATH, int(llm_concorrencia_input))
+        st.session_state['llm_rpm'] = int(llm_rpm_input)
+        salva_chave(LLM_RPM_PATH, int(llm_rpm_input))
+        st.session_state['llm_tpm'] = int(llm_tpm_input)
+        salva_chave(LLM_TPM_PATH, int(llm_tpm_input))
+        st.session_state['llm_orcamento_tokens'] = int(llm_orcamento_tokens_input)
+        salva_chave(LLM_ORCAMENTO_TOKENS_PATH, int(llm_orcamento_tokens_input))
+        st.session_state['llm_resumo_incremental'] = llm_resumo_incremental_input
+        salva_chave(LLM_RESUMO_INCREMENTAL_PATH, llm_resumo_incremental_input)
+        st.session_state['llm_modo_analise'] = llm_modo_analise_input
+        salva_chave(LLM_MODO_ANALISE_PATH, llm_modo_analise_input)
+        st.session_state['modo_execucao'] = modo_execucao_input
+        salva_chave(MODO_EXECUCAO_PATH, modo_execucao_input)
 
 
         # Salvar as configurações do Redis
@@ -219,161 +263,163 @@ def pagina_configuracoes():
 
 
 
+# Tabelas da página Diagnóstico a partir de um resumo de métricas (painel ou worker)
+def exibir_metricas(resumo):
+    import pandas as pd
+
+    st.caption(f"Desde {datetime.fromtimestamp(resumo['iniciado_em']):%d/%m/%y %H:%M:%S}")
+
+    st.markdown("<span style='color: #03fcf8; font-weight: bold;'>ETAPAS</span>", unsafe_allow_html=True)
+    if resumo['etapas']:
+        etapas = pd.DataFrame.from_dict(resumo['etapas'], orient='index')
+        etapas['media'] = etapas['segundos'] / etapas['execucoes']
+        st.dataframe(
+            etapas[['execucoes', 'segundos', 'media', 'ultima', 'maxima']].rename(columns={
+                'execucoes': 'Execuções', 'segundos': 'Total (s)', 'media': 'Média (s)', 'ultima': 'Última (s)', 'maxima': 'Máxima (s)',
+            }).sort_values('Total (s)', ascending=False)
+        )
+    else:
+        st.write("Nenhuma etapa registrada.")
+
+    st.markdown("<span style='color: #03fcf8; font-weight: bold;'>CHAMADAS AO MODELO</span>", unsafe_allow_html=True)
+    if resumo['llm']:
+        llm = pd.DataFrame.from_dict(resumo['llm'], orient='index')
+        llm['latencia_media'] = llm['segundos'] / llm['chamadas']
+        st.dataframe(llm[['chamadas', 'erros', 'latencia_media', 'prompt_tokens', 'completion_tokens']].rename(columns={
+            'chamadas': 'Chamadas', 'erros': 'Erros', 'latencia_media': 'Latência média (s)',
+            'prompt_tokens': 'Tokens de entrada', 'completion_tokens': 'Tokens de saída',
+        }))
+    else:
+        st.write("Nenhuma chamada registrada.")
+
+    st.markdown("<span style='color: #03fcf8; font-weight: bold;'>TOKENS DA CONVERSA POR PROMPT</span>", unsafe_allow_html=True)
+    if resumo.get('janelas'):
+        janelas = pd.DataFrame.from_dict(resumo['janelas'], orient='index')
+        janelas['media'] = janelas['tokens'] / janelas['prompts']
+        st.dataframe(janelas[['prompts', 'media', 'maximo', 'cortadas']].rename(columns={
+            'prompts': 'Prompts', 'media': 'Média de tokens', 'maximo': 'Máximo de tokens', 'cortadas': 'Mensagens cortadas',
+        }))
+    else:
+        st.write("Nenhum prompt registrado.")
+
+    st.markdown("<span style='color: #03fcf8; font-weight: bold;'>REDIS</span>", unsafe_allow_html=True)
+    comandos = resumo['redis']['comandos']
+    st.write(f"{resumo['redis']['idas']} idas ao Redis, {sum(comandos.values())} comandos.")
+    if comandos:
+        st.dataframe(pd.Series(comandos, name='Comandos').sort_values(ascending=False))
+
+    st.markdown("<span style='color: #03fcf8; font-weight: bold;'>CACHES</span>", unsafe_allow_html=True)
+    for nome, cache in resumo['cache'].items():
+        st.write(f"{nome}: {cache['hits']} acertos, {cache['misses']} falhas ({cache['taxa_acerto']:.0%}).")
+
+# Função para a página de diagnóstico
+def pagina_diagnostico():
+    st.markdown("<h1 style='color: #03fcf8;'>Diagnóstico</h1>", unsafe_allow_html=True)
+    st.write("Tempo de cada etapa da atualização, chamadas ao modelo, comandos enviados ao Redis e caches.")
+
+    redis_client = conectar_redis()
+    resumo = METRICAS.resumo()
+    resumo_worker = None
+    if redis_client is not None:
+        dados_worker = redis_client.get(CHAVE_METRICAS_WORKER)
+        resumo_worker = json.loads(dados_worker) if dados_worker else None
+
+    aba_painel, aba_worker = st.tabs(["Painel", "Worker"])
+    with aba_painel:
+        exibir_metricas(resumo)
+        if redis_client is not None:
+            # Acumulado de todas as sessões e do worker, guardado no Redis
+            from analise import CacheAnalise
+            estatisticas_cache = CacheAnalise(redis_client).estatisticas()
+            st.write(
+                f"Cache de análises (total): {estatisticas_cache['hits']} acertos, {estatisticas_cache['misses']} falhas "
+                f"({estatisticas_cache['taxa_acerto']:.0%}), {estatisticas_cache['entradas']} entradas."
+            )
+    with aba_worker:
+        if resumo_worker:
+            exibir_metricas(resumo_worker)
+        else:
+            st.write("O worker ainda não publicou métricas.")
+
+    # Exportação das métricas do painel e do worker
+    exportacao = {'painel': resumo, 'worker': resumo_worker}
+    prometheus = resumo_para_prometheus([('painel', resumo)] + ([('worker', resumo_worker)] if resumo_worker else []))
+    col1, col2, col3 = st.columns(3)
+    col1.download_button("Exportar JSON", json.dumps(exportacao, indent=2, ensure_ascii=False), file_name='metricas.json', mime='application/json')
+    col2.download_button("Exportar Prometheus", prometheus, file_name='metricas.prom', mime='text/plain')
+    if col3.button("Zerar métricas do painel"):
+        METRICAS.limpar()
+        st.rerun()
+
+
+
+
 # Função para o "Painel de Mensagem"
 def painel_mensagem():
+    import pandas as pd
+    from analise import Analisador, CacheAnalise
+    from busca import CAMPOS_BUSCA
+    from conversas import (
+        CHAVE_ASSINATURA_CONFIG,
+        get_changed_phone_numbers, get_historic_phone_numbers, ler_watermark, avancar_watermark,
+        RegistroLeads, processar_em_fluxo, restaurar_dados_do_redis, versao_dados_do_redis,
+        salvar_checks_no_redis, restaurar_checks_do_redis,
+        enfileirar_analises, progresso_analises,
+        COLUNAS_DASHBOARD, carregar_mensagens, anexar_mensagens, buscar_leads,
+    )
+    from relatorios import CAMINHO_RELATORIO_CSV, PERIODOS, exportar_csv, salvar_relatorio, mascara_periodo, versao_dados_relatorio
+
     st.title('Dashboard - Conversas da IA com Usuários')
 
-    # Função para normalizar o número de telefone
-    def normalize_phone_number(phone):
-        if not phone:
-            return ''
-        normalized_phone = ''.join(filter(str.isdigit, phone))
-        if normalized_phone.startswith('55'):
-            normalized_phone = normalized_phone[2:]
-            if len(normalized_phone) == 10:
-                ddd = normalized_phone[:2]
-                rest_of_number = normalized_phone[2:]
-                normalized_phone = f"{ddd}9{rest_of_number}"
-        return normalized_phone
-
-    # Função para normalizar a data para o formato correto com ou sem horário incluído
-    def normalizar_data(data_string):
-        try:
-            # Verifica se a data está vazia ou contém uma mensagem de erro
-            if pd.isnull(data_string) or data_string.strip() == "" or "Erro" in data_string:
-                return ''  # Retornar uma string vazia se a data estiver ausente ou for uma mensagem de erro
-
-            # Tenta converter o valor para inteiro (timestamp UNIX)
-            try:
-                data_timestamp = int(data_string)
-                # Converte o timestamp UNIX em uma data legível
-                data_formatada = pd.to_datetime(data_timestamp, unit='s')
-            except ValueError:
-                # Caso não seja um timestamp, tenta converter como data formatada
-                # Primeiro tenta com horário, depois sem horário
-                try:
-                    data_formatada = pd.to_datetime(data_string, format='%d/%m/%y %H:%M:%S', dayfirst=True)
-                except ValueError:
-                    # Se falhar, tenta sem o horário
-                    data_formatada = pd.to_datetime(data_string, format='%d/%m/%y', dayfirst=True)
-
-            # Retorna a data no formato 'DD/MM/YY HH:MM:SS' (se possível) ou apenas 'DD/MM/YY'
-            return data_formatada.strftime('%d/%m/%y %H:%M:%S') if ' ' in data_string else data_formatada.strftime('%d/%m/%y')
-        except Exception as e:
-            st.error(f"Erro ao converter a data: {data_string} - {e}")
-            return ''
-
-    # Funções para gerar resumos, datas, nomes e classificações
-    def gerar_resumo_conversa(mensagens, phone_number, ai_name, ai_objectives):
-        try:
-            # Limitar o resumo às últimas 15 mensagens
-            mensagens_limitadas = '\n'.join(mensagens.strip().split('\n')[-15:])
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": f"Escreva seu resumo todo em um único parágrafo sem 'enters' ou 'quebras de linhas'. Resuma a conversa entre o usuário, cujo número é {phone_number}, e a IA de nome {ai_name}. Caso o usuário forneça o nome durante a conversa, use o nome fornecido para referenciá-lo. Lembre-se que {ai_name} é o nome da IA. No seu resumo, atente-se às seguintes situações:{ai_objectives}. Essas são as mensagens entre o usuário e a IA: {mensagens_limitadas}"},
-                ],
-                max_tokens=300,
-                temperature=0.2,
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            return f"Erro ao gerar resumo: {e}"
-
-    def gerar_data(mensagens, phone_number):
-        try:
-            # Extrair as 8 primeiras mensagens do usuário
-            linhas = mensagens.strip().split('\n')
-            ultima_mensagem = '\n'.join(linhas[-8:])  # Junta as 8 primeiras linhas
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": f"Identifique a data da mensagem mais recente enviada pelo número {phone_number}. Seu retorno deve ser apenas a data na seguinte estrutura: 'XX/XX/XX HH:MM:SS'. Exemplo de resposta: 12/10/24 09:30:55. Por exemplo, se tiver uma mensagem com data '12/10/24 09:30:55' e outra com '12/10/24 09:35:55', você deve retornar '12/10/24 09:35:55'."},
-                    {"role": "user", "content": f"Identifique a data da mensagem mais recente enviada pelo número {phone_number}. Seu retorno deve ser apenas a data na seguinte estrutura: 'XX/XX/XX HH:MM:SS'. Exemplo de resposta: 12/10/24 09:30:55. Por exemplo, se tiver uma mensagem com data '12/10/24 09:30:55' e outra com '12/10/24 09:35:55', você deve retornar '12/10/24 09:35:55'. Essas são as mensagens:\n\n{ultima_mensagem}"},
-                ],
-                max_tokens=50,
-                temperature=0.2,
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            return f"Erro ao gerar data: {e}"
-
-    def gerar_nome(mensagens, phone_number, ai_name):
-        try:
-            mensagens_limitadas = '\n'.join(mensagens.strip().split('\n')[-20:])
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": f"Analise a conversa entre o usuário, cujo telefone é {phone_number}, e a IA, cujo nome é {ai_name}. Seu objetivo é identificar e retornar o nome do usuário. Seu retorno deve ser apenas o nome do usuário: Exemplo 'Bruno'. Caso não identifique o nome do usuário, retorne apenas 'Nome não fornecido'. Lembre-se que o nome da IA é {ai_name}."},
-                    {"role": "user", "content": f"As mensagens são:\n\n{mensagens_limitadas}"},
-                ],
-                max_tokens=50,
-                temperature=0.2,
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            return f"Erro ao gerar nome: {e}"
-
-    def gerar_classificacao(mensagens, phone_number, ai_name):
-        try:
-            mensagens_limitadas = '\n'.join(mensagens.strip().split('\n')[-20:])
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": f"Analise a conversa entre o usuário, cujo telefone é {phone_number}, e a IA, cujo nome é {ai_name}. Classifique a conversa conforme as seguintes categorias: {ai_status}. Sua resposta deve conter apenas a classificação. Exemplo: 'Lead quente'"},
-                    {"role": "user", "content": f"As mensagens são:\n\n{mensagens_limitadas}"},
-                ],
-                max_tokens=50,
-                temperature=0.2,
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            return f"Erro ao gerar classificação: {e}"
-
-    # Função para salvar dados processados no Redis
-    def salvar_dados_no_redis(redis_client, df):
-        for _, row in df.iterrows():
-            phone_number = row['Número de WhatsApp']
-            redis_client.set(f"dashboard_dados:{phone_number}", json.dumps(row.to_dict()))  # Salva o DataFrame como JSON no Redis
-
-    # Função para restaurar dados do Redis
-    def restaurar_dados_do_redis(redis_client):
-        cursor = '0'
-        dados_redis = []
-        while True:
-            cursor, keys = redis_client.scan(cursor=cursor, match='dashboard_dados:*', count=1000)
-            for key in keys:
-                dado = redis_client.get(key)
-                if dado:
-                    dados_redis.append(json.loads(dado.decode('utf-8')))
-            if cursor == 0:
-                break
-        return dados_redis
-
-    # Função para salvar o estado dos checks no Redis
-    def salvar_checks_no_redis(redis_client, df):
-        for _, row in df.iterrows():
-            phone_number = row['Número de WhatsApp']
-            check_value = row['Selecionado']
-            redis_client.set(f"check:{phone_number}", str(check_value))  # Armazena como string ('True' ou 'False')
-
-    # Função para restaurar os checks do Redis
-    def restaurar_checks_do_redis(redis_client, df):
-        for i, row in df.iterrows():
-            phone_number = row['Número de WhatsApp']
-            check_value = redis_client.get(f"check:{phone_number}")
-            if check_value:
-                df.at[i, 'Selecionado'] = check_value.decode('utf-8') == 'True'  # Converte string para booleano
+    client = conectar_openai()
+    redis_client = conectar_redis()
+    verificar_informacoes_ia()
+    if redis_client is None:
+        st.stop()
+
+    # Analisador das conversas com as configurações atuais da IA. O limitador de taxa é
+    # compartilhado pelas sessões e o cache evita pagar de novo por conversas já analisadas.
+    analisador = Analisador(
+        client,
+        st.session_state['ai_name_info'],
+        st.session_state['ai_objectives_info'],
+        st.session_state['ai_status_info'],
+        modo=st.session_state['llm_modo_analise'],
+        limitador=obter_limitador_llm(int(st.session_state['llm_rpm']), int(st.session_state['llm_tpm'])),
+        cache=CacheAnalise(redis_client),
+        orcamento_tokens=int(st.session_state['llm_orcamento_tokens']),
+        resumo_incremental=bool(st.session_state['llm_resumo_incremental']),
+    )
+    assinatura_config = analisador.assinatura()
+
+    # Acompanha o worker enquanto houver itens na fila; ao terminar, recarrega os dados do Redis
+    @st.fragment(run_every=2)
+    def acompanhar_worker():
+        progresso = progresso_analises(redis_client)
+        if progresso['status'] == 'concluido' and not progresso['na_fila'] and not progresso['processando']:
+            st.session_state['acompanhando_worker'] = False
+            st.session_state.pop('df', None)
+            st.rerun()
+        total = max(progresso['total'], 1)
+        st.progress(
+            min(progresso['concluidos'] / total, 1.0),
+            text=f"Worker analisando conversas... {progresso['concluidos']}/{progresso['total']}"
+        )
 
     # Carregar dados salvos do Redis ou session_state
-    dados_salvos = restaurar_dados_do_redis(redis_client)
     if 'df' not in st.session_state:
+        # Lida antes das linhas: uma gravação no meio da leitura deixa o relatório para ser regravado
+        versao_dados = versao_dados_do_redis(redis_client)
+        dados_salvos = restaurar_dados_do_redis(redis_client)
         if dados_salvos:
-            df = pd.DataFrame(dados_salvos)
-            # Aplicar a normalização da data e ordenar
-            df['Data de Criação'] = df['Data de Criação'].apply(normalizar_data)
+            # 'Data de Criação' já vem como datetime64, então a ordenação é cronológica
+            df = RegistroLeads(dados_salvos).para_dataframe()
             df = df.sort_values(by='Data de Criação', ascending=False)
             st.session_state['df'] = df
+            # O relatório só é regravado quando os dados do Redis mudaram desde a última gravação
+            # (de qualquer sessão), e não a cada sessão que abre o painel
+            if versao_dados_relatorio() != versao_dados:
+                salvar_relatorio(df, versao_dados)
         else:
             df = pd.DataFrame()
             st.session_state['df'] = df
@@ -382,197 +428,158 @@ def painel_mensagem():
 
     
     # Adicionar o seletor de período
-    period_options = ['Completo', 'Último mês', 'Últimos 14 dias', 'Últimos 7 dias', 'Ontem', 'Hoje']
-    selected_period = st.selectbox('Selecione o período', period_options)
+    selected_period = st.selectbox('Selecione o período', PERIODOS)
 
-    # Obter a data atual
-    today = datetime.today()
+    # Na atualização incremental só são visitados os números com atividade desde a última atualização
+    atualizacao_incremental = st.toggle(
+        'Atualização incremental',
+        value=True,
+        help="Processa apenas as conversas com mensagens novas desde a última atualização. Desative para reprocessar todo o histórico."
+    )
 
-    # Criar uma série temporária com as datas convertidas
-    temp_dates = pd.to_datetime(df['Data de Criação'], format='%d/%m/%y %H:%M:%S', dayfirst=True, errors='coerce')
+    # Adicionar botão de atualização
+    if st.button('Atualizar'):
+        inicio_atualizacao = time.perf_counter()
+        # Se as configurações da IA mudaram desde a última atualização, todas as conversas são reanalisadas
+        assinatura_anterior = redis_client.get(CHAVE_ASSINATURA_CONFIG)
+        config_inalterada = assinatura_anterior is not None and assinatura_anterior.decode('utf-8') == assinatura_config
+
+        # Linhas atuais indexadas pelo número; a atualização trabalha sobre esse registro
+        registro = RegistroLeads.de_dataframe(df)
+
+        watermark = ler_watermark(redis_client)
+        incremental = atualizacao_incremental and watermark is not None and config_inalterada and not df.empty
+        if incremental:
+            historic_phone_numbers = get_changed_phone_numbers(redis_client, watermark, registro)
+            if not historic_phone_numbers:
+                st.info("Nenhuma conversa nova desde a última atualização.")
+        else:
+            # Obter números históricos do Redis
+            historic_phone_numbers = get_historic_phone_numbers(redis_client)
+            if not historic_phone_numbers:
+                st.info("Nenhum dado encontrado no Redis.")
+                return
+
+        if st.session_state['modo_execucao'] == MODO_EXECUCAO_WORKER:
+            # O worker grava os resultados no Redis; o painel só acompanha o progresso
+            if historic_phone_numbers:
+                enfileirar_analises(redis_client, historic_phone_numbers, reanalisar=not config_inalterada)
+                st.session_state['acompanhando_worker'] = True
+            redis_client.set(CHAVE_ASSINATURA_CONFIG, assinatura_config)
+            avancar_watermark(redis_client, historic_phone_numbers)
+        else:
+            # Atualização em fluxo: cada bloco de conversas é gravado no Redis assim que suas
+            # análises terminam, e as linhas concluídas mais recentes aparecem na tabela abaixo
+            total = len(historic_phone_numbers)
+            progresso = st.progress(0.0, text="Analisando conversas...")
+            tabela_concluidas = st.empty()
+            recentes = pd.DataFrame()
+            visitados = []
+            analisadas = 0
+            inicio_fluxo = time.perf_counter()
+            for df_bloco, analisadas_bloco in processar_em_fluxo(
+                redis_client,
+                analisador,
+                historic_phone_numbers,
+                registro,
+                reanalisar=not config_inalterada,
+                max_concorrencia=int(st.session_state['llm_concorrencia']),
+            ):
+                visitados.extend(df_bloco['Número de WhatsApp'])
+                analisadas += analisadas_bloco
+                ritmo = len(visitados) / max(time.perf_counter() - inicio_fluxo, 1e-6)
+                progresso.progress(
+                    min(len(visitados) / total, 1.0),
+                    text=f"Analisando conversas... {len(visitados)}/{total} ({ritmo:.1f} conversas/s, {analisadas} analisadas)"
+                )
+                recentes = pd.concat([df_bloco, recentes]).head(TAMANHO_PAGINA)
+                tabela_concluidas.dataframe(
+                    recentes,
+                    column_order=[coluna for coluna in COLUNAS_DASHBOARD if coluna in recentes.columns],
+                    hide_index=True
+                )
+            progresso.empty()
+            tabela_concluidas.empty()
+
+            redis_client.set(CHAVE_ASSINATURA_CONFIG, assinatura_config)
+
+            # Na atualização incremental, as linhas dos números não visitados continuam as mesmas.
+            # As conversas completas ficam só no Redis e são lidas sob demanda.
+            df = registro.para_dataframe() if incremental else registro.para_dataframe(list(dict.fromkeys(visitados)))
+
+            # Ordenar o dataframe
+            df = df.sort_values(by='Data de Criação', ascending=False)
 
-    # Aplicar o filtro de acordo com o período selecionado
-    if selected_period == 'Último mês':
-        start_date = today - timedelta(days=30)
-        mask = temp_dates >= start_date
-        df_filtered = df[mask]
-    elif selected_period == 'Últimos 14 dias':
-        start_date = today - timedelta(days=14)
-        mask = temp_dates >= start_date
-        df_filtered = df[mask]
-    elif selected_period == 'Últimos 7 dias':
-        start_date = today - timedelta(days=7)
-        mask = temp_dates >= start_date
-        df_filtered = df[mask]
-    elif selected_period == 'Ontem':
-        yesterday = today - timedelta(days=1)
-        mask = temp_dates.dt.date == yesterday.date()
-        df_filtered = df[mask]
-    elif selected_period == 'Hoje':
-        mask = temp_dates.dt.date == today.date()
-        df_filtered = df[mask]
-    else:
-        df_filtered = df  # 'Completo', não aplica filtro
+            avancar_watermark(redis_client, historic_phone_numbers)
 
+            # Salvar o dataframe na sessão
+            st.session_state['df'] = df
+            if not df.empty:
+                salvar_relatorio(df)
+                st.toast(f"Relatório salvo como {CAMINHO_RELATORIO_CSV}", icon="✅")
+            METRICAS.registrar_etapa('atualizacao_painel', time.perf_counter() - inicio_atualizacao)
+
+            st.success('Dados atualizados com sucesso!')
+            estatisticas_cache = analisador.cache.estatisticas()
+            st.caption(
+                f"Cache de análises: {estatisticas_cache['hits']} acertos, {estatisticas_cache['misses']} falhas "
+                f"({estatisticas_cache['taxa_acerto']:.0%}), {estatisticas_cache['entradas']} entradas."
+            )
 
-    # Adicionar botão de atualização
-    if st.button('Atualizar'):
-        # Obter números históricos do Redis
-        historic_phone_numbers = get_historic_phone_numbers(redis_client)
-        if not historic_phone_numbers:
-            st.info("Nenhum dado encontrado no Redis.")
-            return
-
-        # Criar uma cópia do dataframe atual
-        previous_df = df.copy()
-
-        data = []
-        for item in historic_phone_numbers:
-            phone_number = item['phone_number']
-            data_criacao = item['created_at']
-            normalized_phone_number = normalize_phone_number(phone_number)
-
-            # Verificar se o número já existe no dataframe anterior
-            previous_data = previous_df[previous_df['Número de WhatsApp'] == normalized_phone_number]
-            if not previous_data.empty:
-                previous_message_count = previous_data['Nº User Messages'].values[0]
-            else:
-                previous_message_count = 0
-
-            # Obter o threadId associado a este número de telefone
-            thread_id_key = f'threadId:{normalized_phone_number}'
-            thread_id = redis_client.get(thread_id_key)
-            mensagens_texto = ''
-            mensagens_texto_completo = ''
-            if thread_id:
-                thread_id = thread_id.decode('utf-8')
-                # Obter as mensagens da conversa
-                conversation_key = f'conversation:{normalized_phone_number}:{thread_id}'
-                messages = redis_client.lrange(conversation_key, 0, -1)
-                # Contar quantas mensagens foram enviadas pelo usuário
-                user_message_count = sum(1 for msg in messages if json.loads(msg).get('role', '') == 'user')
-            else:
-                user_message_count = 0
-                thread_id = ''
-
-            # Se o número de mensagens for igual ao anterior e os dados já existirem, manter os dados antigos
-            if user_message_count == previous_message_count and not previous_data.empty:
-                data.append(previous_data.iloc[0].to_dict())
-                continue
-            else:
-                # Sempre regenerar as análises quando o número de mensagens aumentar
-                if thread_id:
-                    # Processar mensagens para gerar o resumo e outras informações
-                    mensagens = []
-                    for msg in messages:
-                        msg_obj = json.loads(msg)
-                        role = msg_obj.get('role', '')
-                        content = msg_obj.get('content', '')
-                        if role == "user":
-                            mensagens.append(f"Usuário: {content}")
-                        elif role == "assistant":
-                            mensagens.append(f"Assistente: {content}")
-
-                    
-                    mensagens_texto = '\n'.join(mensagens[-20:])  # Pega as últimas 20 mensagens
-
-                    # Gerar análises usando as funções correspondentes
-                    resumo = gerar_resumo_conversa(mensagens_texto, phone_number, ai_name, ai_objectives)
-                    salvar_analise_no_redis(redis_client, phone_number, 'resumo', resumo)
-
-                    data_ia = gerar_data(mensagens_texto, phone_number)
-                    salvar_analise_no_redis(redis_client, phone_number, 'data', data_ia)
-
-                    user_data = gerar_nome(mensagens_texto, phone_number, ai_name)
-                    salvar_analise_no_redis(redis_client, phone_number, 'nome', user_data)
-
-                    classificacao = gerar_classificacao(mensagens_texto, phone_number, ai_name)
-                    salvar_analise_no_redis(redis_client, phone_number, 'classificacao', classificacao)
-                else:
-                    resumo = "Sem resumo disponível"
-                    data_ia = ""
-                    user_data = "Nome não fornecido"
-                    classificacao = "Não classificado"
-                    mensagens_texto = ''
-
-                # Gerar o link do WhatsApp Web para contato direto
-                whatsapp_link = f"https://wa.me/55{normalized_phone_number}"
-
-                # Atualizar os campos específicos para o usuário existente ou criar novo
-                if not previous_data.empty:
-                    updated_row = previous_data.iloc[0].to_dict()
-                    updated_row.update({
-                        'Data de Criação': normalizar_data(data_ia),
-                        'Resumo da Conversa (IA) 🤖': resumo,
-                        'Mensagens': mensagens_texto,
-                        'Nº User Messages': user_message_count,
-                        'Status': classificacao,
-                        'Nome do usuário': user_data,
-                        'Thread ID': thread_id,
-                        'Falar com Usuário': whatsapp_link
-                    })
-                else:
-                    updated_row = {
-                        'Selecionado': False,
-                        'Data de Criação': normalizar_data(data_ia),
-                        'Nome do usuário': user_data,
-                        'Status': classificacao,
-                        'Número de WhatsApp': normalized_phone_number,
-                        'Resumo da Conversa (IA) 🤖': resumo,
-                        'Mensagens': mensagens_texto,
-                        'Nº User Messages': user_message_count,
-                        'Thread ID': thread_id,
-                        'Falar com Usuário': whatsapp_link
-                    }
-                data.append(updated_row)
-
-        # Converter os dados para DataFrame
-        df = pd.DataFrame(data)
-
-        # Remover quebras de linha no campo 'Resumo da Conversa (IA) 🤖' para evitar múltiplas linhas no CSV
-        df['Resumo da Conversa (IA) 🤖'] = df['Resumo da Conversa (IA) 🤖'].apply(lambda x: ' '.join(x.splitlines()))
-
-        # Adicionar a coluna DDD, que pega os 2 primeiros dígitos do número de WhatsApp
-        df['DDD'] = df['Número de WhatsApp'].apply(lambda x: x[:2])
-
-        # Ordenar o dataframe
-        df = df.sort_values(by='Data de Criação', ascending=False)
-
-        # Salvar os dados processados no Redis
-        salvar_dados_no_redis(redis_client, df)
-
-        # Salvar o dataframe na sessão
-        st.session_state['df'] = df
+    if st.session_state.get('acompanhando_worker'):
+        acompanhar_worker()
 
+    if df.empty:
+        st.warning('Não há dados disponíveis. Clique em "Atualizar" para carregar os dados.')
+        return
+    else:
         # Restaurar o estado dos checks
         restaurar_checks_do_redis(redis_client, df)
 
-        st.success('Dados atualizados com sucesso!')
-    else:
-        if df.empty:
-            st.warning('Não há dados disponíveis. Clique em "Atualizar" para carregar os dados.')
-            return
-        else:
-            # Restaurar o estado dos checks
-            restaurar_checks_do_redis(redis_client, df)
-
-    # Exibir o dataframe filtrado
+    # Aplicar o filtro de acordo com o período selecionado
+    df_filtered = df[mascara_periodo(df['Data de Criação'], selected_period, datetime.today().date())]
+
+    # Busca e paginação feitas aqui no servidor: só as linhas da página atual vão para o navegador.
+    # As palavras são procuradas no índice de busca do Redis (sem acentos; a última vale como prefixo).
+    col_busca, col_campos, col_status = st.columns([2, 1, 1])
+    busca = col_busca.text_input('Buscar por nome, número, status, resumo ou conversa')
+    campos_busca = col_campos.multiselect(
+        'Buscar em',
+        list(CAMPOS_BUSCA),
+        format_func=CAMPOS_BUSCA.get,
+        placeholder='Todos os campos'
+    )
+    status_filtro = col_status.multiselect('Status', sorted(df['Status'].dropna().astype(str).unique()))
+    if status_filtro:
+        df_filtered = df_filtered[df_filtered['Status'].astype(str).isin(status_filtro)]
+    if busca:
+        mascara = df_filtered['Número de WhatsApp'].astype(str).isin(buscar_leads(redis_client, busca, campos_busca))
+        # Números continuam sendo procurados em qualquer posição
+        if any(caractere.isdigit() for caractere in busca):
+            mascara |= df_filtered['Número de WhatsApp'].astype(str).str.contains(busca.strip(), regex=False)
+        df_filtered = df_filtered[mascara]
+    total_paginas = max(1, -(-len(df_filtered) // TAMANHO_PAGINA))
+    pagina = st.number_input('Página', min_value=1, max_value=total_paginas, value=1, step=1)
+    st.caption(f"{len(df_filtered)} conversas - página {pagina} de {total_paginas}")
+    df_pagina = df_filtered.iloc[(pagina - 1) * TAMANHO_PAGINA:pagina * TAMANHO_PAGINA]
+
+    # Exibir a página do dataframe filtrado
     updated_df = st.data_editor(
-        df_filtered,
+        df_pagina,
+        column_order=[coluna for coluna in COLUNAS_DASHBOARD if coluna in df_pagina.columns],
         column_config={
             "Selecionado": st.column_config.CheckboxColumn(
                 label="Selecionar Usuário",  # Nome da coluna de checkbox
                 help="Selecione este usuário para ações futuras",
                 default=False  # Valor padrão para o checkbox
             ),
+            "Data de Criação": st.column_config.DatetimeColumn(
+                label="Data de Criação",
+                format="DD/MM/YY HH:mm:ss"
+            ),
             "Falar com Usuário": st.column_config.LinkColumn(
                 label="Falar com Usuário",
                 help="Clique para contatar o usuário via WhatsApp"
-            ),
-            "Mensagens": st.column_config.TextColumn(
-                label="Mensagens",
-                help="Conversa completa entre o usuário e a IA",
-                width="large"  # Ajuste conforme necessário
             )
         },
         hide_index=True  # Esconder o índice do DataFrame
@@ -582,80 +589,163 @@ def painel_mensagem():
     if st.button("Salvar Seleções"):
         salvar_checks_no_redis(redis_client, updated_df)
         st.toast("Seleções salvas com sucesso!", icon="✅")
-    
-    # Salvar o dataframe em um arquivo CSV após gerar a tabela
-    csv_file_path = "data/relatorios_conversas.csv"
-    df.to_csv(csv_file_path, index=False)
-    st.toast((f"Relatório salvo como {csv_file_path}"), icon="✅")
 
-    # Oferecer o download para o usuário
+    # Conversa completa do lead escolhido, lida do Redis só quando pedida
+    nomes = dict(zip(df_pagina['Número de WhatsApp'], df_pagina['Nome do usuário']))
+    telefone_conversa = st.selectbox(
+        'Ver conversa',
+        [None] + list(nomes),
+        format_func=lambda telefone: 'Selecione um lead da página' if telefone is None else f"{nomes[telefone]} ({telefone})"
+    )
+    if telefone_conversa:
+        st.text_area(
+            'Mensagens',
+            carregar_mensagens(redis_client, telefone_conversa) or 'Conversa não disponível.',
+            height=300,
+            disabled=True
+        )
+
+    # Oferecer o download para o usuário. O CSV com as conversas só é montado no clique.
     st.download_button(
         label="Baixar relatório em CSV",
-        data=df.to_csv(index=False).encode('utf-8'),
-        file_name=csv_file_path,
+        data=lambda: exportar_csv(anexar_mensagens(redis_client, df)).encode('utf-8'),
+        file_name=CAMINHO_RELATORIO_CSV.name,
         mime='text/csv'
     )
 
+# Tabela DDD -> estado, lida uma única vez
+@st.cache_resource
+def obter_estados_por_ddd():
+    from relatorios import carregar_estados_por_ddd
+    return carregar_estados_por_ddd()
+
+# Linhas do relatório usadas no gráfico por usuário. Fica em cache enquanto o arquivo não for
+# regravado (a versão é a data de modificação), então trocar de período não relê o disco.
+@st.cache_data(max_entries=8)
+def carregar_dados_bi(versao):
+    from relatorios import carregar_relatorio
+    return carregar_relatorio(['Data de Criação', 'Nome do usuário', 'Nº User Messages'])
+
+# Agregados diários do período (conversas, mensagens e satisfeitos por dia, DDD e Status),
+# mantidos no Redis a cada gravação das linhas. A versão muda a cada alteração dos agregados.
+# O cliente (_redis_client, None sem Redis) não entra na chave do cache
+@st.cache_data(max_entries=32)
+def carregar_agregados_bi(_redis_client, versao, periodo, hoje):
+    import pandas as pd
+    from relatorios import carregar_agregados, estados_dos_ddds
+
+    agregados = carregar_agregados(_redis_client, periodo, hoje)
+    agregados['Estado'] = estados_dos_ddds(pd.to_numeric(agregados['DDD'], errors='coerce'), obter_estados_por_ddd())
+    return agregados
+
+# KPIs e gráficos de cada período. As figuras são compartilhadas entre as sessões, por isso
+# st.cache_resource (sem cópia); o st.plotly_chart apenas as serializa.
+@st.cache_resource(max_entries=32)
+def montar_dashboard_bi(_redis_client, versao_agregados, versao_linhas, periodo, hoje):
+    import pandas as pd
+    import plotly.express as px
+    from relatorios import mascara_periodo
+
+    agregados = carregar_agregados_bi(_redis_client, versao_agregados, periodo, hoje)
+
+    # Cálculo dos KPIs, somando os agregados dos dias do período
+    total_conversas = int(agregados['conversas'].sum())
+    kpis = {
+        'total_conversas': total_conversas,
+        'media_mensagens_por_conversa': agregados['mensagens'].sum() / total_conversas if total_conversas > 0 else float('nan'),
+        'taxa_satisfacao': (
+            agregados['satisfeitos'].sum() / total_conversas * 100
+            if total_conversas > 0 else 0
+        ),
+    }
+
+    figuras = {}
+    figuras['status'] = px.pie(
+        agregados,
+        names='Status',
+        values='conversas',
+        title='Distribuição dos Status dos Leads',
+        color_discrete_sequence=px.colors.qualitative.Pastel,
+        height=600,
+        width=700
+    )
+
+    estado_counts = agregados.groupby('Estado')['conversas'].sum().sort_values(ascending=False).reset_index()
+    estado_counts.columns = ['Estado', 'Quantidade']
+    figuras['estado'] = px.bar(
+        estado_counts,
+        x='Estado',
+        y='Quantidade',
+        title="Conversas por Estado",
+        color='Quantidade',
+        color_continuous_scale='Blues',
+        height=600,
+        width=850
+    )
+
+    # Agrupando por dia
+    por_dia = agregados[agregados['Dia'] != '']
+    df_conversas_por_data = por_dia.groupby('Dia')['conversas'].sum().reset_index()
+    df_conversas_por_data.columns = ['Data de Criação', 'Quantidade']
+    df_conversas_por_data['Data de Criação'] = pd.to_datetime(df_conversas_por_data['Data de Criação'])
+    figuras['evolucao'] = px.line(
+        df_conversas_por_data,
+        x='Data de Criação',
+        y='Quantidade',
+        title="Mensagens ao longo do tempo",
+        line_shape='spline',
+        markers=True
+    )
+    figuras['evolucao'].update_layout(xaxis_title="Data", yaxis_title="Conversas", width=1200, height=500)
+
+    por_ddd = agregados.dropna(subset=['Estado']).groupby(['Estado', 'DDD'], as_index=False)['mensagens'].sum()
+    por_ddd = por_ddd.rename(columns={'mensagens': 'Nº User Messages'})
+    figuras['ddd'] = px.treemap(
+        por_ddd[por_ddd['Nº User Messages'] > 0],
+        path=['Estado', 'DDD'],
+        values='Nº User Messages',
+        title="Conversas por Estados",
+        color='Nº User Messages',
+        color_continuous_scale='RdBu',
+        height=600
+    )
+
+    # O gráfico por usuário é o único que precisa das linhas individuais
+    df_conversas = carregar_dados_bi(versao_linhas)
+    df_filtered = df_conversas[mascara_periodo(df_conversas['Data de Criação'], periodo, hoje)]
+
+    figuras['mensagens'] = px.bar(
+        df_filtered.sort_values(by='Nº User Messages', ascending=False),
+        x='Nome do usuário',
+        y='Nº User Messages',
+        title="Mensagens por Usuário",
+        color='Nº User Messages',
+        color_continuous_scale='Viridis',
+        height=600,
+        width=850
+    )
+    return kpis, figuras
+
 # Função para o dashboard
 def dashboard_bi():
+    from conversas import versao_rollups
+    from relatorios import PERIODOS, versao_relatorio
+
     # Título com ícone
     st.markdown(
         "<h1 style='text-align: center; font-size: 36px;'>📊 Business Intelligence Dashboard</h1>",
         unsafe_allow_html=True
     )
 
-    # Carregar arquivos CSV
-    df_conversas = pd.read_csv('data/relatorios_conversas.csv')
-    df_ddd_estado = pd.read_csv('data/ddd_estado_brasil.csv')
-
-    # Mesclar os dados de DDD com estado
-    df_conversas = df_conversas.merge(df_ddd_estado, how='left', on='DDD')
-
     # Adicionar o seletor de período com uma chave única
-    period_options = ['Completo', 'Último mês', 'Últimos 14 dias', 'Últimos 7 dias', 'Ontem', 'Hoje']
-    selected_period = st.selectbox('Selecione o período', period_options, key='dashboard_period_selector')
-
-    # Obter a data atual
-    today = datetime.today()
-
-    # Converter 'Data de Criação' para datetime
-    df_conversas['Data de Criação'] = pd.to_datetime(
-        df_conversas['Data de Criação'],
-        format='%d/%m/%y %H:%M:%S',
-        dayfirst=True,
-        errors='coerce'
-    )
+    selected_period = st.selectbox('Selecione o período', PERIODOS, key='dashboard_period_selector')
 
-    # Aplicar o filtro de acordo com o período selecionado
-    if selected_period == 'Último mês':
-        start_date = today - timedelta(days=30)
-        mask = df_conversas['Data de Criação'] >= start_date
-        df_filtered = df_conversas[mask]
-    elif selected_period == 'Últimos 14 dias':
-        start_date = today - timedelta(days=14)
-        mask = df_conversas['Data de Criação'] >= start_date
-        df_filtered = df_conversas[mask]
-    elif selected_period == 'Últimos 7 dias':
-        start_date = today - timedelta(days=7)
-        mask = df_conversas['Data de Criação'] >= start_date
-        df_filtered = df_conversas[mask]
-    elif selected_period == 'Ontem':
-        yesterday = today - timedelta(days=1)
-        mask = df_conversas['Data de Criação'].dt.date == yesterday.date()
-        df_filtered = df_conversas[mask]
-    elif selected_period == 'Hoje':
-        mask = df_conversas['Data de Criação'].dt.date == today.date()
-        df_filtered = df_conversas[mask]
-    else:
-        df_filtered = df_conversas  # 'Completo', não aplica filtro
-
-    # Cálculo dos KPIs
-    total_conversas = len(df_filtered)
-    media_mensagens_por_conversa = df_filtered['Nº User Messages'].mean()
-    taxa_satisfacao = (
-        len(df_filtered[df_filtered['Resumo da Conversa (IA) 🤖'].str.contains("satisfação|agradecimento|obrigado|obrigada", case=False, na=False)]) / total_conversas * 100
-        if total_conversas > 0 else 0
-    )
+    # Sem Redis, os agregados são calculados a partir do relatório salvo
+    redis_client = conectar_redis()
+
+    # O dia atual entra na chave para que 'Hoje' e 'Ontem' acompanhem a virada do dia
+    versao_agregados = versao_rollups(redis_client) if redis_client is not None else versao_relatorio()
+    kpis, figuras = montar_dashboard_bi(redis_client, versao_agregados, versao_relatorio(), selected_period, datetime.today().date())
 
     # Layout com KPIs
     st.markdown(
@@ -663,9 +753,9 @@ def dashboard_bi():
         unsafe_allow_html=True
     )
     col1, col2, col3 = st.columns(3)
-    col1.metric("Total de Conversas", f"{total_conversas:,}", "📈", delta_color="off")
-    col2.metric("Média de Mensagens por Conversa", f"{media_mensagens_por_conversa:.2f}", "💬", delta_color="off")
-    col3.metric("Taxa de Satisfação do Usuário (%)", f"{taxa_satisfacao:.2f}%", "😊", delta_color="off")
+    col1.metric("Total de Conversas", f"{kpis['total_conversas']:,}", "📈", delta_color="off")
+    col2.metric("Média de Mensagens por Conversa", f"{kpis['media_mensagens_por_conversa']:.2f}", "💬", delta_color="off")
+    col3.metric("Taxa de Satisfação do Usuário (%)", f"{kpis['taxa_satisfacao']:.2f}%", "😊", delta_color="off")
     st.markdown("</div><br>", unsafe_allow_html=True)
 
     # Gráficos lado a lado com layout em colunas e bordas arredondadas
@@ -676,15 +766,7 @@ def dashboard_bi():
             unsafe_allow_html=True
         )
         st.subheader("📊 Distribuição dos Status dos Leads")
-        fig_status = px.pie(
-            df_filtered,
-            names='Status',
-            title='Distribuição dos Status dos Leads',
-            color_discrete_sequence=px.colors.qualitative.Pastel,
-            height=600,
-            width=700
-        )
-        st.plotly_chart(fig_status)
+        st.plotly_chart(figuras['status'])
         st.markdown("</div>", unsafe_allow_html=True)
 
     with col5:
@@ -693,19 +775,7 @@ def dashboard_bi():
             unsafe_allow_html=True
         )
         st.subheader("📍 Conversas por Estado")
-        estado_counts = df_filtered['Estado'].value_counts().reset_index()
-        estado_counts.columns = ['Estado', 'Quantidade']
-        fig_estado = px.bar(
-            estado_counts,
-            x='Estado',
-            y='Quantidade',
-            title="Conversas por Estado",
-            color='Quantidade',
-            color_continuous_scale='Blues',
-            height=600,
-            width=850
-        )
-        st.plotly_chart(fig_estado)
+        st.plotly_chart(figuras['estado'])
         st.markdown("</div>", unsafe_allow_html=True)
 
     # Gráfico de evolução no tempo (full width)
@@ -714,21 +784,7 @@ def dashboard_bi():
         unsafe_allow_html=True
     )
     st.subheader("📈 Mensagens ao longo do tempo")
-
-    # Agrupando por dia
-    df_filtered['Data de Criação'] = df_filtered['Data de Criação'].dt.date
-    df_conversas_por_data = df_filtered.groupby('Data de Criação').size().reset_index(name='Quantidade')
-
-    fig_evolucao = px.line(
-        df_conversas_por_data,
-        x='Data de Criação',
-        y='Quantidade',
-        title="Mensagens ao longo do tempo",
-        line_shape='spline',
-        markers=True
-    )
-    fig_evolucao.update_layout(xaxis_title="Data", yaxis_title="Conversas", width=1200, height=500)
-    st.plotly_chart(fig_evolucao, use_container_width=True)
+    st.plotly_chart(figuras['evolucao'], use_container_width=True)
     st.markdown("</div><br>", unsafe_allow_html=True)
 
     # Gráficos lado a lado
@@ -739,17 +795,7 @@ def dashboard_bi():
             unsafe_allow_html=True
         )
         st.subheader("🌍 Localização dos Leads")
-        df_conversas_filtrado = df_filtered.dropna(subset=['Estado', 'DDD', 'Nº User Messages'])
-        fig_ddd = px.treemap(
-            df_conversas_filtrado,
-            path=['Estado', 'DDD'],
-            values='Nº User Messages',
-            title="Conversas por Estados",
-            color='Nº User Messages',
-            color_continuous_scale='RdBu',
-            height=600
-        )
-        st.plotly_chart(fig_ddd)
+        st.plotly_chart(figuras['ddd'])
         st.markdown("</div>", unsafe_allow_html=True)
 
     with col7:
@@ -758,27 +804,20 @@ def dashboard_bi():
             unsafe_allow_html=True
         )
         st.subheader("💬 Mensagens por Usuário")
-        fig_mensagens = px.bar(
-            df_filtered.sort_values(by='Nº User Messages', ascending=False),
-            x='Nome do usuário',
-            y='Nº User Messages',
-            title="Mensagens por Usuário",
-            color='Nº User Messages',
-            color_continuous_scale='Viridis',
-            height=600,
-            width=850
-        )
-        st.plotly_chart(fig_mensagens)
+        st.plotly_chart(figuras['mensagens'])
         st.markdown("</div>", unsafe_allow_html=True)
 
 
-# Lógica para alternar entre páginas
-if pagina_selecionada == "Painel de Mensagem":
-    painel_mensagem()
-elif pagina_selecionada == "Dashboard BI":
-    dashboard_bi()
-elif pagina_selecionada == "Configurações":
-    pagina_configuracoes()
+# Lógica para alternar entre páginas. O tempo de cada execução da página (com as importações
+# feitas na primeira) aparece em Diagnóstico como pagina:<nome>.
+PAGINAS = {
+    "Painel de Mensagem": painel_mensagem,
+    "Dashboard BI": dashboard_bi,
+    "Configurações": pagina_configuracoes,
+    "Diagnóstico": pagina_diagnostico,
+}
+with METRICAS.etapa(f"pagina:{pagina_selecionada}"):
+    PAGINAS[pagina_selecionada]()
 
 
 
@@ -0,0 +1,208 @@
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Prefixo das métricas no formato de texto do Prometheus
+PREFIXO_PROMETHEUS = 'ias'
+
+# Resumo das métricas do worker, publicado no Redis a cada lote para a página Diagnóstico
+CHAVE_METRICAS_WORKER = 'metricas:worker'
+
+
+# Métricas do processo (painel ou worker): tempo de cada etapa da atualização, chamadas ao
+# modelo com latência e tokens, tokens da conversa enviados em cada prompt, comandos enviados ao Redis e consultas aos caches.
+# Os contadores são acumulados desde o início do processo ou desde a última limpeza.
+class Metricas:
+    def __init__(self):
+        self._trava = threading.Lock()
+        self.limpar()
+
+    def limpar(self):
+        with self._trava:
+            self.iniciado_em = time.time()
+            self.etapas = {}
+            self.llm = {}
+            self.janelas = {}
+            self.redis_comandos = {}
+            self.redis_idas = 0
+            self.cache = {}
+
+    @contextmanager
+    def etapa(self, nome):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registrar_etapa(nome, time.perf_counter() - inicio)
+
+    def registrar_etapa(self, nome, segundos):
+        with self._trava:
+            etapa = self.etapas.setdefault(nome, {'execucoes': 0, 'segundos': 0.0, 'ultima': 0.0, 'maxima': 0.0})
+            etapa['execucoes'] += 1
+            etapa['segundos'] += segundos
+            etapa['ultima'] = segundos
+            etapa['maxima'] = max(etapa['maxima'], segundos)
+
+    # `usage` é o response.usage da OpenAI (ou None quando a chamada falhou)
+    def registrar_llm(self, operacao, segundos, usage=None, erro=False):
+        with self._trava:
+            chamadas = self.llm.setdefault(operacao, {
+                'chamadas': 0, 'erros': 0, 'segundos': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0,
+            })
+            chamadas['chamadas'] += 1
+            chamadas['erros'] += int(erro)
+            chamadas['segundos'] += segundos
+            if usage is not None:
+                chamadas['prompt_tokens'] += getattr(usage, 'prompt_tokens', 0) or 0
+                chamadas['completion_tokens'] += getattr(usage, 'completion_tokens', 0) or 0
+
+    # Tokens da conversa incluídos em um prompt de `operacao` e mensagens cortadas por excederem o limite
+    def registrar_janela(self, operacao, tokens, cortadas=0):
+        with self._trava:
+            janela = self.janelas.setdefault(operacao, {'prompts': 0, 'tokens': 0, 'maximo': 0, 'cortadas': 0})
+            janela['prompts'] += 1
+            janela['tokens'] += tokens
+            janela['maximo'] = max(janela['maximo'], tokens)
+            janela['cortadas'] += cortadas
+
+    # Comandos de uma ida ao Redis (um comando avulso ou um pipeline inteiro)
+    def registrar_redis(self, comandos):
+        with self._trava:
+            self.redis_idas += 1
+            for comando in comandos:
+                comando = str(comando).upper()
+                self.redis_comandos[comando] = self.redis_comandos.get(comando, 0) + 1
+
+    def registrar_cache(self, nome, acerto):
+        with self._trava:
+            cache = self.cache.setdefault(nome, {'hits': 0, 'misses': 0})
+            cache['hits' if acerto else 'misses'] += 1
+
+    def resumo(self):
+        with self._trava:
+            cache = {
+                nome: {**valores, 'taxa_acerto': valores['hits'] / (valores['hits'] + valores['misses'])}
+                for nome, valores in self.cache.items()
+            }
+            return {
+                'iniciado_em': self.iniciado_em,
+                'gerado_em': time.time(),
+                'etapas': {nome: dict(valores) for nome, valores in self.etapas.items()},
+                'llm': {nome: dict(valores) for nome, valores in self.llm.items()},
+                'janelas': {nome: dict(valores) for nome, valores in self.janelas.items()},
+                'redis': {'idas': self.redis_idas, 'comandos': dict(self.redis_comandos)},
+                'cache': cache,
+            }
+
+    def para_json(self):
+        return json.dumps(self.resumo(), indent=2, ensure_ascii=False)
+
+    def para_prometheus(self, resumo=None):
+        return resumo_para_prometheus([(None, resumo or self.resumo())])
+
+
+def _rotulo(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Converte resumos (de Metricas.resumo) para o formato de texto do Prometheus. `resumos` é
+# uma lista de pares (instancia, resumo); a instância identifica o processo quando os resumos
+# do painel e do worker são exportados juntos, com HELP e TYPE uma única vez por métrica.
+def resumo_para_prometheus(resumos):
+    linhas = []
+
+    def metrica(nome, tipo, ajuda, valores_do_resumo):
+        linhas.append(f'# HELP {PREFIXO_PROMETHEUS}_{nome} {ajuda}')
+        linhas.append(f'# TYPE {PREFIXO_PROMETHEUS}_{nome} {tipo}')
+        for instancia, resumo in resumos:
+            extra = f',instancia="{_rotulo(instancia)}"' if instancia else ''
+            for rotulos, valor in valores_do_resumo(resumo):
+                rotulos = (','.join(f'{chave}="{_rotulo(texto)}"' for chave, texto in rotulos.items()) + extra).lstrip(',')
+                linhas.append(f'{PREFIXO_PROMETHEUS}_{nome}{{{rotulos}}} {valor}' if rotulos else f'{PREFIXO_PROMETHEUS}_{nome} {valor}')
+
+    def por_etapa(campo):
+        return lambda resumo: [({'etapa': nome}, valores[campo]) for nome, valores in resumo['etapas'].items()]
+
+    def por_operacao(secao, campo):
+        return lambda resumo: [({'operacao': nome}, valores[campo]) for nome, valores in resumo.get(secao, {}).items()]
+
+    metrica('etapa_execucoes_total', 'counter', 'Execuções de cada etapa da atualização', por_etapa('execucoes'))
+    metrica('etapa_segundos_total', 'counter', 'Tempo acumulado de cada etapa da atualização', por_etapa('segundos'))
+    metrica('etapa_ultima_segundos', 'gauge', 'Duração da última execução de cada etapa', por_etapa('ultima'))
+
+    metrica('llm_chamadas_total', 'counter', 'Chamadas ao modelo por operação', por_operacao('llm', 'chamadas'))
+    metrica('llm_erros_total', 'counter', 'Chamadas ao modelo que falharam', por_operacao('llm', 'erros'))
+    metrica('llm_segundos_total', 'counter', 'Latência acumulada das chamadas ao modelo', por_operacao('llm', 'segundos'))
+    metrica('llm_tokens_total', 'counter', 'Tokens informados em response.usage', lambda resumo: (
+        [({'operacao': nome, 'tipo': 'prompt'}, valores['prompt_tokens']) for nome, valores in resumo['llm'].items()]
+        + [({'operacao': nome, 'tipo': 'completion'}, valores['completion_tokens']) for nome, valores in resumo['llm'].items()]
+    ))
+
+    metrica('conversa_tokens_total', 'counter', 'Tokens da conversa enviados nos prompts', por_operacao('janelas', 'tokens'))
+    metrica('conversa_prompts_total', 'counter', 'Prompts montados com a janela da conversa', por_operacao('janelas', 'prompts'))
+    metrica('conversa_mensagens_cortadas_total', 'counter', 'Mensagens cortadas por excederem o limite de tokens',
+            por_operacao('janelas', 'cortadas'))
+
+    metrica('redis_idas_total', 'counter', 'Idas ao Redis (comandos avulsos e pipelines)',
+            lambda resumo: [({}, resumo['redis']['idas'])])
+    metrica('redis_comandos_total', 'counter', 'Comandos enviados ao Redis',
+            lambda resumo: [({'comando': nome}, quantidade) for nome, quantidade in resumo['redis']['comandos'].items()])
+
+    metrica('cache_consultas_total', 'counter', 'Consultas aos caches', lambda resumo: (
+        [({'cache': nome, 'resultado': 'hit'}, valores['hits']) for nome, valores in resumo['cache'].items()]
+        + [({'cache': nome, 'resultado': 'miss'}, valores['misses']) for nome, valores in resumo['cache'].items()]
+    ))
+    return '\n'.join(linhas) + '\n'
+
+
+# Métricas compartilhadas pelo processo
+METRICAS = Metricas()
+
+
+# Decorador que registra a duração de cada chamada da função como a etapa `nome`
+def medir(nome, metricas=METRICAS):
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def medida(*args, **kwargs):
+            with metricas.etapa(nome):
+                return funcao(*args, **kwargs)
+        return medida
+    return decorador
+
+
+# Conta os comandos enviados por `redis_client`, inclusive os de pipelines, em `metricas`
+def instrumentar_redis(redis_client, metricas=METRICAS):
+    execute_command = redis_client.execute_command
+    pipeline = redis_client.pipeline
+
+    def executar_comando(*args, **options):
+        metricas.registrar_redis(args[:1])
+        return execute_command(*args, **options)
+
+    # Os comandos são anotados à medida que entram no pipeline (o pipeline do Redis Cluster
+    # não expõe a pilha de comandos como o pipeline comum)
+    def criar_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+        enfileirar = pipe.execute_command
+        comandos = []
+
+        def enfileirar_comando(*args_comando, **options):
+            comandos.append(args_comando[0])
+            return enfileirar(*args_comando, **options)
+
+        def executar_pipeline(*args_execute, **kwargs_execute):
+            if comandos:
+                metricas.registrar_redis(comandos)
+                comandos.clear()
+            return execute(*args_execute, **kwargs_execute)
+
+        pipe.execute_command = enfileirar_comando
+        pipe.execute = executar_pipeline
+        return pipe
+
+    redis_client.execute_command = executar_comando
+    redis_client.pipeline = criar_pipeline
+    return redis_client
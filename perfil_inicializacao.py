@@ -0,0 +1,135 @@
+# Perfil da inicialização a frio do dashboard, página por página.
+# Cada página é aberta em um processo novo (python -X importtime) pelo AppTest do Streamlit:
+# mede o tempo das importações feitas pelo script, da primeira execução (primeira pintura,
+# com as importações e a criação dos clientes) e de uma segunda execução (já aquecida),
+# e lista os pacotes que mais pesaram nas importações.
+#
+# Uso:
+#   python -m perfil_inicializacao
+#   python -m perfil_inicializacao --paginas "Dashboard BI,Configurações" --saida perfil.json
+#   python -m perfil_inicializacao --comparar perfil.json
+#
+# As credenciais são as salvas em Configurações; sem elas, as páginas abrem sem Redis/OpenAI.
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+PAGINAS = ["Painel de Mensagem", "Dashboard BI", "Configurações", "Diagnóstico"]
+TOLERANCIA_PADRAO = 0.3
+# Pacotes listados por página, em ordem de tempo de importação
+PACOTES_LISTADOS = 5
+# Separa no stderr as importações do AppTest (e do próprio Streamlit) das feitas pelo dashboard
+MARCADOR = '#perfil-inicio'
+DIRETORIO = Path(__file__).resolve().parent
+
+# Executado no processo filho; o resultado vai em JSON na última linha do stdout
+SCRIPT_PAGINA = f"""
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+sys.stderr.write({MARCADOR!r} + '\\n')
+sys.stderr.flush()
+at = AppTest.from_file('dashboard.py', default_timeout=120)
+at.session_state['pagina'] = sys.argv[1]
+inicio = time.perf_counter()
+at.run()
+primeira = time.perf_counter() - inicio
+inicio = time.perf_counter()
+at.run()
+segunda = time.perf_counter() - inicio
+print(json.dumps({{'primeira_execucao': primeira, 'segunda_execucao': segunda, 'erros': [str(e.value) for e in at.exception]}}))
+"""
+
+
+# Tempo das importações de nível mais alto registradas após o marcador, somado por pacote raiz
+def importacoes_por_pacote(stderr):
+    pacotes = {}
+    linhas = stderr.splitlines()
+    if MARCADOR in linhas:
+        linhas = linhas[linhas.index(MARCADOR) + 1:]
+    for linha in linhas:
+        if not linha.startswith('import time:') or 'cumulative' in linha:
+            continue
+        _, acumulado, nome = linha[len('import time:'):].split('|')
+        # Importações aninhadas são recuadas e já estão no acumulado da que as trouxe
+        if nome.startswith('  '):
+            continue
+        pacote = nome.strip().split('.')[0]
+        pacotes[pacote] = pacotes.get(pacote, 0.0) + int(acumulado) / 1e6
+    return pacotes
+
+
+def medir_pagina(pagina):
+    inicio = time.perf_counter()
+    processo = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', SCRIPT_PAGINA, pagina],
+        cwd=DIRETORIO, capture_output=True, text=True,
+    )
+    total = time.perf_counter() - inicio
+    if processo.returncode != 0:
+        raise RuntimeError(f"Falha ao abrir a página {pagina}:\n{processo.stderr[-2000:]}")
+    resultado = json.loads(processo.stdout.strip().splitlines()[-1])
+    pacotes = importacoes_por_pacote(processo.stderr)
+    return {
+        'processo': total,
+        'importacoes': sum(pacotes.values()),
+        'primeira_execucao': resultado['primeira_execucao'],
+        'segunda_execucao': resultado['segunda_execucao'],
+        'pacotes': dict(sorted(pacotes.items(), key=lambda item: item[1], reverse=True)[:PACOTES_LISTADOS]),
+        'erros': resultado['erros'],
+    }
+
+
+def imprimir_resultados(resultados):
+    for pagina, medidas in resultados.items():
+        print(f"{pagina}")
+        print(f"  processo completo   {medidas['processo'] * 1000:8.1f} ms")
+        print(f"  importações         {medidas['importacoes'] * 1000:8.1f} ms")
+        print(f"  primeira execução   {medidas['primeira_execucao'] * 1000:8.1f} ms")
+        print(f"  segunda execução    {medidas['segunda_execucao'] * 1000:8.1f} ms")
+        print("  " + ", ".join(f"{pacote} {segundos * 1000:.0f} ms" for pacote, segundos in medidas['pacotes'].items()))
+        for erro in medidas['erros']:
+            print(f"  ERRO {erro}")
+
+
+# Medidas que ficaram mais de `tolerancia` mais lentas que no arquivo de referência
+def comparar_resultados(resultados, referencia, tolerancia):
+    regressoes = []
+    for pagina, medidas in resultados.items():
+        anteriores = referencia.get(pagina, {})
+        for medida in ('importacoes', 'primeira_execucao'):
+            anterior = anteriores.get(medida)
+            if anterior and medidas[medida] > anterior * (1 + tolerancia):
+                regressoes.append(f'{pagina} / {medida}: {anterior * 1000:.1f} ms -> {medidas[medida] * 1000:.1f} ms')
+    return regressoes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Perfil da inicialização a frio de cada página do dashboard.")
+    parser.add_argument('--paginas', default=','.join(PAGINAS), help="Páginas a medir, separadas por vírgula")
+    parser.add_argument('--saida', help="Grava os resultados em JSON")
+    parser.add_argument('--comparar', help="JSON de uma execução anterior; termina com erro se alguma página regredir")
+    parser.add_argument('--tolerancia', type=float, default=TOLERANCIA_PADRAO, help="Regressão tolerada na comparação (0.3 = 30%%)")
+    args = parser.parse_args(argv)
+
+    paginas = [pagina.strip() for pagina in args.paginas.split(',')]
+    desconhecidas = [pagina for pagina in paginas if pagina not in PAGINAS]
+    if desconhecidas:
+        parser.error(f"Páginas desconhecidas: {', '.join(desconhecidas)}")
+
+    resultados = {pagina: medir_pagina(pagina) for pagina in paginas}
+    imprimir_resultados(resultados)
+    if args.saida:
+        Path(args.saida).write_text(json.dumps(resultados, indent=2, ensure_ascii=False))
+    if args.comparar:
+        regressoes = comparar_resultados(resultados, json.loads(Path(args.comparar).read_text()), args.tolerancia)
+        for regressao in regressoes:
+            print(f"REGRESSÃO {regressao}")
+        if regressoes:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
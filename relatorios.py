@@ -0,0 +1,135 @@
+from datetime import timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from conversas import COLUNAS_DASHBOARD, agregar_linhas, formatar_datas, ler_rollups, marcar_satisfeitos, normalizar_datas
+from metricas import medir
+
+# pyarrow é opcional: sem ele o relatório fica só em CSV e o BI lê o CSV
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+# O CSV continua sendo o formato de exportação; o BI lê o arquivo colunar (Arrow IPC/Feather),
+# já tipado e que pode ser mapeado em memória, carregando só as colunas de cada gráfico
+CAMINHO_RELATORIO_CSV = Path('data/relatorios_conversas.csv')
+CAMINHO_RELATORIO = Path('data/relatorios_conversas.arrow')
+# Versão dos dados do Redis (conversas.versao_dados_do_redis) de que o relatório foi gerado
+CAMINHO_VERSAO_RELATORIO = Path('data/relatorios_conversas.versao')
+CAMINHO_DDD_ESTADO = Path('data/ddd_estado_brasil.csv')
+
+# Períodos oferecidos nos seletores das páginas
+PERIODOS = ['Completo', 'Último mês', 'Últimos 14 dias', 'Últimos 7 dias', 'Ontem', 'Hoje']
+
+# Colunas usadas pelo Dashboard BI
+COLUNAS_BI = ['Data de Criação', 'Nome do usuário', 'Status', 'Nº User Messages', 'DDD', 'Satisfeito']
+
+
+# Converte as colunas do relatório para os tipos usados no BI
+def tipar_relatorio(df):
+    df = df.copy()
+    df['Data de Criação'] = normalizar_datas(df['Data de Criação'])
+    df['Nº User Messages'] = pd.to_numeric(df['Nº User Messages'], errors='coerce').fillna(0).astype('int32')
+    df['DDD'] = pd.to_numeric(df['DDD'], errors='coerce').astype('Int16')
+    df['Status'] = df['Status'].astype('category')
+    df['Satisfeito'] = marcar_satisfeitos(df['Resumo da Conversa (IA) 🤖'])
+    return df
+
+
+# Relatório em CSV, com as datas no FORMATO_DATA. Sem `caminho`, devolve o texto (download)
+def exportar_csv(df, caminho=None):
+    colunas = [coluna for coluna in COLUNAS_DASHBOARD if coluna in df.columns]
+    return df[colunas].assign(**{'Data de Criação': formatar_datas(df['Data de Criação'])}).to_csv(caminho, index=False)
+
+
+# Salva o relatório do painel: CSV para exportação e arquivo colunar tipado para o BI.
+# `versao_dados` é a versão dos dados do Redis de que `df` veio; sem ela, o relatório fica
+# sem versão e é regravado na próxima carga do painel.
+@medir('salvar_relatorio')
+def salvar_relatorio(df, versao_dados=None):
+    exportar_csv(df, CAMINHO_RELATORIO_CSV)
+    if feather is not None:
+        tabela = pa.Table.from_pandas(tipar_relatorio(df), preserve_index=False)
+        feather.write_feather(tabela, CAMINHO_RELATORIO)
+    if versao_dados is None:
+        CAMINHO_VERSAO_RELATORIO.unlink(missing_ok=True)
+    else:
+        CAMINHO_VERSAO_RELATORIO.write_text(str(versao_dados))
+
+
+# Versão dos dados do Redis gravada com o relatório, ou None
+def versao_dados_relatorio():
+    if not CAMINHO_VERSAO_RELATORIO.exists() or not CAMINHO_RELATORIO_CSV.exists():
+        return None
+    texto = CAMINHO_VERSAO_RELATORIO.read_text().strip()
+    return int(texto) if texto.isdigit() else None
+
+
+# Carrega apenas as colunas pedidas do relatório, já com os tipos do BI
+@medir('carregar_relatorio')
+def carregar_relatorio(colunas=COLUNAS_BI):
+    if feather is not None and CAMINHO_RELATORIO.exists():
+        return feather.read_table(CAMINHO_RELATORIO, columns=colunas, memory_map=True).to_pandas()
+    # Sem o arquivo colunar (pyarrow ausente ou relatório ainda não gerado), lê o CSV
+    return tipar_relatorio(pd.read_csv(CAMINHO_RELATORIO_CSV))[colunas]
+
+
+# Versão do relatório lido pelo BI (data de modificação do arquivo), usada como chave dos caches
+def versao_relatorio():
+    caminho = CAMINHO_RELATORIO if feather is not None and CAMINHO_RELATORIO.exists() else CAMINHO_RELATORIO_CSV
+    return caminho.stat().st_mtime_ns
+
+
+# Tabela indexada pelo DDD (0 a 99) com a sigla do estado, no lugar do merge com o CSV
+def carregar_estados_por_ddd(caminho=CAMINHO_DDD_ESTADO):
+    tabela = pd.read_csv(caminho)
+    estados = np.full(100, None, dtype=object)
+    estados[tabela['DDD'].to_numpy()] = tabela['Estado'].to_numpy()
+    return estados
+
+
+def estados_dos_ddds(ddds, estados):
+    # DDDs ausentes ou inválidos caem na posição 0, que não tem estado
+    posicoes = ddds.where(ddds.between(0, 99), 0).fillna(0).astype('int64').to_numpy()
+    return pd.Series(estados[posicoes], index=ddds.index)
+
+
+# Primeiro e último dia do período selecionado, contado a partir de `hoje` (None: sem limite)
+def intervalo_periodo(periodo, hoje):
+    if periodo == 'Último mês':
+        return hoje - timedelta(days=30), None
+    if periodo == 'Últimos 14 dias':
+        return hoje - timedelta(days=14), None
+    if periodo == 'Últimos 7 dias':
+        return hoje - timedelta(days=7), None
+    if periodo == 'Ontem':
+        return hoje - timedelta(days=1), hoje - timedelta(days=1)
+    if periodo == 'Hoje':
+        return hoje, hoje
+    # 'Completo', não aplica filtro
+    return None, None
+
+
+# Máscara das datas dentro do período selecionado
+def mascara_periodo(datas, periodo, hoje):
+    inicio, fim = intervalo_periodo(periodo, hoje)
+    dias = datas.dt.normalize()
+    mascara = pd.Series(True, index=datas.index)
+    if inicio is not None:
+        mascara &= dias >= pd.Timestamp(inicio)
+    if fim is not None:
+        mascara &= dias <= pd.Timestamp(fim)
+    return mascara
+
+
+# Agregados por dia, DDD e Status do período, lidos do Redis. Sem Redis, são calculados
+# a partir do relatório salvo.
+def carregar_agregados(redis_client, periodo, hoje):
+    if redis_client is not None:
+        return ler_rollups(redis_client, *intervalo_periodo(periodo, hoje))
+    df = carregar_relatorio()
+    return agregar_linhas(df[mascara_periodo(df['Data de Criação'], periodo, hoje)])
@@ -0,0 +1,154 @@
+# Worker de análise das conversas, desacoplado da execução do Streamlit.
+# Consome a fila fila:{analise} (preenchida pelo botão "Atualizar" do painel) e grava os
+# resultados em analise:* e dashboard_dados:*; o painel apenas lê os dados e o progresso.
+#
+# Uso:
+#   python -m worker
+#   python -m worker --redis-url redis://localhost:6379 --openai-base-url http://localhost:8000/v1 --uma-vez
+import argparse
+import json
+import logging
+
+from dotenv import load_dotenv
+
+from analise import Analisador, CacheAnalise, LimitadorTaxa
+from clientes import criar_cliente_openai, criar_cliente_redis, pipeline_transacao
+from configuracao import (
+    API_KEY_PATH, REDIS_URL_PATH, REDIS_PASSWORD_PATH,
+    AI_NAME_PATH, AI_OBJECTIVES_PATH, AI_STATUS_PATH,
+    LLM_CONCORRENCIA_PATH, LLM_RPM_PATH, LLM_TPM_PATH, LLM_MODO_ANALISE_PATH, LLM_ORCAMENTO_TOKENS_PATH,
+    LLM_RESUMO_INCREMENTAL_PATH,
+    CONCORRENCIA_PADRAO, RPM_PADRAO, TPM_PADRAO, MODO_ANALISE_UNICA, ORCAMENTO_TOKENS_PADRAO, RESUMO_INCREMENTAL_PADRAO,
+    le_chave, montar_url_redis,
+)
+from conversas import (
+    FILA_ANALISE, FILA_ANALISE_PROCESSANDO, PROGRESSO_ANALISE,
+    processar_telefones, salvar_dados_no_redis,
+)
+from metricas import CHAVE_METRICAS_WORKER, METRICAS
+
+logger = logging.getLogger('worker')
+
+
+# Configurações salvas pela página "Configurações" do dashboard. São relidas a cada lote
+# para que alterações feitas no painel valham sem reiniciar o worker.
+def carregar_configuracoes():
+    resumo_incremental = le_chave(LLM_RESUMO_INCREMENTAL_PATH)
+    return {
+        'api_key': le_chave(API_KEY_PATH),
+        'redis_url': le_chave(REDIS_URL_PATH),
+        'redis_password': le_chave(REDIS_PASSWORD_PATH),
+        'ai_name': le_chave(AI_NAME_PATH),
+        'ai_objectives': le_chave(AI_OBJECTIVES_PATH),
+        'ai_status': le_chave(AI_STATUS_PATH),
+        'llm_concorrencia': int(le_chave(LLM_CONCORRENCIA_PATH) or CONCORRENCIA_PADRAO),
+        'llm_rpm': int(le_chave(LLM_RPM_PATH) or RPM_PADRAO),
+        'llm_tpm': int(le_chave(LLM_TPM_PATH) or TPM_PADRAO),
+        'llm_modo_analise': le_chave(LLM_MODO_ANALISE_PATH) or MODO_ANALISE_UNICA,
+        'llm_orcamento_tokens': int(le_chave(LLM_ORCAMENTO_TOKENS_PATH) or ORCAMENTO_TOKENS_PADRAO),
+        # Salvo como booleano: só o arquivo ausente ('') usa o padrão
+        'llm_resumo_incremental': RESUMO_INCREMENTAL_PADRAO if resumo_incremental == '' else bool(resumo_incremental),
+    }
+
+
+# Itens que ficaram em processamento quando um worker anterior parou voltam para a fila.
+# Assume um único worker por fila.
+def reencaminhar_pendentes(redis_client):
+    devolvidos = 0
+    while redis_client.lmove(FILA_ANALISE_PROCESSANDO, FILA_ANALISE, 'RIGHT', 'LEFT') is not None:
+        devolvidos += 1
+    if devolvidos:
+        logger.info("%s itens devolvidos para a fila", devolvidos)
+
+
+# Retira até `tamanho` itens da fila, movendo-os para a lista de processamento.
+# Bloqueia até `timeout` segundos esperando o primeiro item.
+def obter_lote(redis_client, tamanho, timeout):
+    primeiro = redis_client.blmove(FILA_ANALISE, FILA_ANALISE_PROCESSANDO, timeout, 'LEFT', 'RIGHT')
+    if primeiro is None:
+        return []
+    pipe = redis_client.pipeline(transaction=False)
+    for _ in range(tamanho - 1):
+        pipe.lmove(FILA_ANALISE, FILA_ANALISE_PROCESSANDO, 'LEFT', 'RIGHT')
+    return [primeiro] + [item for item in pipe.execute() if item is not None]
+
+
+def processar_lote(redis_client, analisador, lote, max_concorrencia):
+    itens = [json.loads(item) for item in lote]
+    # Itens enfileirados após mudança nas configurações da IA ignoram as linhas anteriores
+    for reanalisar in (False, True):
+        grupo = [item for item in itens if bool(item.get('reanalisar')) == reanalisar]
+        if not grupo:
+            continue
+        df = processar_telefones(redis_client, analisador, grupo, reanalisar=reanalisar, max_concorrencia=max_concorrencia)
+        if not df.empty:
+            salvar_dados_no_redis(redis_client, df)
+
+    pipe = pipeline_transacao(redis_client)
+    pipe.hincrby(PROGRESSO_ANALISE, 'concluidos', len(lote))
+    for item in lote:
+        pipe.lrem(FILA_ANALISE_PROCESSANDO, 1, item)
+    pipe.execute()
+
+
+def executar(redis_client, client, uma_vez=False, timeout=5):
+    reencaminhar_pendentes(redis_client)
+    limitador = None
+    while True:
+        config = carregar_configuracoes()
+        # O limitador só é recriado quando os limites mudam, para manter o saldo entre lotes
+        if limitador is None or (limitador.rpm, limitador.tpm) != (config['llm_rpm'], config['llm_tpm']):
+            limitador = LimitadorTaxa(rpm=config['llm_rpm'], tpm=config['llm_tpm'])
+
+        lote = obter_lote(redis_client, config['llm_concorrencia'] * 4, timeout)
+        if not lote:
+            if uma_vez:
+                break
+            continue
+
+        redis_client.hset(PROGRESSO_ANALISE, 'status', 'processando')
+        analisador = Analisador(
+            client,
+            config['ai_name'],
+            config['ai_objectives'],
+            config['ai_status'],
+            modo=config['llm_modo_analise'],
+            limitador=limitador,
+            cache=CacheAnalise(redis_client),
+            orcamento_tokens=config['llm_orcamento_tokens'],
+            resumo_incremental=config['llm_resumo_incremental'],
+        )
+        with METRICAS.etapa('lote_worker'):
+            processar_lote(redis_client, analisador, lote, config['llm_concorrencia'])
+        logger.info("%s conversas processadas", len(lote))
+        redis_client.set(CHAVE_METRICAS_WORKER, METRICAS.para_json())
+
+        if redis_client.llen(FILA_ANALISE) == 0 and redis_client.llen(FILA_ANALISE_PROCESSANDO) == 0:
+            redis_client.hset(PROGRESSO_ANALISE, 'status', 'concluido')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Worker de análise das conversas do dashboard.")
+    parser.add_argument('--redis-url', help="URL completa do Redis (padrão: credenciais salvas em Configurações)")
+    parser.add_argument('--openai-base-url', help="Endpoint compatível com a API da OpenAI (ex.: servidor de testes)")
+    parser.add_argument('--uma-vez', action='store_true', help="Esvazia a fila e encerra em vez de aguardar novos itens")
+    parser.add_argument('--timeout', type=int, default=5, help="Segundos de espera por novos itens na fila")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    load_dotenv()
+
+    config = carregar_configuracoes()
+    redis_url = args.redis_url or montar_url_redis(config['redis_url'], config['redis_password'])
+    redis_client = criar_cliente_redis(redis_url)
+    redis_client.ping()
+
+    # Sem chave salva, usa OPENAI_API_KEY do ambiente
+    client = criar_cliente_openai(config['api_key'], base_url=args.openai_base_url)
+
+    logger.info("Worker aguardando itens em %s", FILA_ANALISE)
+    executar(redis_client, client, uma_vez=args.uma_vez, timeout=args.timeout)
+
+
+if __name__ == '__main__':
+    main()